@@ -1,6 +1,9 @@
 #! /bin/bash
 
+# The hash cache has to survive between runs, or every file gets re-read and re-hashed each night: mount a volume at
+# /var/lib/hashbak (or point HASH_CACHE somewhere that persists). Anything in "$@" overrides these.
 hashbak backup \
+  --hash-cache "${HASH_CACHE:-/var/lib/hashbak/hash-cache.sqlite}" \
   "$@" \
   --salt-hex $HASH_SALT \
   --key-hex $AES_KEY
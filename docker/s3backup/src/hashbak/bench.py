@@ -0,0 +1,338 @@
+import dataclasses
+import datetime
+import io
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import shutil
+import tempfile
+import time
+import typing
+
+import hashbak.codec
+import hashbak.entrypoints
+import hashbak.fmeta
+import hashbak.pack
+import hashbak.remote
+import hashbak.serial
+import hashbak.stream
+import hashbak.thaw
+
+
+logger = logging.getLogger(__name__)
+
+
+KEY = b'\x00' * 32
+SALT = b'bench'
+
+
+@dataclasses.dataclass
+class Result:
+    name: str
+    seconds: float
+    nbytes: int = 0
+    files: int = 0
+    # KiB, high-water mark over the stage where the kernel lets us reset it, over the whole run otherwise
+    peak_rss_kb: int = 0
+
+    @property
+    def mb_per_s(self) -> float:
+        return self.nbytes / (1024**2) / self.seconds if self.seconds else 0.0
+
+    @property
+    def files_per_s(self) -> float:
+        return self.files / self.seconds if self.seconds else 0.0
+
+    def to_dict(self) -> dict:
+        res = dataclasses.asdict(self)
+        res['mb_per_s'] = round(self.mb_per_s, 2)
+        res['files_per_s'] = round(self.files_per_s, 2)
+        return res
+
+    def __str__(self):
+        res = f'{self.name:<16} {self.seconds:8.2f}s'
+        if self.nbytes:
+            res += f' {self.mb_per_s:9.1f} MB/s'
+        if self.files:
+            res += f' {self.files_per_s:9.1f} files/s'
+        return res + f'   peak RSS {self.peak_rss_kb / 1024:.0f} MiB'
+
+
+def _reset_peak_rss() -> None:
+    # Linux only: writing 5 to clear_refs resets VmHWM, so each stage gets its own peak
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def _peak_rss_kb() -> int:
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    own = int(line.split()[1])
+                    break
+            else:
+                own = 0
+    except OSError:
+        own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Only matters with --hash-pool process, where hashing runs in child processes
+    return max(own, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+def _timed(name: str, fn: typing.Callable[[], typing.Any], nbytes: int = 0, files: int = 0) -> Result:
+    _reset_peak_rss()
+    start = time.perf_counter()
+    fn()
+    res = Result(name, time.perf_counter() - start, nbytes, files, _peak_rss_kb())
+    logger.info(str(res))
+    return res
+
+
+def _drain(xs: typing.Iterable[bytes]) -> int:
+    n = 0
+    for x in xs:
+        n += len(x)
+    return n
+
+
+def payload(size: int, seed: int = 0) -> typing.Iterable[bytes]:
+    # Pages of half random, half repetitive data: something for the compressor to do, without being trivial.
+    # A handful of distinct pages get cycled, so a big run doesn't need a big buffer.
+    rnd = random.Random(seed)
+    half = hashbak.stream.PAGE_SIZE // 2
+    pages = [rnd.randbytes(half) + (b'%d hashbak bench ' % i) * (half // 18) for i in range(8)]
+    pages = [page.ljust(hashbak.stream.PAGE_SIZE, b'\0')[:hashbak.stream.PAGE_SIZE] for page in pages]
+    sent = 0
+    i = 0
+    while sent < size:
+        page = pages[i % len(pages)][:size - sent]
+        sent += len(page)
+        i += 1
+        yield page
+
+
+def make_tree(root: str, small_files: int, small_size: int, large_files: int, large_size: int, seed: int = 0) -> (int, int):
+    # -> (files, bytes). Same seed + sizes, same tree, byte for byte.
+    rnd = random.Random(seed)
+    nbytes = 0
+    for i in range(small_files):
+        fdir = os.path.join(root, 'small', f'd{i % 100}')
+        os.makedirs(fdir, exist_ok=True)
+        size = rnd.randint(0, small_size * 2)
+        with open(os.path.join(fdir, f'f{i}'), 'wb') as out_f:
+            out_f.write(rnd.randbytes(size // 2) + b'x' * (size - size // 2))
+        nbytes += size
+    os.makedirs(os.path.join(root, 'large'), exist_ok=True)
+    for i in range(large_files):
+        with open(os.path.join(root, 'large', f'f{i}'), 'wb') as out_f:
+            for page in payload(large_size, seed=seed + i + 1):
+                out_f.write(page)
+        nbytes += large_size
+    return small_files + large_files, nbytes
+
+
+def bench_streams(work_dir: str, size: int, codec: hashbak.codec.Codec, seed: int = 0) -> [Result]:
+    res = []
+
+    fpath = os.path.join(work_dir, 'hash-input')
+    with open(fpath, 'wb') as out_f:
+        for page in payload(size, seed):
+            out_f.write(page)
+    res.append(_timed('file_hash', lambda: hashbak.fmeta.file_hash(fpath, SALT), size))
+    os.remove(fpath)
+
+    compressed = []
+    res.append(_timed('compress', lambda: compressed.extend(hashbak.stream.compress(payload(size, seed), codec)), size))
+    res.append(_timed('decompress', lambda: _drain(hashbak.stream.decompress(compressed)), size))
+    gzipped = []
+    res.append(_timed('gzip', lambda: gzipped.extend(hashbak.stream.gzip(payload(size, seed))), size))
+    res.append(_timed('ungzip', lambda: _drain(hashbak.stream.ungzip(gzipped)), size))
+    del compressed, gzipped
+
+    encrypted = []
+    res.append(_timed('encrypt', lambda: encrypted.extend(hashbak.stream.encrypt(payload(size, seed), KEY, b'\0' * 16)), size))
+    res.append(_timed('decrypt', lambda: _drain(hashbak.stream.decrypt(encrypted, KEY)), size))
+    encrypted = []
+    res.append(_timed('encrypt_gcm', lambda: encrypted.extend(hashbak.stream.encrypt_gcm(payload(size, seed), KEY)), size))
+    res.append(_timed('decrypt_gcm', lambda: _drain(hashbak.stream.decrypt(encrypted, KEY)), size))
+    del encrypted
+
+    # Lots of little pages in, full pages out: the shape of a multipart upload. Then pieces that don't line up with
+    # pages, and ones much bigger than a page (a whole chunk handed over at once).
+    for name, piece_size in [('paginate', 64 * 1024), ('paginate_3m', 3 * 1024**2), ('paginate_64m', 64 * 1024**2)]:
+        if piece_size > size:
+            continue
+        piece = b''.join(payload(piece_size, seed))
+        count = size // piece_size
+        res.append(_timed(name, lambda: _drain(hashbak.stream.paginate(piece for _ in range(count))), count * piece_size))
+        del piece
+
+    def split():
+        head, rest = hashbak.stream.split(payload(size, seed), 16)
+        _drain(rest)
+    res.append(_timed('split', split, size))
+
+    def iterio():
+        buf = hashbak.stream.IterIO(payload(size, seed))
+        # Odd read sizes, so reads keep straddling pages
+        while buf.more:
+            buf.read(hashbak.serial.INTSIZE)
+            buf.read(100_003)
+    res.append(_timed('IterIO', iterio, size))
+    return res
+
+
+def bench_serial(count: int, seed: int = 0) -> [Result]:
+    meta = hashbak.fmeta.FMeta(
+        fname='/some/reasonably/deep/path/to/a/file.jpg',
+        ftype=hashbak.fmeta.FileType.file,
+        fhash=random.Random(seed).randbytes(32),
+        ino=123456,
+        uid=1000,
+        gid=1000,
+        mode=0o100644,
+    )
+    buf = io.BytesIO()
+
+    def encode():
+        for _ in range(count):
+            meta.write(buf)
+
+    def decode():
+        for _ in hashbak.fmeta.iter_meta([data]):
+            pass
+
+    res = [_timed('serial_encode', encode, files=count)]
+    data = buf.getvalue()
+    res.append(_timed('serial_decode', decode, len(data), count))
+    return res
+
+
+def bench_end_to_end(
+        work_dir: str,
+        small_files: int,
+        small_size: int,
+        large_files: int,
+        large_size: int,
+        codec: hashbak.codec.Codec,
+        hash_workers: int,
+        restore_workers: int,
+        seed: int = 0,
+) -> [Result]:
+    src = os.path.join(work_dir, 'src')
+    dest = os.path.join(work_dir, 'dest')
+    logger.info(f'Writing test tree: {small_files} small files, {large_files} x {large_size} bytes (seed {seed})')
+    files, nbytes = make_tree(src, small_files, small_size, large_files, large_size, seed)
+
+    def storage() -> hashbak.pack.PackedStorage:
+        return hashbak.pack.PackedStorage(hashbak.remote.EncryptedLocalStorage(
+            KEY,
+            codec=codec,
+            cipher='gcm',
+            root=os.path.join(work_dir, 'remote'),
+        ))
+
+    res = [_timed('backup', lambda: hashbak.entrypoints.backup(src, SALT, storage(), hash_workers=hash_workers), nbytes, files)]
+
+    def restore():
+        store = storage()
+        name = store.list_meta()[0]
+        # Local "thaws" are instant, no point waiting between polls -- or rate limiting them, which would time the
+        # limiter rather than the restore
+        with hashbak.thaw.ThawPlanner(store, rate=0, min_poll=0) as thaw:
+            hashbak.entrypoints.full_restore(name, dest, SALT, store, workers=restore_workers, thaw=thaw)
+    res.append(_timed('restore', restore, nbytes, files))
+    return res
+
+
+def run(
+        work_dir: typing.Optional[str] = None,
+        stream_size: int = 256 * (1024**2),
+        serial_count: int = 100_000,
+        small_files: int = 10_000,
+        small_size: int = 16 * 1024,
+        large_files: int = 2,
+        large_size: int = 2 * (1024**3),
+        codec: typing.Optional[hashbak.codec.Codec] = None,
+        hash_workers: int = 1,
+        restore_workers: int = 8,
+        stages: typing.Optional[typing.Set[str]] = None,
+        seed: int = 0,
+) -> dict:
+    codec = codec or hashbak.codec.ZstdCodec()
+    stages = stages or {'stream', 'serial', 'e2e'}
+    # Everything that decides what gets measured. compare() only trusts runs where these match.
+    params = {
+        'seed': seed,
+        'stages': sorted(stages),
+        'stream_size': stream_size,
+        'serial_count': serial_count,
+        'small_files': small_files,
+        'small_size': small_size,
+        'large_files': large_files,
+        'large_size': large_size,
+        'codec': codec.name,
+        'hash_workers': hash_workers,
+        'restore_workers': restore_workers,
+    }
+    tmp = tempfile.mkdtemp(prefix='hashbak-bench-', dir=work_dir)
+    results = []
+    try:
+        if 'stream' in stages:
+            results.extend(bench_streams(tmp, stream_size, codec, seed))
+        if 'serial' in stages:
+            results.extend(bench_serial(serial_count, seed))
+        if 'e2e' in stages:
+            results.extend(bench_end_to_end(
+                tmp, small_files, small_size, large_files, large_size, codec, hash_workers, restore_workers, seed,
+            ))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return {
+        'time': datetime.datetime.now().isoformat(),
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'codec': codec.name,
+        'params': params,
+        'results': [r.to_dict() for r in results],
+    }
+
+
+def compare(report: dict, baseline: dict) -> typing.Iterable[str]:
+    # One line per stage in both: throughput change, + is faster. Different datasets / settings get called out first,
+    # numbers from those aren't comparable.
+    before_params = baseline.get('params', {})
+    for key, value in report.get('params', {}).items():
+        if before_params.get(key) != value:
+            yield f'WARNING: {key} differs ({before_params.get(key)} -> {value}), not a like-for-like comparison'
+    before = {r['name']: r for r in baseline['results']}
+    for r in report['results']:
+        prev = before.get(r['name'])
+        if prev is None:
+            continue
+        key = 'mb_per_s' if r['mb_per_s'] and prev['mb_per_s'] else 'files_per_s'
+        if not prev[key]:
+            continue
+        unit = 'MB/s' if key == 'mb_per_s' else 'files/s'
+        change = (r[key] - prev[key]) / prev[key] * 100
+        yield f'{r["name"]:<16} {prev[key]:9.1f} -> {r[key]:9.1f} {unit} ({change:+.1f}%)'
+
+
+def print_report(report: dict, baseline: typing.Optional[dict] = None):
+    for r in report['results']:
+        print(Result(**{f.name: r[f.name] for f in dataclasses.fields(Result)}))
+    if baseline is not None:
+        print(f'vs. {baseline["time"]}:')
+        for line in compare(report, baseline):
+            print(line)
+
+
+def save(report: dict, path: str):
+    with open(path, 'w') as out_f:
+        json.dump(report, out_f, indent=2)
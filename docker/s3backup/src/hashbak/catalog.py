@@ -0,0 +1,172 @@
+import dataclasses
+import os
+import sqlite3
+import threading
+import time
+import typing
+
+
+@dataclasses.dataclass
+class ObjectInfo:
+    fhash: bytes
+    # Bytes actually stored (compressed + encrypted)
+    size: int = 0
+    # Empty if unknown (e.g. rebuilt from a bucket listing, which doesn't say)
+    codec: str = ''
+    storage_class: str = ''
+    uploaded: float = 0.0
+    # Set for files stored inside a pack (see hashbak.pack)
+    pack: typing.Optional[str] = None
+
+    def count(self, pages: typing.Iterable[bytes]) -> typing.Iterable[bytes]:
+        # Pass-through that adds up the stored size as an upload streams by
+        for page in pages:
+            self.size += len(page)
+            yield page
+
+
+class Catalog:
+    """
+    Local record of what's been uploaded: hash -> (stored size, codec, storage class, upload time, pack), plus which
+    snapshots reference which hashes
+
+    Rows go in as each upload completes, so the catalog never claims something that isn't stored. It can still be
+    missing things (uploads from another machine, a lost catalog file) -- unless `trusted` is set, a miss falls back
+    to asking the bucket. `hashbak catalog sync` rebuilds it from the bucket.
+
+    The other way it goes wrong is a gc --delete it didn't see (run elsewhere, or with another catalog): it would claim
+    objects that are gone. gc leaves a marker in the bucket saying which sweep ran last (see hashbak.garbage), `swept`
+    is the one this catalog is up to date with, and a backup that finds they differ sets `stale`: no answers from
+    the catalog at all that run, everything gets asked of the bucket.
+
+    Safe to share between threads (uploads record themselves from whichever worker ran them).
+    """
+
+    def __init__(self, path: str = ':memory:', trusted: bool = False):
+        self.path = path
+        self.trusted = trusted
+        self.stale = False
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.RLock()
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS objects (
+                fhash BLOB PRIMARY KEY,
+                size INTEGER NOT NULL,
+                codec TEXT NOT NULL,
+                storage_class TEXT NOT NULL,
+                uploaded REAL NOT NULL,
+                pack TEXT
+            )
+        ''')
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS refs (
+                snapshot TEXT NOT NULL,
+                fhash BLOB NOT NULL,
+                PRIMARY KEY (snapshot, fhash)
+            )
+        ''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS refs_fhash ON refs (fhash)')
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS state (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )
+        ''')
+        self.db.commit()
+
+    def __enter__(self) -> 'Catalog':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _insert(self, info: ObjectInfo) -> None:
+        self.db.execute(
+            'INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?, ?)',
+            (info.fhash, info.size, info.codec, info.storage_class, info.uploaded or time.time(), info.pack),
+        )
+
+    def add(self, info: ObjectInfo) -> None:
+        # One commit per upload: cheap next to the upload itself, and a crash can't lose a row for something stored
+        with self.lock:
+            self._insert(info)
+            self.db.commit()
+
+    def add_many(self, infos: typing.Iterable[ObjectInfo]) -> None:
+        with self.lock, self.db:
+            for info in infos:
+                self._insert(info)
+
+    def __contains__(self, fhash: bytes) -> bool:
+        with self.lock:
+            return self.db.execute('SELECT 1 FROM objects WHERE fhash = ?', (fhash,)).fetchone() is not None
+
+    def get(self, fhash: bytes) -> typing.Optional[ObjectInfo]:
+        with self.lock:
+            row = self.db.execute(
+                'SELECT fhash, size, codec, storage_class, uploaded, pack FROM objects WHERE fhash = ?',
+                (fhash,),
+            ).fetchone()
+        return None if row is None else ObjectInfo(*row)
+
+    def add_refs(self, snapshot: str, fhashes: typing.Iterable[bytes]) -> None:
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM refs WHERE snapshot = ?', (snapshot,))
+            self.db.executemany('INSERT OR IGNORE INTO refs VALUES (?, ?)', ((snapshot, fhash) for fhash in fhashes))
+
+    def discard(self, fhashes: typing.Iterable[bytes]) -> None:
+        # Objects deleted from the bucket (see hashbak.garbage)
+        with self.lock, self.db:
+            self.db.executemany('DELETE FROM objects WHERE fhash = ?', ((fhash,) for fhash in fhashes))
+
+    def discard_packs(self, pack_ids: typing.Iterable[str]) -> None:
+        with self.lock, self.db:
+            self.db.executemany('DELETE FROM objects WHERE pack = ?', ((pack_id,) for pack_id in pack_ids))
+
+    def keep_snapshots(self, snapshots: typing.Iterable[str]) -> None:
+        # Drops refs for every snapshot not listed
+        snapshots = list(snapshots)
+        with self.lock, self.db:
+            self.db.execute(
+                f'DELETE FROM refs WHERE snapshot NOT IN ({",".join("?" * len(snapshots))})',
+                snapshots,
+            )
+
+    @property
+    def swept(self) -> typing.Optional[str]:
+        with self.lock:
+            row = self.db.execute("SELECT value FROM state WHERE key = 'swept'").fetchone()
+        return None if row is None else row[0]
+
+    @swept.setter
+    def swept(self, marker: typing.Optional[str]) -> None:
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO state VALUES ('swept', ?)", (marker,))
+
+    def clear(self) -> None:
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM objects')
+            self.db.execute('DELETE FROM refs')
+
+    def stats(self) -> typing.Dict[str, typing.Any]:
+        by_class = {}
+        for storage_class, packed, count, size in self.db.execute(
+                'SELECT storage_class, pack IS NOT NULL, COUNT(*), SUM(size) FROM objects GROUP BY 1, 2'):
+            key = f'{storage_class} (packed)' if packed else storage_class
+            by_class[key] = {'objects': count, 'bytes': size}
+        snapshots = self.db.execute('SELECT COUNT(DISTINCT snapshot) FROM refs').fetchone()[0]
+        unreferenced = self.db.execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM objects WHERE fhash NOT IN (SELECT fhash FROM refs)'
+        ).fetchone()
+        return {
+            'storage': by_class,
+            'snapshots': snapshots,
+            'unreferenced': {'objects': unreferenced[0], 'bytes': unreferenced[1]},
+        }
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
@@ -0,0 +1,90 @@
+import hashlib
+import typing
+
+
+MASK64 = (1 << 64) - 1
+
+
+def _gear_table() -> [int]:
+    # Any fixed table of random-looking 64 bit ints works, it just has to never change (or every chunk boundary moves)
+    res = []
+    for i in range(256):
+        digest = hashlib.sha256(b'hashbak-gear' + bytes([i])).digest()
+        res.append(int.from_bytes(digest[:8], 'little'))
+    return res
+
+
+GEAR = _gear_table()
+
+
+def _mask(bits: int) -> int:
+    # Use the high bits: with a shift-left gear hash, those depend on the last ~64 bytes rather than the last few
+    return ((1 << bits) - 1) << (64 - bits)
+
+
+def chunk_hash(data: bytes, salt: bytes) -> bytes:
+    # Same construction as hashbak.fmeta.file_hash, so a file that's a single chunk dedups against itself
+    acc = hashlib.sha256()
+    acc.update(salt)
+    acc.update(data)
+    return acc.digest()
+
+
+class Chunker:
+    """
+    FastCDC-style content defined chunking
+
+    Boundaries are picked by a rolling gear hash over the contents, so an insert/append only moves the boundaries
+    near the edit and every other chunk keeps its hash. Normalized chunking: a stricter mask before avg_size and a
+    looser one after, which keeps chunk sizes bunched up around avg_size.
+
+    This is pure python, so it only manages a few MB/s -- fine for a nightly job on the files that changed, not
+    something to run over a whole media library.
+    """
+
+    def __init__(self, avg_size: int = 4 * (1024**2), min_size: typing.Optional[int] = None, max_size: typing.Optional[int] = None):
+        self.avg_size = avg_size
+        self.min_size = min_size if min_size is not None else avg_size // 4
+        self.max_size = max_size if max_size is not None else avg_size * 4
+        bits = max(avg_size.bit_length() - 1, 4)
+        self.mask_s = _mask(bits + 2)
+        self.mask_l = _mask(bits - 2)
+
+    @property
+    def min_file_size(self) -> int:
+        # Below this, chunking buys very little over just storing the whole file
+        return self.max_size
+
+    def _cut(self, buf: bytearray, n: int) -> int:
+        if n <= self.min_size:
+            return n
+        gear = GEAR
+        fp = 0
+        view = memoryview(buf)
+        normal = min(self.avg_size, n)
+        mask = self.mask_s
+        # Iterating a memoryview is a fair bit quicker than indexing the bytearray
+        for i, b in enumerate(view[self.min_size:normal], self.min_size + 1):
+            fp = ((fp << 1) + gear[b]) & MASK64
+            if not fp & mask:
+                return i
+        end = min(self.max_size, n)
+        mask = self.mask_l
+        for i, b in enumerate(view[normal:end], normal + 1):
+            fp = ((fp << 1) + gear[b]) & MASK64
+            if not fp & mask:
+                return i
+        return end
+
+    def chunks(self, pages: typing.Iterable[bytes]) -> typing.Iterable[bytes]:
+        buf = bytearray()
+        for page in pages:
+            buf += page
+            while len(buf) >= self.max_size:
+                cut = self._cut(buf, len(buf))
+                yield bytes(buf[:cut])
+                del buf[:cut]
+        while buf:
+            cut = self._cut(buf, len(buf))
+            yield bytes(buf[:cut])
+            del buf[:cut]
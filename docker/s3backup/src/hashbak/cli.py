@@ -1,8 +1,56 @@
 import argparse
+import contextlib
+import json
+import os
+import sys
+import tempfile
 
+import hashbak.bench
+import hashbak.catalog
+import hashbak.chunker
+import hashbak.codec
 import hashbak.entrypoints
+import hashbak.hashcache
 import hashbak.log
+import hashbak.metrics
+import hashbak.pack
+import hashbak.profiling
 import hashbak.remote
+import hashbak.snapshot
+import hashbak.thaw
+
+
+# Where state that has to outlive a run (the hash cache) goes by default
+STATE_DIR = os.environ.get('HASHBAK_STATE_DIR', os.path.expanduser('~/.cache/hashbak'))
+
+
+def add_backend_args(parser: argparse.ArgumentParser):
+    parser.add_argument('--s3-bucket')
+    local = parser.add_argument_group('local backend', 'a directory standing in for S3, for running offline')
+    local.add_argument('--local-root', help='use this directory instead of --s3-bucket')
+    local.add_argument('--local-latency-ms', type=float, default=0, help='added to every request')
+    local.add_argument('--local-bandwidth-mb', type=float, default=0, help='MB/s shared by all requests, 0 for unlimited')
+    local.add_argument('--local-thaw-delay', type=float, default=0, help='seconds until a thaw request completes')
+    local.add_argument('--local-throttle-rate', type=float, default=0, help='fraction of requests that get throttled')
+
+
+def remote_storage(args, aes_key: bytes, threshold: int = 0, pack_size: int = 128 * (1024**2), **kwargs) -> hashbak.pack.PackedStorage:
+    # Always wrapped, so every command sees packed files: only backup ever sets a threshold (see --pack-threshold-kb)
+    if args.local_root:
+        inner = hashbak.remote.EncryptedLocalStorage(
+            aes_key=aes_key,
+            root=args.local_root,
+            latency=args.local_latency_ms / 1000,
+            bandwidth=args.local_bandwidth_mb * (1024**2),
+            thaw_delay=args.local_thaw_delay,
+            throttle_rate=args.local_throttle_rate,
+            **kwargs,
+        )
+    elif args.s3_bucket:
+        inner = hashbak.remote.EncryptedS3Storage(aes_key=aes_key, bucket=args.s3_bucket, **kwargs)
+    else:
+        raise SystemExit('Need either --s3-bucket or --local-root')
+    return hashbak.pack.PackedStorage(inner, threshold, pack_size)
 
 
 def cli_args():
@@ -13,67 +61,288 @@ def cli_args():
     backup.add_argument('--src-dir', required=True)
     backup.add_argument('--salt-hex', required=True)
     backup.add_argument('--key-hex', required=True)
-    backup.add_argument('--s3-bucket', required=True)
+    add_backend_args(backup)
+    backup.add_argument(
+        '--hash-cache',
+        default=os.path.join(STATE_DIR, 'hash-cache.sqlite'),
+        help='sqlite file to remember file hashes between runs (":memory:" to start from scratch every time)',
+    )
+    backup.add_argument('--rehash', action='store_true', help='ignore (but still refresh) the hash cache')
+    backup.add_argument('--hash-workers', type=int, default=os.cpu_count() or 1)
+    backup.add_argument('--hash-pool', choices=['process', 'thread'], default='thread', help='"process" helps when hashing is CPU bound (fast local disks)')
+    backup.add_argument('--upload-concurrency', type=int, default=4, help='parts of one upload in flight at once')
+    backup.add_argument('--upload-buffer-mb', type=int, default=256, help='memory for the parts of one upload (so per upload worker), caps the part size')
+    backup.add_argument('--upload-workers', type=int, default=1, help='files uploaded at once, alongside hashing')
+    backup.add_argument('--walk-ahead', type=int, default=10_000, help='how many paths the directory walk can get ahead of hashing')
+    backup.add_argument('--chunked', action='store_true', help='store new large files as content-defined chunks')
+    backup.add_argument('--chunk-avg-size', type=int, default=4 * (1024**2))
+    backup.add_argument('--codec', choices=['gzip', 'zstd'], default='gzip', help='zstd is faster at a similar ratio, gzip is what older versions wrote')
+    backup.add_argument('--compress-level', type=int, default=None)
+    backup.add_argument('--compress-threads', type=int, default=0, help='zstd only')
+    backup.add_argument('--skip-compressed', action='store_true', help='store media / archives uncompressed instead of recompressing them')
+    backup.add_argument('--cipher', choices=['cbc', 'gcm'], default='cbc', help='gcm is authenticated, can use --crypt-workers and lets `cat` read from the middle of a file; cbc is what older versions wrote')
+    backup.add_argument('--crypt-workers', type=int, default=1, help='gcm only: frames encrypted in parallel')
+    backup.add_argument('--pack-threshold-kb', type=int, default=0, help='files up to this size get packed together (e.g. 1024), 0 to store every file on its own')
+    backup.add_argument('--pack-size-mb', type=int, default=128)
+    backup.add_argument('--incremental', action='store_true', help='skip files that look unchanged since the last snapshot')
+    backup.add_argument('--single-pass', action='store_true', help='read new files once: copy to local scratch while hashing, upload from there')
+    backup.add_argument('--spool-dir', default=None, help='scratch directory for --single-pass (default: system temp dir)')
+    backup.add_argument('--spool-limit-mb', type=int, default=4096, help='max scratch space for --single-pass, bigger files get read twice')
+    backup.add_argument('--catalog', help='sqlite file recording uploaded objects, checked before asking the bucket')
+    backup.add_argument('--trust-catalog', action='store_true', help="treat --catalog as complete: don't list the bucket at all (unless gc --delete has run since it was synced)")
+    backup.add_argument('--progress-interval', type=float, default=60.0, help='seconds between progress lines, 0 for none')
+    backup.add_argument('--metrics-textfile', help='keep Prometheus metrics in this file (for the node exporter textfile collector)')
+    backup.add_argument('--metrics-port', type=int, help='serve Prometheus metrics on this port')
+    backup.add_argument('--profile', metavar='PREFIX', help='write per-stage timings, cProfile stats and flamegraph stacks to PREFIX.*')
 
     restore = subparsers.add_parser('restore')
     restore.add_argument('--snapshot', required=True)
     restore.add_argument('--dest-dir', required=True)
     restore.add_argument('--salt-hex', required=True)
     restore.add_argument('--key-hex', required=True)
-    restore.add_argument('--s3-bucket', required=True)
+    add_backend_args(restore)
+    restore.add_argument('--hash-cache', default=':memory:')
+    restore.add_argument('--restore-workers', type=int, default=8, help='files downloaded + written at once')
+    restore.add_argument('--restore-memory-mb', type=int, default=512, help='rough cap on memory used by in-flight files')
+    restore.add_argument('--thaw-state', default=':memory:', help='sqlite file tracking thaw requests, so an interrupted restore can resume')
+    restore.add_argument('--thaw-workers', type=int, default=8)
+    restore.add_argument('--thaw-rate', type=float, default=50.0, help='max thaw requests / status checks per second')
+    restore.add_argument('--thaw-min-poll', type=float, default=60.0, help='seconds between thaw status checks, to start with')
+    restore.add_argument('--path', help='only restore this file / directory (relative to the backup root, e.g. /photos)')
+    restore.add_argument('--include', action='append', default=[], help='glob, e.g. "/photos/*.jpg". Repeatable.')
+    restore.add_argument('--exclude', action='append', default=[], help='glob, applied after --include. Repeatable.')
+
+    report = subparsers.add_parser('report')
+    report.add_argument('--snapshot', required=True)
+    report.add_argument('--key-hex', required=True)
+    add_backend_args(report)
 
     list_ = subparsers.add_parser('list')
-    list_.add_argument('--s3-bucket', required=True)
+    add_backend_args(list_)
 
     show = subparsers.add_parser('show')
     show.add_argument('--snapshot', required=True)
-    show.add_argument('--s3-bucket', required=True)
+    add_backend_args(show)
     show.add_argument('--key-hex', required=True)
+    show.add_argument('--path', help='Only list this file / directory (path relative to the backup root, e.g. /photos)')
+
+    cat = subparsers.add_parser('cat')
+    cat.add_argument('--snapshot', required=True)
+    add_backend_args(cat)
+    cat.add_argument('--key-hex', required=True)
+    cat.add_argument('--path', required=True, help='path relative to the backup root, e.g. /videos/a.mkv')
+    cat.add_argument('--offset', type=int, default=0, help='first byte to write')
+    cat.add_argument('--length', type=int, default=None, help='bytes to write (default: to the end). Only gcm objects skip downloading what comes before --offset')
+
+    catalog = subparsers.add_parser('catalog')
+    catalog.add_argument('action', choices=['sync', 'stats'])
+    catalog.add_argument('--catalog', required=True)
+    add_backend_args(catalog)
+    catalog.add_argument('--key-hex', help='sync only')
+
+    gc = subparsers.add_parser('gc')
+    gc.add_argument('--key-hex', required=True)
+    add_backend_args(gc)
+    gc.add_argument('--delete', action='store_true', help="actually delete, rather than just report. Takes a lock in the bucket: refuses to start while a backup is running, and backups refuse to start until it's done")
+    gc.add_argument('--grace-hours', type=float, default=48, help='never touch anything younger, e.g. from a backup still running')
+    gc.add_argument('--early-delete', action='store_true', help='delete archived objects inside their minimum storage duration too (billed anyway)')
+    gc.add_argument('--max-exact', type=int, default=2_000_000, help='referenced hashes kept exactly, past that a bloom filter (bounded memory, keeps a little garbage)')
+    gc.add_argument('--catalog', help='keep this catalog in line with what gets deleted')
+    gc.add_argument('--output', help='also write the JSON report here')
+
+    verify = subparsers.add_parser('verify')
+    verify.add_argument('--snapshot', action='append', default=[], help='repeatable, default: every snapshot')
+    verify.add_argument('--key-hex', required=True)
+    add_backend_args(verify)
+    verify.add_argument('--deep', action='store_true', help='download + decrypt whatever is readable without a thaw, and check its hash')
+    verify.add_argument('--salt-hex', help='needed for --deep')
+    verify.add_argument('--sample', type=float, default=1.0, help='fraction of objects --deep checks, picked at random')
+    verify.add_argument('--workers', type=int, default=8)
+    verify.add_argument('--rate', type=float, default=50.0, help='max requests per second')
+    verify.add_argument('--output', help='also write the JSON report here')
+
+    bench = subparsers.add_parser(
+        'bench',
+        description='Synthetic data only, generated from --seed: the same seed and sizes give the same data every run. '
+                    'Save a baseline with --output, then --compare against it after a change (see the Makefile\'s '
+                    'bench-baseline / bench targets).',
+    )
+    bench.add_argument('--stages', nargs='+', choices=['stream', 'serial', 'e2e'], default=['stream', 'serial', 'e2e'])
+    bench.add_argument('--seed', type=int, default=0, help='for the generated test data')
+    bench.add_argument('--work-dir', help='where the test tree + local "bucket" go (default: system temp dir)')
+    bench.add_argument('--stream-mb', type=int, default=256, help='data pushed through each stream stage')
+    bench.add_argument('--serial-count', type=int, default=100_000)
+    bench.add_argument('--small-files', type=int, default=10_000)
+    bench.add_argument('--small-size-kb', type=int, default=16, help='average size of the small files')
+    bench.add_argument('--large-files', type=int, default=2)
+    bench.add_argument('--large-size-mb', type=int, default=2048)
+    bench.add_argument('--codec', choices=['gzip', 'zstd'], default='zstd')
+    bench.add_argument('--hash-workers', type=int, default=os.cpu_count() or 1)
+    bench.add_argument('--restore-workers', type=int, default=8)
+    bench.add_argument('--output', help='save results here as JSON')
+    bench.add_argument('--compare', help='earlier --output file to compare against')
 
     return parser.parse_args()
 
 
+def backup_codec(args) -> hashbak.codec.Codec:
+    codec = hashbak.codec.by_name(args.codec, args.compress_level, args.compress_threads)
+    if args.skip_compressed:
+        codec = hashbak.codec.AdaptiveCodec(codec)
+    return codec
+
+
 def main():
-    hashbak.log.setup_logs()
     args = cli_args()
+    # These write their results to stdout (a JSON report, file contents), which has to stay clean
+    hashbak.log.setup_logs(sys.stderr if args.cmd in {'gc', 'verify', 'cat'} else sys.stdout)
 
     if args.cmd == "backup":
-        hashbak.entrypoints.backup(
-            root=args.src_dir,
-            hash_salt=bytes.fromhex(args.salt_hex),
-            storage=hashbak.remote.EncryptedS3Storage(
-                aes_key=bytes.fromhex(args.key_hex),
-                bucket=args.s3_bucket,
+        with hashbak.hashcache.HashCache(args.hash_cache, rehash=args.rehash) as cache, \
+                (hashbak.catalog.Catalog(args.catalog, args.trust_catalog) if args.catalog else contextlib.nullcontext()) as catalog, \
+                hashbak.metrics.Progress(args.progress_interval, args.metrics_textfile, args.metrics_port), \
+                (hashbak.profiling.Profiler(args.profile) if args.profile else contextlib.nullcontext()):
+            hashbak.entrypoints.backup(
+                root=args.src_dir,
+                hash_salt=bytes.fromhex(args.salt_hex),
+                storage=remote_storage(
+                    args,
+                    aes_key=bytes.fromhex(args.key_hex),
+                    threshold=args.pack_threshold_kb * 1024,
+                    pack_size=args.pack_size_mb * (1024**2),
+                    upload_concurrency=args.upload_concurrency,
+                    upload_buffer=args.upload_buffer_mb * (1024**2),
+                    codec=backup_codec(args),
+                    cipher=args.cipher,
+                    crypt_workers=args.crypt_workers,
+                    catalog=catalog,
+                ),
+                cache=cache,
+                hash_workers=args.hash_workers,
+                hash_pool=args.hash_pool,
+                chunker=hashbak.chunker.Chunker(args.chunk_avg_size) if args.chunked else None,
+                incremental=args.incremental,
+                spool_dir=(args.spool_dir or os.path.join(tempfile.gettempdir(), 'hashbak-spool')) if args.single_pass else None,
+                spool_limit=args.spool_limit_mb * (1024**2),
+                upload_workers=args.upload_workers,
+                walk_ahead=args.walk_ahead,
             )
-        )
+            cache.compact()
 
     elif args.cmd == "restore":
-        hashbak.entrypoints.full_restore(
-            name=args.snapshot,
-            root=args.dest_dir,
-            hash_salt=bytes.fromhex(args.salt_hex),
-            storage=hashbak.remote.EncryptedS3Storage(
-                aes_key=bytes.fromhex(args.key_hex),
-                bucket=args.s3_bucket,
+        storage = remote_storage(
+            args,
+            aes_key=bytes.fromhex(args.key_hex),
+            # Sizes the connection pool too
+            upload_concurrency=args.restore_workers + args.thaw_workers,
+        )
+        with hashbak.hashcache.HashCache(args.hash_cache) as cache, \
+                hashbak.thaw.ThawPlanner(storage, args.thaw_state, args.thaw_workers, args.thaw_rate, args.thaw_min_poll) as thaw:
+            hashbak.entrypoints.full_restore(
+                name=args.snapshot,
+                root=args.dest_dir,
+                hash_salt=bytes.fromhex(args.salt_hex),
+                storage=storage,
+                cache=cache,
+                workers=args.restore_workers,
+                memory_budget=args.restore_memory_mb * (1024**2),
+                thaw=thaw,
+                path_filter=hashbak.snapshot.PathFilter(args.path, args.include, args.exclude),
             )
+
+    elif args.cmd == "report":
+        hashbak.entrypoints.show_report(
+            name=args.snapshot,
+            storage=remote_storage(args, aes_key=bytes.fromhex(args.key_hex)),
         )
 
     elif args.cmd == "list":
         hashbak.entrypoints.list_snapshots(
-            storage=hashbak.remote.EncryptedS3Storage(
-                aes_key=b'',
-                bucket=args.s3_bucket,
-            )
+            storage=remote_storage(args, aes_key=b''),
         )
 
     elif args.cmd == "show":
         hashbak.entrypoints.show_snapshot(
             name=args.snapshot,
-            storage=hashbak.remote.EncryptedS3Storage(
-                aes_key=bytes.fromhex(args.key_hex),
-                bucket=args.s3_bucket,
+            storage=remote_storage(args, aes_key=bytes.fromhex(args.key_hex)),
+            path=args.path,
+        )
+
+    elif args.cmd == "cat":
+        hashbak.entrypoints.cat_file(
+            name=args.snapshot,
+            path=args.path,
+            storage=remote_storage(args, aes_key=bytes.fromhex(args.key_hex)),
+            out=sys.stdout.buffer,
+            start=args.offset,
+            length=args.length,
+        )
+
+    elif args.cmd == "catalog":
+        with hashbak.catalog.Catalog(args.catalog) as catalog:
+            if args.action == 'sync':
+                if not args.key_hex:
+                    raise SystemExit('catalog sync needs --key-hex')
+                hashbak.entrypoints.catalog_sync(
+                    storage=remote_storage(args, aes_key=bytes.fromhex(args.key_hex)),
+                    catalog=catalog,
+                )
+            hashbak.entrypoints.catalog_stats(catalog)
+
+    elif args.cmd == "gc":
+        with (hashbak.catalog.Catalog(args.catalog) if args.catalog else contextlib.nullcontext()) as catalog:
+            hashbak.entrypoints.collect_garbage(
+                storage=remote_storage(args, aes_key=bytes.fromhex(args.key_hex)),
+                catalog=catalog,
+                max_exact=args.max_exact,
+                grace=args.grace_hours * 3600,
+                early_delete=args.early_delete,
+                delete=args.delete,
+                output=args.output,
             )
+
+    elif args.cmd == "verify":
+        if args.deep and not args.salt_hex:
+            raise SystemExit('verify --deep needs --salt-hex')
+        ok = hashbak.entrypoints.verify(
+            storage=remote_storage(
+                args,
+                aes_key=bytes.fromhex(args.key_hex),
+                upload_concurrency=args.workers,
+            ),
+            names=args.snapshot,
+            hash_salt=bytes.fromhex(args.salt_hex) if args.salt_hex else None,
+            deep=args.deep,
+            sample=args.sample,
+            workers=args.workers,
+            rate=args.rate,
+            output=args.output,
+        )
+        if not ok:
+            raise SystemExit(1)
+
+    elif args.cmd == "bench":
+        report = hashbak.bench.run(
+            work_dir=args.work_dir,
+            stream_size=args.stream_mb * (1024**2),
+            serial_count=args.serial_count,
+            small_files=args.small_files,
+            small_size=args.small_size_kb * 1024,
+            large_files=args.large_files,
+            large_size=args.large_size_mb * (1024**2),
+            codec=hashbak.codec.by_name(args.codec),
+            hash_workers=args.hash_workers,
+            restore_workers=args.restore_workers,
+            stages=set(args.stages),
+            seed=args.seed,
         )
+        baseline = None
+        if args.compare:
+            with open(args.compare) as in_f:
+                baseline = json.load(in_f)
+        hashbak.bench.print_report(report, baseline)
+        if args.output:
+            hashbak.bench.save(report, args.output)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,172 @@
+import gzip as _gzip
+import os
+import threading
+import typing
+import zlib
+
+
+class Codec:
+    # One byte, written into the stream header so the reader knows how to undo it
+    id: bytes = b''
+    name: str = ''
+
+    # How many hashbak.stream pages go into each compressed frame
+    pages_per_frame: int = 1
+
+    def compress(self, data: bytes) -> bytes:
+        raise NotImplementedError('stub!')
+
+    def decompress(self, data: bytes) -> bytes:
+        raise NotImplementedError('stub!')
+
+    def select(self, sample: bytes, fname: typing.Optional[str] = None) -> 'Codec':
+        # Chance to pick a different codec per stream, based on the start of the contents
+        return self
+
+
+class StoredCodec(Codec):
+    # No compression at all, for contents that are already compressed
+    id = b's'
+    name = 'stored'
+
+    def compress(self, data: bytes) -> bytes:
+        return data
+
+    def decompress(self, data: bytes) -> bytes:
+        return data
+
+
+class GzipCodec(Codec):
+    id = b'g'
+    name = 'gzip'
+
+    def __init__(self, level: int = 9):
+        self.level = level
+
+    def compress(self, data: bytes) -> bytes:
+        return _gzip.compress(data, compresslevel=self.level)
+
+    def decompress(self, data: bytes) -> bytes:
+        return _gzip.decompress(data)
+
+
+class ZstdCodec(Codec):
+    id = b'z'
+    name = 'zstd'
+
+    def __init__(self, level: int = 3, threads: int = 0):
+        # Optional dependency, only needed if you actually ask for zstd (or read something written with it)
+        try:
+            import zstandard
+        except ImportError as e:
+            raise RuntimeError('zstd codec needs the "zstandard" package (pip install zstandard)') from e
+        self.zstandard = zstandard
+        self.level = level
+        self.threads = threads
+        # zstd only splits work across threads within one frame, so give it bigger frames to split
+        self.pages_per_frame = max(threads, 1)
+        # (de)compressor objects aren't thread safe, keep one per thread
+        self.local = threading.local()
+
+    def _compressor(self):
+        if not hasattr(self.local, 'cctx'):
+            self.local.cctx = self.zstandard.ZstdCompressor(level=self.level, threads=self.threads)
+        return self.local.cctx
+
+    def _decompressor(self):
+        if not hasattr(self.local, 'dctx'):
+            self.local.dctx = self.zstandard.ZstdDecompressor()
+        return self.local.dctx
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor().compress(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        return self._decompressor().decompress(data)
+
+
+# Media and archives: compressing these again just burns CPU
+STORED_EXTENSIONS = {
+    '.mkv', '.mp4', '.m4v', '.avi', '.webm', '.mov', '.wmv', '.flv', '.ts',
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.avif',
+    '.mp3', '.m4a', '.aac', '.flac', '.ogg', '.opus',
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.zst', '.7z', '.rar', '.cbz', '.cbr', '.epub', '.jar', '.docx', '.xlsx',
+}
+
+STORED_MAGIC = [
+    b'\x1a\x45\xdf\xa3',  # matroska / webm
+    b'\xff\xd8\xff',  # jpeg
+    b'\x89PNG',
+    b'GIF8',
+    b'PK\x03\x04',  # zip and everything built on it
+    b'\x1f\x8b',  # gzip
+    b'BZh',
+    b'\xfd7zXZ\x00',
+    b'\x28\xb5\x2f\xfd',  # zstd
+    b"7z\xbc\xaf'\x1c",
+    b'Rar!',
+    b'fLaC',
+    b'OggS',
+    b'ID3',  # mp3
+]
+
+# Trial-compress this much of the start of a stream, and store it if that doesn't save at least a few percent
+SAMPLE_SIZE = 64 * 1024
+SAMPLE_RATIO = 0.95
+
+
+def looks_compressed(sample: bytes, fname: typing.Optional[str] = None) -> bool:
+    if fname is not None and os.path.splitext(fname)[1].lower() in STORED_EXTENSIONS:
+        return True
+    if any(sample.startswith(magic) for magic in STORED_MAGIC):
+        return True
+    # mp4 / mov / heic: size, then "ftyp". riff: "RIFF", size, then the format
+    if sample[4:8] == b'ftyp' or (sample[:4] == b'RIFF' and sample[8:12] in {b'WEBP', b'AVI '}):
+        return True
+    sample = sample[:SAMPLE_SIZE]
+    if len(sample) < 1024:
+        # Not worth guessing about, and the overhead of compressing something tiny doesn't matter
+        return False
+    return len(zlib.compress(sample, 1)) > len(sample) * SAMPLE_RATIO
+
+
+class AdaptiveCodec(Codec):
+    """
+    Wraps another codec, but switches to StoredCodec for anything that looks like it won't compress
+
+    Never appears in a stream header itself: select() always hands back the inner codec or StoredCodec.
+    """
+
+    def __init__(self, inner: Codec):
+        self.inner = inner
+        self.pages_per_frame = inner.pages_per_frame
+
+    def select(self, sample: bytes, fname: typing.Optional[str] = None) -> Codec:
+        if looks_compressed(sample, fname):
+            return StoredCodec()
+        return self.inner.select(sample, fname)
+
+
+CODECS: typing.Dict[bytes, typing.Type[Codec]] = {
+    StoredCodec.id: StoredCodec,
+    GzipCodec.id: GzipCodec,
+    ZstdCodec.id: ZstdCodec,
+}
+
+
+def by_id(codec_id: bytes) -> Codec:
+    # Decompression doesn't care about level / threads, so default settings are fine here
+    if codec_id not in CODECS:
+        raise ValueError(f'Unknown codec id {codec_id!r}')
+    return CODECS[codec_id]()
+
+
+def by_name(name: str, level: typing.Optional[int] = None, threads: int = 0) -> Codec:
+    if name == StoredCodec.name:
+        return StoredCodec()
+    elif name == GzipCodec.name:
+        return GzipCodec() if level is None else GzipCodec(level)
+    elif name == ZstdCodec.name:
+        return ZstdCodec(threads=threads) if level is None else ZstdCodec(level, threads)
+    else:
+        raise ValueError(f'Unknown codec {name}')
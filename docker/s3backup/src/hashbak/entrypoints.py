@@ -1,73 +1,274 @@
+import concurrent.futures
+import dataclasses
 import datetime
-import io
+import json
 import logging
 import os
+import sys
+import time
 import typing
 
+import hashbak.catalog
+import hashbak.chunker
 import hashbak.fmeta
+import hashbak.garbage
+import hashbak.hashcache
+import hashbak.hasher
+import hashbak.metrics
+import hashbak.pack
+import hashbak.parallel
 import hashbak.remote
+import hashbak.restorer
+import hashbak.snapshot
 import hashbak.stream
+import hashbak.thaw
+import hashbak.uploader
+import hashbak.verify
 
 
 logger = logging.getLogger(__name__)
 
 
-def backup(root: str, hash_salt: bytes, storage: hashbak.remote.RemoteStorage):
+def walk(root: str) -> typing.Iterable[str]:
+    it = os.walk(root)
+    while True:
+        # Timed one directory at a time, so the time spent by whoever's consuming this doesn't count
+        start, cpu = time.perf_counter(), time.thread_time()
+        try:
+            path, fdirs, files = next(it)
+        except StopIteration:
+            return
+        hashbak.metrics.record('walk', time.perf_counter() - start, items=len(fdirs) + len(files), cpu=time.thread_time() - cpu)
+        for fdir in fdirs:
+            yield os.path.join(path, fdir)
+        for file in files:
+            yield os.path.join(path, file)
+
+
+def _lstat_all(fpaths: typing.Iterable[str]) -> typing.Iterable[typing.Tuple[str, os.stat_result]]:
+    for fpath in fpaths:
+        yield fpath, os.lstat(fpath)
+
+
+def backup(
+        root: str,
+        hash_salt: bytes,
+        storage: hashbak.remote.RemoteStorage,
+        cache: typing.Optional[hashbak.hashcache.HashCache] = None,
+        hash_workers: int = 1,
+        hash_pool: str = 'thread',
+        chunker: typing.Optional[hashbak.chunker.Chunker] = None,
+        incremental: bool = False,
+        spool_dir: typing.Optional[str] = None,
+        spool_limit: int = 4 * (1024**3),
+        upload_workers: int = 1,
+        walk_ahead: int = 10_000,
+) -> hashbak.snapshot.SnapshotDiff:
+    """
+    Runs as a pipeline, each stage with its own concurrency and a bound on how far it can get ahead of the next:
+    walk + lstat (own thread, up to walk_ahead paths) -> hash (hash_workers) -> dedup check -> upload (upload_workers)
+    -> snapshot writer, which gets files in walk order whatever order the uploads finish in.
+
+    spool_dir: single-pass mode, new files get read once (see Hasher) instead of once to hash + once to upload
+    """
     name = datetime.datetime.now().strftime('%Y-%m-%d-%H-%M')
+    started = time.time()
+    root = os.path.abspath(root)
+    if cache is None:
+        cache = hashbak.hashcache.HashCache()
 
-    def iter_files() -> typing.Iterable[hashbak.fmeta.FMeta]:
-        for path, fdirs, files in os.walk(root):
-            for fdir in fdirs:
-                fpath = os.path.join(path, fdir)
-                yield hashbak.fmeta.FMeta.from_file(fpath, hash_salt, root)
-            for file in files:
-                fpath = os.path.join(path, file)
-                meta = hashbak.fmeta.FMeta.from_file(fpath, hash_salt, root)
-                yield meta
-                if storage.file_exists(meta.fhash):
-                    logger.info(f'File {meta.fname} exists at {meta.fhash.hex()}')
-                else:
-                    logger.info(f'File {meta.fname}: backing up to {meta.fhash.hex()}')
-                    storage.upload_file(meta.fhash, hashbak.stream.file(fpath))
-
-    def serialize_meta():
-        for meta in iter_files():
-            buf = io.BytesIO()
-            meta.write(buf)
-            buf.seek(0)
-            yield buf.read()
-
-    storage.upload_meta(name, serialize_meta())
-
-
-def pre_restore(name: str, root: str, hash_salt: bytes, storage: hashbak.remote.RemoteStorage):
-    logger.info(f'Beginning un-archive from snapshot {name}')
-    metas = hashbak.fmeta.iter_meta(storage.get_meta(name))
-    hashes = []
+    previous = {}
+    if incremental:
+        prev_name = hashbak.snapshot.latest(storage)
+        if prev_name is not None:
+            logger.info(f'Diffing against snapshot {prev_name}')
+            previous = {meta.fname: meta for meta in hashbak.snapshot.iter_snapshot(storage, prev_name)}
+            # Lets the progress line give an ETA
+            hashbak.metrics.registry.set('hashbak_expected_files', len(previous))
+    diff = hashbak.snapshot.SnapshotDiff()
+    seen = set()
+    # (dev, ino) -> first FMeta for that inode
+    linked = {}
+    writer = hashbak.snapshot.SnapshotWriter()
+    # Every object the new snapshot points at, for the catalog
+    referenced = set()
+
+    def add(meta: hashbak.fmeta.FMeta) -> None:
+        writer.add(meta)
+        referenced.update(hashbak.restorer.stored_objects(meta))
+
+    def changed_paths(hasher: hashbak.hasher.Hasher) -> typing.Iterable[str]:
+        # Files that look the same as last time go straight into the new snapshot, without being read or checked
+        # against the remote. The snapshot gets sorted at the end, so skipping them here doesn't upset anything.
+        for fpath, stat in hashbak.parallel.background(_lstat_all(walk(root)), walk_ahead, 'walk'):
+            fname = os.path.abspath(fpath).removeprefix(root)
+            seen.add(fname)
+            prev = previous.get(fname)
+            if prev is not None and prev.unchanged(stat):
+                # Link count can change without the file itself changing
+                prev.dev, prev.nlink = stat.st_dev, stat.st_nlink
+                if prev.link_key is not None:
+                    linked.setdefault(prev.link_key, prev)
+                    hasher.known_inode(prev.dev, prev.ino, prev.fhash)
+                diff.carried += 1
+                hashbak.metrics.registry.inc('hashbak_files_total', result='carried')
+                add(prev)
+                continue
+            yield fpath
+
+    def iter_files(hasher: hashbak.hasher.Hasher, uploader: hashbak.uploader.Uploader) -> typing.Iterable[concurrent.futures.Future]:
+        # -> futures resolving to FMetas, in walk order
+        for meta in hasher.metas(changed_paths(hasher), root):
+            diff.record(previous.get(meta.fname), meta)
+            if meta.ftype != hashbak.fmeta.FileType.file:
+                hashbak.metrics.registry.inc('hashbak_files_total', result='other')
+                yield hashbak.parallel.resolved(meta)
+                continue
+            fpath = root + meta.fname
+            if meta.link_key in linked:
+                # Hardlink to a file that's already been backed up, gets pointed at the same objects below (which
+                # might only be known once the first name's upload is done)
+                logger.info(f'File {meta.fname} is a hardlink of {linked[meta.link_key].fname}')
+                hashbak.metrics.registry.inc('hashbak_files_total', result='hardlink')
+                yield hashbak.parallel.resolved(meta)
+                continue
+            if meta.link_key is not None:
+                linked[meta.link_key] = meta
+            yield uploader.submit(meta, fpath)
+
+    # gc --delete can't run from here until the snapshot is stored: it could sweep objects this backup dedups against
+    with hashbak.garbage.backup_lock(storage):
+        catalog = storage.catalog
+        if catalog is not None and catalog.swept != hashbak.garbage.last_sweep(storage):
+            # It could still list objects that gc has since deleted: dedup against those would point at nothing
+            logger.warning('gc --delete has run since the catalog was last synced, not using it this time (`hashbak catalog sync` brings it up to date)')
+            catalog.stale = True
+        if catalog is None or catalog.stale or not catalog.trusted:
+            storage.load_index()
+        with hashbak.hasher.Hasher(hash_salt, cache, hash_workers, hash_pool, spool_dir, spool_limit) as hasher, \
+                hashbak.uploader.Uploader(storage, hash_salt, chunker, hasher, upload_workers) as uploader:
+            # Results are in submission order, so a first name is always done by the time its hardlinks come out
+            for meta in uploader.results(iter_files(hasher, uploader)):
+                first = linked.get(meta.link_key)
+                if first is not None and first is not meta:
+                    meta.ftype, meta.chunks = first.ftype, first.chunks
+                add(meta)
+        # Nothing in the snapshot can point at a file that's still sitting in a half-full pack
+        storage.flush()
+        writer.upload(storage, name)
+    if storage.catalog is not None:
+        storage.catalog.add_refs(name, referenced)
+    for fname, prev in previous.items():
+        if fname not in seen:
+            diff.record(prev, None)
+    logger.info(f'Hash cache: {cache.hits} hits, {cache.misses} misses')
+    logger.info(f'Snapshot {name}: {diff}')
+    report = run_report(name, diff, started)
+    storage.upload_report(name, json.dumps(report, indent=2).encode('utf-8'))
+    return diff
+
+
+def run_report(name: str, diff: hashbak.snapshot.SnapshotDiff, started: float) -> dict:
+    finished = time.time()
+    metrics = hashbak.metrics.registry
+    return {
+        'snapshot': name,
+        'started': datetime.datetime.fromtimestamp(started).isoformat(),
+        'finished': datetime.datetime.fromtimestamp(finished).isoformat(),
+        'seconds': round(finished - started, 3),
+        'diff': dataclasses.asdict(diff),
+        'files': {
+            result: metrics.get('hashbak_files_total', result=result)
+            for result in ['new', 'dedup', 'carried', 'hardlink', 'other']
+        },
+        'dedup_rate': round(hashbak.metrics.dedup_rate(metrics), 4),
+        'stages': hashbak.metrics.stage_summary(metrics),
+    }
+
+
+def _restore_units(meta: hashbak.fmeta.FMeta, storage: hashbak.remote.RemoteStorage) -> typing.Set[bytes]:
+    # What has to be thawed to read this file (e.g. a whole pack, for a small packed file)
+    return {storage.restore_unit(fhash) for fhash in hashbak.restorer.stored_objects(meta)}
+
+
+def _thaw_plan(metas: [hashbak.fmeta.FMeta], storage: hashbak.remote.RemoteStorage) -> typing.Dict[bytes, typing.List[hashbak.fmeta.FMeta]]:
+    # thaw unit -> files that need it
+    waiting = {}
     for meta in metas:
-        if not meta.test(root, hash_salt):
-            logger.info(f'Attempting to un-archive {meta.fhash.hex()} ({meta.fname})')
-            storage.request_restore(meta.fhash)
-            hashes.append(meta.fhash)
+        for unit in _restore_units(meta, storage):
+            waiting.setdefault(unit, []).append(meta)
+    return waiting
 
-    for fhash in hashes:
-        storage.await_restore(fhash)
 
+def pre_restore(
+        name: str,
+        root: str,
+        hash_salt: bytes,
+        storage: hashbak.remote.RemoteStorage,
+        cache: typing.Optional[hashbak.hashcache.HashCache] = None,
+        thaw: typing.Optional[hashbak.thaw.ThawPlanner] = None,
+        path_filter: typing.Optional[hashbak.snapshot.PathFilter] = None,
+):
+    # Thaw everything a restore of this snapshot would need, and wait for it all
+    logger.info(f'Beginning un-archive from snapshot {name}')
+    root = os.path.abspath(root)
+    if thaw is None:
+        thaw = hashbak.thaw.ThawPlanner(storage)
+    metas = [meta for meta in hashbak.snapshot.iter_filtered(storage, name, path_filter) if not meta.test(root, hash_salt, cache)]
+    thaw.request(_thaw_plan(metas, storage))
+    for unit in thaw.ready():
+        logger.info(f'Un-archived {unit.hex()}')
     logger.info('Un-archiving complete')
 
 
-def restore(name: str, root: str, hash_salt: bytes, storage: hashbak.remote.RemoteStorage):
+def restore(
+        name: str,
+        root: str,
+        hash_salt: bytes,
+        storage: hashbak.remote.RemoteStorage,
+        cache: typing.Optional[hashbak.hashcache.HashCache] = None,
+        workers: int = 1,
+        memory_budget: int = 512 * (1024**2),
+        path_filter: typing.Optional[hashbak.snapshot.PathFilter] = None,
+):
+    # Assumes everything is readable already (see pre_restore). Files already on disk with the right hash get skipped.
     logger.info(f'Beginning restore from snapshot {name}')
-    metas = hashbak.fmeta.iter_meta(storage.get_meta(name))
-    root = os.path.abspath(root)
-    for meta in metas:
-        logger.info(f'Restoring file {meta.fname}')
-        meta.to_file(hash_salt, lambda: storage.get_restored_file(meta.fhash), root)
+    metas = list(hashbak.snapshot.iter_filtered(storage, name, path_filter))
+    with hashbak.restorer.Restorer(storage, root, hash_salt, cache, workers, memory_budget) as restorer:
+        for meta in restorer.prepare(metas):
+            restorer.submit(meta)
+        restorer.finish(metas)
 
 
-def full_restore(name: str, root: str, hash_salt: bytes, storage: hashbak.remote.RemoteStorage):
-    pre_restore(name, root, hash_salt, storage)
-    restore(name, root, hash_salt, storage)
+def full_restore(
+        name: str,
+        root: str,
+        hash_salt: bytes,
+        storage: hashbak.remote.RemoteStorage,
+        cache: typing.Optional[hashbak.hashcache.HashCache] = None,
+        workers: int = 1,
+        memory_budget: int = 512 * (1024**2),
+        thaw: typing.Optional[hashbak.thaw.ThawPlanner] = None,
+        path_filter: typing.Optional[hashbak.snapshot.PathFilter] = None,
+):
+    # Thaw + restore in one go: each file gets written as soon as all of its objects are readable, rather than
+    # waiting on the whole snapshot to thaw first
+    logger.info(f'Beginning restore from snapshot {name}')
+    if thaw is None:
+        thaw = hashbak.thaw.ThawPlanner(storage)
+    metas = list(hashbak.snapshot.iter_filtered(storage, name, path_filter))
+    with hashbak.restorer.Restorer(storage, root, hash_salt, cache, workers, memory_budget) as restorer:
+        todo = restorer.prepare(metas)
+        waiting = _thaw_plan(todo, storage)
+        remaining = {meta.fname: _restore_units(meta, storage) for meta in todo}
+        thaw.request(waiting)
+        for unit in thaw.ready():
+            for meta in waiting.pop(unit):
+                remaining[meta.fname].discard(unit)
+                if not remaining[meta.fname]:
+                    restorer.submit(meta)
+        restorer.finish(metas)
+    logger.info('Restore complete')
 
 
 def list_snapshots(storage: hashbak.remote.RemoteStorage):
@@ -76,7 +277,120 @@ def list_snapshots(storage: hashbak.remote.RemoteStorage):
         print(meta)
 
 
-def show_snapshot(name: str, storage: hashbak.remote.RemoteStorage):
-    metas = hashbak.fmeta.iter_meta(storage.get_meta(name))
+def catalog_sync(storage: hashbak.remote.RemoteStorage, catalog: hashbak.catalog.Catalog):
+    # Rebuild the catalog from what's actually in the bucket: file objects, packed files, and snapshot references
+    # Read first: a gc that deletes while this lists leaves the catalog out of date, not wrongly current
+    swept = hashbak.garbage.last_sweep(storage)
+    catalog.clear()
+    catalog.add_many(storage.list_objects())
+    for pack_id in storage.list_packs():
+        entries = hashbak.pack.decode_index(pack_id, storage.get_pack_index(pack_id))
+        catalog.add_many(
+            hashbak.catalog.ObjectInfo(fhash, entry.length, storage_class=storage.archive_class, pack=pack_id)
+            for fhash, entry in entries.items()
+        )
+    for name in hashbak.snapshot.complete_snapshots(storage)[0]:
+        referenced = set()
+        for meta in hashbak.snapshot.iter_snapshot(storage, name):
+            referenced.update(hashbak.restorer.stored_objects(meta))
+        catalog.add_refs(name, referenced)
+    catalog.swept = swept
+    logger.info(f'Catalog synced: {catalog.stats()}')
+
+
+def catalog_stats(catalog: hashbak.catalog.Catalog):
+    stats = catalog.stats()
+    for storage_class, entry in sorted(stats['storage'].items()):
+        print(f'{storage_class}: {entry["objects"]} objects, {entry["bytes"]} bytes')
+    print(f'Snapshots: {stats["snapshots"]}')
+    print(f'Unreferenced: {stats["unreferenced"]["objects"]} objects, {stats["unreferenced"]["bytes"]} bytes')
+
+
+def show_report(name: str, storage: hashbak.remote.RemoteStorage):
+    report = storage.get_report(name)
+    if report is None:
+        print(f'No report for snapshot {name}')
+    else:
+        print(report.decode('utf-8'))
+
+
+def show_snapshot(name: str, storage: hashbak.remote.RemoteStorage, path: typing.Optional[str] = None):
+    # With a path, only the index and the blocks covering that subtree get downloaded
+    metas = hashbak.snapshot.iter_snapshot(storage, name, path)
     for meta in metas:
         print(meta.fname)
+
+
+def cat_file(
+        name: str,
+        path: str,
+        storage: hashbak.remote.RemoteStorage,
+        out: typing.BinaryIO,
+        start: int = 0,
+        length: typing.Optional[int] = None,
+):
+    """
+    Partial restore: one file's contents, or `length` bytes of them from `start`, written to `out`
+
+    Objects stored with --cipher gcm only get the frames covering the range downloaded (see RemoteStorage.read_range).
+    CBC objects, and chunked files (chunk sizes aren't recorded), get read through from the start.
+    """
+    path = hashbak.snapshot.rooted(path)
+    meta = next((m for m in hashbak.snapshot.iter_snapshot(storage, name, path) if m.fname == path), None)
+    if meta is None or not meta.ftype.regular:
+        raise ValueError(f'No regular file {path} in snapshot {name}')
+    waiting = [unit for unit in _restore_units(meta, storage) if storage.restore_status(unit) != hashbak.remote.RestoreStatus.complete]
+    for unit in waiting:
+        storage.request_restore(unit)
+    waiting = [unit for unit in waiting if storage.restore_status(unit) != hashbak.remote.RestoreStatus.complete]
+    if waiting:
+        raise RuntimeError(f'{path} is archived: thaw requested for {len(waiting)} objects, try again once it\'s done')
+
+    length = sys.maxsize if length is None else length
+    if meta.ftype == hashbak.fmeta.FileType.chunked:
+        pages = hashbak.stream.window(
+            hashbak.stream.cat(*(storage.get_restored_file(chash) for chash in meta.chunks)), start, length,
+        )
+    else:
+        pages = storage.read_range(meta.fhash, start, length)
+    for page in pages:
+        out.write(page)
+
+
+def collect_garbage(
+        storage: hashbak.remote.RemoteStorage,
+        catalog: typing.Optional[hashbak.catalog.Catalog] = None,
+        max_exact: int = 2_000_000,
+        grace: float = 2 * 86400,
+        early_delete: bool = False,
+        delete: bool = False,
+        output: typing.Optional[str] = None,
+):
+    report = hashbak.garbage.Collector(storage, catalog, max_exact, grace, early_delete, delete).run()
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, 'w') as out_f:
+            out_f.write(text)
+    print(text)
+
+
+def verify(
+        storage: hashbak.pack.PackedStorage,
+        names: typing.Optional[typing.List[str]] = None,
+        hash_salt: typing.Optional[bytes] = None,
+        deep: bool = False,
+        sample: float = 1.0,
+        workers: int = 8,
+        rate: float = 50.0,
+        output: typing.Optional[str] = None,
+) -> bool:
+    # names: snapshots to check, all of them if not given. -> whether everything checked out.
+    names = names or sorted(storage.list_meta())
+    with hashbak.verify.Verifier(storage, hash_salt, deep, sample, workers, rate) as verifier:
+        report = verifier.run(names)
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, 'w') as out_f:
+            out_f.write(text)
+    print(text)
+    return report['ok']
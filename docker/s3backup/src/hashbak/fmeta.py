@@ -1,36 +1,55 @@
+import contextlib
 import dataclasses
 import enum
-import functools
 import hashlib
 import io
 import os
 import typing
 
+import hashbak.hashcache
 import hashbak.serial
 import hashbak.stream
 
 
-@functools.lru_cache()
-def file_hash(fname: str, salt: bytes) -> bytes:
+def file_hash(fname: str, salt: bytes, copy_to: typing.Optional[str] = None) -> bytes:
     """
     Bad: hash the file itself
         Then hash exposes... the file hash, which might get matched against a DB of known files
     Ideal: hash the encrypted contents
         But that's slow
     Practical: hash the unencrypted contents, plus a secret "salt"
+
+    copy_to: also write the contents there, in the same pass (see Hasher spooling)
     """
     acc = hashlib.sha256()
     acc.update(salt)
-    with open(fname, 'rb') as in_f:
+    with open(fname, 'rb') as in_f, (open(copy_to, 'wb') if copy_to else contextlib.nullcontext()) as out_f:
         while page := in_f.read(hashbak.stream.PAGE_SIZE):
             acc.update(page)
+            if out_f is not None:
+                out_f.write(page)
     return acc.digest()
 
 
+def cached_file_hash(fname: str, salt: bytes, cache: typing.Optional[hashbak.hashcache.HashCache] = None) -> bytes:
+    if cache is None:
+        return file_hash(fname, salt)
+    # stat before reading, so a write that lands mid-hash shows up as a changed mtime next time around
+    key = os.path.abspath(fname)
+    stat = os.stat(fname)
+    fhash = cache.get(key, stat, salt)
+    if fhash is None:
+        fhash = file_hash(fname, salt)
+        cache.put(key, stat, salt, fhash)
+    return fhash
+
+
 class FileType(hashbak.serial.Serial, enum.Enum):
     directory = enum.auto()
     file = enum.auto()
     link = enum.auto()
+    # A regular file, stored as a list of content-defined chunks instead of one object (see hashbak.chunker)
+    chunked = enum.auto()
 
     @staticmethod
     def _byte_code():
@@ -38,8 +57,13 @@ class FileType(hashbak.serial.Serial, enum.Enum):
             FileType.directory: b'd',
             FileType.file: b'f',
             FileType.link: b'l',
+            FileType.chunked: b'c',
         }
 
+    @property
+    def regular(self) -> bool:
+        return self in {FileType.file, FileType.chunked}
+
     def write(self, buf: io.BytesIO):
         self.write_bytes(self._byte_code()[self], buf)
 
@@ -69,6 +93,15 @@ class FMeta(hashbak.serial.Serial):
     gid: int
     mode: int
     # yeah, let's ignore attrs, they're dumb anyway
+    # Only for FileType.chunked: the chunk hashes, in order. fhash is still the hash of the whole file.
+    chunks: typing.Optional[typing.List[bytes]] = None
+    # Only in the block snapshot format (hashbak.snapshot), 0 when read from an old snapshot. Lets an incremental
+    # backup tell a file hasn't changed without reading it.
+    size: int = 0
+    mtime_ns: int = 0
+    # Also block format only. Regular files with nlink > 1 and the same (dev, ino) are hardlinks of each other.
+    dev: int = 0
+    nlink: int = 0
 
     _fields = [
         hashbak.serial.SerialField('fname', str),
@@ -82,17 +115,27 @@ class FMeta(hashbak.serial.Serial):
 
     def write(self, buf: io.BytesIO):
         self.write_many(FMeta._fields, buf)
+        if self.ftype == FileType.chunked:
+            self.write_int(len(self.chunks), buf)
+            for chunk in self.chunks:
+                self.write_dyn_bytes(chunk, buf)
 
     @staticmethod
     def read(buf: io.BytesIO):
-        return FMeta.read_many(FMeta._fields, buf)
+        meta = FMeta.read_many(FMeta._fields, buf)
+        if meta.ftype == FileType.chunked:
+            n = FMeta.read_int(buf)
+            meta.chunks = [FMeta.read_dyn_bytes(buf) for _ in range(n)]
+        return meta
 
     @staticmethod
-    def from_file(fpath: str, hash_salt: bytes, root: str = ''):
+    def from_file(fpath: str, hash_salt: bytes, root: str = '', cache: typing.Optional[hashbak.hashcache.HashCache] = None, fhash: typing.Optional[bytes] = None):
+        # fhash: content hash computed elsewhere (e.g. by hashbak.hasher), skips reading the file here
         fname = os.path.abspath(fpath).removeprefix(root)
         ftype = FileType.from_file(fpath)
         if ftype == FileType.file:
-            fhash = file_hash(fpath, hash_salt)
+            if fhash is None:
+                fhash = cached_file_hash(fpath, hash_salt, cache)
         elif ftype == FileType.link:
             fhash = os.readlink(fpath).removeprefix(root).encode('utf-8')
         else:
@@ -107,39 +150,73 @@ class FMeta(hashbak.serial.Serial):
             uid=stat.st_uid,
             gid=stat.st_gid,
             mode=stat.st_mode,
+            size=stat.st_size,
+            mtime_ns=stat.st_mtime_ns,
+            dev=stat.st_dev,
+            nlink=stat.st_nlink,
         )
 
-    def to_file(self, hash_salt: bytes, get_contents: typing.Callable[[], typing.Iterable[bytes]] = lambda: b'', root: str = ''):
+    @property
+    def link_key(self) -> typing.Optional[typing.Tuple[int, int]]:
+        # Same key = same inode = hardlinks. None if this isn't (known to be) hardlinked.
+        if not self.ftype.regular or self.nlink <= 1:
+            return None
+        return self.dev, self.ino
+
+    def unchanged(self, stat: os.stat_result) -> bool:
+        # Same test as the hash cache, minus ctime (which isn't in the snapshot): good enough to skip re-reading
+        return (
+            self.ftype.regular
+            and self.mtime_ns != 0
+            and (self.ino, self.size, self.mtime_ns, self.mode, self.uid, self.gid)
+            == (stat.st_ino, stat.st_size, stat.st_mtime_ns, stat.st_mode, stat.st_uid, stat.st_gid)
+        )
+
+    def to_file(
+            self,
+            hash_salt: bytes,
+            get_contents: typing.Callable[[], typing.Iterable[bytes]] = lambda: b'',
+            root: str = '',
+            cache: typing.Optional[hashbak.hashcache.HashCache] = None,
+            attrs: bool = True,
+    ):
+        # attrs=False: leave ownership / permissions for a later apply_attrs (e.g. so a read-only directory doesn't
+        # stop its contents being written)
         fpath = root + self.fname
 
-        if self.ftype == FileType.file:
-            if os.path.isfile(fpath):
-                fhash = file_hash(fpath, hash_salt)
-            else:
-                fhash = b''
-            if fhash != self.fhash:
-                contents = get_contents()
-                with open(fpath, 'wb') as out_f:
-                    for page in contents:
-                        out_f.write(page)
+        if self.ftype.regular:
+            if not self.test(root, hash_salt, cache):
+                self.write_contents(get_contents(), root)
         elif self.ftype == FileType.directory:
             os.makedirs(fpath, exist_ok=True)
         elif self.ftype == FileType.link:
             tgt = self.fhash.decode('utf-8')
-            os.symlink(tgt, fpath)
+            # Already there from an earlier (interrupted) restore
+            if not (os.path.islink(fpath) and os.readlink(fpath) == tgt):
+                os.symlink(tgt, fpath)
 
         else:
             raise NotImplementedError('!')
 
+        if attrs:
+            self.apply_attrs(root)
+
+    def write_contents(self, contents: typing.Iterable[bytes], root: str = ''):
+        with open(root + self.fname, 'wb') as out_f:
+            for page in contents:
+                out_f.write(page)
+
+    def apply_attrs(self, root: str = ''):
+        fpath = root + self.fname
         os.chown(fpath, self.uid, self.gid)
         os.chmod(fpath, self.mode)
 
-    def test(self, root: str, hash_salt: bytes) -> bool:
-        if self.ftype != FileType.file:
+    def test(self, root: str, hash_salt: bytes, cache: typing.Optional[hashbak.hashcache.HashCache] = None) -> bool:
+        if not self.ftype.regular:
             return True
         fpath = root + self.fname
         if os.path.isfile(fpath):
-            fhash = file_hash(fpath, hash_salt)
+            fhash = cached_file_hash(fpath, hash_salt, cache)
         else:
             fhash = b''
         return fhash == self.fhash
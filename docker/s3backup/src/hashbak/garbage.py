@@ -0,0 +1,248 @@
+import contextlib
+import logging
+import os
+import time
+import typing
+
+import hashbak.catalog
+import hashbak.index
+import hashbak.pack
+import hashbak.remote
+import hashbak.restorer
+import hashbak.snapshot
+
+
+logger = logging.getLogger(__name__)
+
+
+# Days an object has to stay stored before deleting it stops costing extra: delete it earlier and S3 bills the rest
+# of the window anyway, so there's nothing to save yet
+MIN_STORAGE_DAYS = {
+    'GLACIER': 90,
+    'GLACIER_IR': 90,
+    'DEEP_ARCHIVE': 180,
+    'STANDARD_IA': 30,
+    'ONEZONE_IA': 30,
+}
+
+
+# Lock names: one gc at a time, and one lock per running backup
+GC_LOCK = 'gc'
+BACKUP_LOCK = 'backup-'
+
+# Left by each gc --delete for catalogs to check against (see last_sweep). Matches neither of the above, so it never
+# blocks anything.
+SWEEP_MARKER = 'swept-'
+
+# A lock older than this is from a run that died without cleaning up. Generous: a first backup to Glacier can take days.
+LOCK_STALE = 7 * 86400
+
+
+@contextlib.contextmanager
+def lock(storage: hashbak.remote.RemoteStorage, name: str, blocked_by: str, stale: float):
+    """
+    Hold lock `name` in the bucket, failing if anyone holds a lock starting with `blocked_by` (unless it's older
+    than `stale` seconds)
+
+    Checked both before and after writing our own, so of two starting at the same moment at least one sees the
+    other (S3 listings are read-after-write consistent) -- at worst both give up, never both go ahead.
+    """
+    def check():
+        now = time.time()
+        for other, written in storage.list_locks().items():
+            if other == name or not other.startswith(blocked_by):
+                continue
+            if now - written >= stale:
+                logger.warning(f'Ignoring stale lock {other} from {time.ctime(written)}')
+                continue
+            raise RuntimeError(
+                f'Lock {other} is held (since {time.ctime(written)}): backups and gc --delete can\'t overlap. If '
+                f'nothing is actually running, delete the lock object and retry.'
+            )
+
+    check()
+    storage.put_lock(name)
+    try:
+        check()
+        yield
+    finally:
+        storage.delete_lock(name)
+
+
+def backup_lock(storage: hashbak.remote.RemoteStorage):
+    # Held by a backup from loading the index (what it dedups against) until its snapshot is stored
+    return lock(storage, BACKUP_LOCK + os.urandom(8).hex(), GC_LOCK, LOCK_STALE)
+
+
+def last_sweep(storage: hashbak.remote.RemoteStorage) -> typing.Optional[str]:
+    # Which gc --delete ran last, None if none ever has. A catalog that saw a different one can claim deleted objects.
+    return ','.join(sorted(name for name in storage.list_locks() if name.startswith(SWEEP_MARKER))) or None
+
+
+def new_sweep(storage: hashbak.remote.RemoteStorage) -> str:
+    # Written before anything gets deleted, so even a gc that dies partway leaves every catalog out of date
+    old = [name for name in storage.list_locks() if name.startswith(SWEEP_MARKER)]
+    marker = SWEEP_MARKER + os.urandom(8).hex()
+    storage.put_lock(marker)
+    for name in old:
+        storage.delete_lock(name)
+    return marker
+
+
+def _tally() -> typing.Dict[str, int]:
+    return {'objects': 0, 'bytes': 0}
+
+
+def _count(tally: typing.Dict[str, int], size: int) -> None:
+    tally['objects'] += 1
+    tally['bytes'] += size
+
+
+class Collector:
+    """
+    Mark and sweep over the bucket: everything the retained snapshots point at is live, anything else can go
+
+    Mark streams every snapshot (the retained ones are simply the ones still there) into a HashIndex -- exact up to
+    max_exact hashes, a bloom filter past that, so memory stays bounded whatever the bucket size. A false positive
+    only means some garbage survives until a later run; nothing live can look dead. Sweep then streams the file
+    listing and deletes in DELETE_BATCH batches. Packs only go once every file in them is dead; partly dead packs
+    just get reported, as repacking would mean thawing them.
+
+    Objects younger than `grace` are never touched (they could be from a backup that's still running, whose snapshot
+    doesn't exist yet), and archived ones are kept until their class's minimum storage duration is up unless
+    early_delete is set. Old objects are a different problem: a running backup may already have decided to dedup
+    against one that no snapshot references. So a deleting run holds GC_LOCK throughout and refuses to start while
+    any backup holds its lock, and backups refuse to start while gc holds it.
+    """
+
+    def __init__(
+            self,
+            storage: hashbak.remote.RemoteStorage,
+            catalog: typing.Optional[hashbak.catalog.Catalog] = None,
+            max_exact: int = 2_000_000,
+            grace: float = 2 * 86400,
+            early_delete: bool = False,
+            delete: bool = False,
+    ):
+        self.storage = storage
+        self.catalog = catalog
+        self.referenced = hashbak.index.HashIndex(max_exact)
+        self.grace = grace
+        self.early_delete = early_delete
+        self.delete = delete
+        self.now = time.time()
+        self.snapshots: typing.List[str] = []
+        self.report = {
+            'deleting': delete,
+            'snapshots': 0,
+            'referenced': 0,
+            'exact': True,
+            'objects': {key: _tally() for key in ['scanned', 'live', 'dead', 'too_recent', 'min_storage']},
+            'packs': {key: _tally() for key in ['scanned', 'live', 'dead', 'too_recent', 'min_storage', 'partial']},
+            # Dead files inside partly dead packs: only reclaimable by repacking
+            'dead_in_partial_packs': _tally(),
+        }
+
+    def mark(self) -> None:
+        # Half-written snapshots can't be read, so they can't keep anything alive either
+        self.snapshots, incomplete = hashbak.snapshot.complete_snapshots(self.storage)
+        self.report['incomplete_snapshots'] = incomplete
+        for name in self.snapshots:
+            logger.info(f'Marking objects referenced by snapshot {name}')
+            for meta in hashbak.snapshot.iter_snapshot(self.storage, name):
+                for fhash in hashbak.restorer.stored_objects(meta):
+                    self.referenced.add(fhash)
+        self.report['snapshots'] = len(self.snapshots)
+        self.report['referenced'] = len(self.referenced)
+        self.report['exact'] = self.referenced.exact
+        logger.info(f'{len(self.referenced)} references from {len(self.snapshots)} snapshots (exact: {self.referenced.exact})')
+
+    def _keep(self, info: hashbak.catalog.ObjectInfo, tallies: typing.Dict[str, typing.Dict[str, int]]) -> bool:
+        # For a dead object: whether it has to stay anyway, for now
+        age = self.now - info.uploaded
+        if age < self.grace:
+            _count(tallies['too_recent'], info.size)
+            return True
+        if not self.early_delete and age < MIN_STORAGE_DAYS.get(info.storage_class, 0) * 86400:
+            _count(tallies['min_storage'], info.size)
+            return True
+        _count(tallies['dead'], info.size)
+        return False
+
+    def _delete_objects(self, fhashes: [bytes]) -> None:
+        if self.delete and fhashes:
+            logger.info(f'Deleting {len(fhashes)} objects')
+            self.storage.delete_objects(fhashes)
+            if self.catalog is not None:
+                self.catalog.discard(fhashes)
+
+    def _delete_packs(self, pack_ids: [str]) -> None:
+        if self.delete and pack_ids:
+            logger.info(f'Deleting {len(pack_ids)} packs')
+            self.storage.delete_packs(pack_ids)
+            if self.catalog is not None:
+                self.catalog.discard_packs(pack_ids)
+
+    def sweep_objects(self) -> None:
+        tallies = self.report['objects']
+        batch = []
+        for info in self.storage.list_objects():
+            _count(tallies['scanned'], info.size)
+            if info.fhash in self.referenced:
+                _count(tallies['live'], info.size)
+                continue
+            if self._keep(info, tallies):
+                continue
+            batch.append(info.fhash)
+            if len(batch) >= hashbak.remote.DELETE_BATCH:
+                self._delete_objects(batch)
+                batch = []
+        self._delete_objects(batch)
+
+    def sweep_packs(self) -> None:
+        tallies = self.report['packs']
+        indexed = set(self.storage.list_packs())
+        batch = []
+        for info in self.storage.list_pack_objects():
+            _count(tallies['scanned'], info.size)
+            # No index: an upload that got interrupted between the pack and its index, nothing can point into it
+            entries = {}
+            if info.pack in indexed:
+                entries = hashbak.pack.decode_index(info.pack, self.storage.get_pack_index(info.pack))
+            dead = [entry for fhash, entry in entries.items() if fhash not in self.referenced]
+            if len(dead) < len(entries):
+                if dead:
+                    _count(tallies['partial'], info.size)
+                    for entry in dead:
+                        _count(self.report['dead_in_partial_packs'], entry.length)
+                else:
+                    _count(tallies['live'], info.size)
+                continue
+            if self._keep(info, tallies):
+                continue
+            batch.append(info.pack)
+            if len(batch) >= hashbak.remote.DELETE_BATCH:
+                self._delete_packs(batch)
+                batch = []
+        self._delete_packs(batch)
+
+    def run(self) -> dict:
+        # A dry run deletes nothing, so it can't race anything
+        with lock(self.storage, GC_LOCK, BACKUP_LOCK, LOCK_STALE) if self.delete else contextlib.nullcontext():
+            self.mark()
+            if not self.snapshots:
+                # Far more likely a wrong bucket / prefix than a backup that really wants everything gone
+                raise RuntimeError('No snapshots found, refusing to collect garbage')
+            if self.delete:
+                # Deletes get applied to the catalog as they go, but that only makes it current if it was before
+                current = self.catalog is not None and self.catalog.swept == last_sweep(self.storage)
+                swept = new_sweep(self.storage)
+            self.sweep_objects()
+            self.sweep_packs()
+            if self.delete and self.catalog is not None:
+                self.catalog.keep_snapshots(self.snapshots)
+                if current:
+                    self.catalog.swept = swept
+                else:
+                    logger.warning('The catalog was already missing an earlier gc --delete, run `hashbak catalog sync`')
+        return self.report
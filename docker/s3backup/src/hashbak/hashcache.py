@@ -0,0 +1,113 @@
+import hashlib
+import os
+import sqlite3
+import time
+import typing
+
+
+# Don't trust a stat tuple if the file was touched this recently -- mtime granularity means a write in the same
+# tick as our read would go unnoticed (same trick git uses for "racy" index entries)
+RACY_SECONDS = 2
+
+# Rows that haven't been seen by any run in this long get dropped on compaction
+DEFAULT_MAX_AGE = 30 * 24 * 60 * 60
+
+COMMIT_EVERY = 1000
+
+
+def salt_id(salt: bytes) -> bytes:
+    # Never store the salt itself, just something to tell salts apart
+    acc = hashlib.sha256()
+    acc.update(b'hashbak-salt-id')
+    acc.update(salt)
+    return acc.digest()[:8]
+
+
+class HashCache:
+    """
+    Persistent map of (path, inode, size, mtime_ns, ctime_ns, salt) -> file hash
+
+    If a file's stat tuple matches what we saw when we last hashed it, assume the contents haven't changed either.
+    Use ':memory:' for a cache that only lives as long as the process.
+    """
+
+    def __init__(self, path: str = ':memory:', rehash: bool = False):
+        self.path = path
+        self.rehash = rehash
+        self.now = int(time.time())
+        self.pending = 0
+        self.hits = 0
+        self.misses = 0
+
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS hashes (
+                path TEXT NOT NULL,
+                salt_id BLOB NOT NULL,
+                ino INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                ctime_ns INTEGER NOT NULL,
+                fhash BLOB NOT NULL,
+                seen INTEGER NOT NULL,
+                PRIMARY KEY (path, salt_id)
+            )
+        ''')
+        self.db.commit()
+
+    def __enter__(self) -> 'HashCache':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def get(self, fpath: str, stat: os.stat_result, salt: bytes) -> typing.Optional[bytes]:
+        if self.rehash:
+            self.misses += 1
+            return None
+        row = self.db.execute(
+            'SELECT ino, size, mtime_ns, ctime_ns, fhash, seen FROM hashes WHERE path = ? AND salt_id = ?',
+            (fpath, salt_id(salt)),
+        ).fetchone()
+        if row is None or row[:4] != (stat.st_ino, stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        # Only bump "seen" once a day or so, so that a fully-cached run is (nearly) read-only
+        if row[5] < self.now - 24 * 60 * 60:
+            self.db.execute(
+                'UPDATE hashes SET seen = ? WHERE path = ? AND salt_id = ?',
+                (self.now, fpath, salt_id(salt)),
+            )
+            self._tick()
+        return row[4]
+
+    def put(self, fpath: str, stat: os.stat_result, salt: bytes, fhash: bytes) -> None:
+        if max(stat.st_mtime_ns, stat.st_ctime_ns) > (time.time() - RACY_SECONDS) * 1e9:
+            return
+        self.db.execute(
+            'INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (fpath, salt_id(salt), stat.st_ino, stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns, fhash, self.now),
+        )
+        self._tick()
+
+    def _tick(self):
+        self.pending += 1
+        if self.pending >= COMMIT_EVERY:
+            self.db.commit()
+            self.pending = 0
+
+    def compact(self, max_age: int = DEFAULT_MAX_AGE) -> int:
+        cur = self.db.execute('DELETE FROM hashes WHERE seen < ?', (self.now - max_age,))
+        self.db.commit()
+        self.pending = 0
+        if self.path != ':memory:':
+            self.db.execute('VACUUM')
+        return cur.rowcount
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
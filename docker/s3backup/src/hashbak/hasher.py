@@ -0,0 +1,135 @@
+import concurrent.futures
+import os
+import time
+import typing
+
+import hashbak.fmeta
+import hashbak.hashcache
+import hashbak.metrics
+import hashbak.parallel
+
+
+def _hash_job(fpath: str, stat: os.stat_result, salt: bytes, spool: typing.Optional[str] = None) -> (str, os.stat_result, bytes, (float, float)):
+    # Module-level so it can be pickled over to a process pool. Timed here (wall, CPU) since a worker process can't
+    # record metrics.
+    start, cpu = time.perf_counter(), time.thread_time()
+    fhash = hashbak.fmeta.file_hash(fpath, salt, spool)
+    return fpath, stat, fhash, (time.perf_counter() - start, time.thread_time() - cpu)
+
+
+class Hasher:
+    """
+    Turns a stream of paths into a stream of FMeta, hashing up to `workers` files at a time
+
+    Output order always matches input order. Cache lookups and writes stay on the calling thread (sqlite doesn't
+    like being shared), only the actual reading + hashing is farmed out. Hardlinked files only get read once.
+
+    With a spool_dir, files that get hashed are copied there in the same read, so uploading them doesn't mean reading
+    them off the NAS a second time (and what gets uploaded is exactly what got hashed). Spooled bytes are capped at
+    spool_limit -- anything that doesn't fit right then just doesn't get spooled. Whoever consumes metas() has to
+    call release() for each file once done with spooled().
+    """
+
+    def __init__(
+            self,
+            hash_salt: bytes,
+            cache: typing.Optional[hashbak.hashcache.HashCache] = None,
+            workers: int = 1,
+            pool: str = 'thread',
+            spool_dir: typing.Optional[str] = None,
+            spool_limit: int = 4 * (1024**3),
+    ):
+        self.hash_salt = hash_salt
+        self.cache = cache
+        self.executor = hashbak.parallel.make_executor(workers, pool)
+        # Each in-flight job holds at most a page of file data, so this is what bounds memory
+        self.window = max(workers, 1) * 4
+        # (dev, ino) -> hash, for files with more than one name
+        self.inodes: typing.Dict[typing.Tuple[int, int], typing.Optional[bytes]] = {}
+        self.spool_dir = spool_dir
+        self.spool_budget = hashbak.parallel.ByteBudget(spool_limit)
+        # fpath -> (spool path, bytes reserved)
+        self.spools: typing.Dict[str, typing.Tuple[str, int]] = {}
+
+    def __enter__(self) -> 'Hasher':
+        if self.spool_dir is not None:
+            os.makedirs(self.spool_dir, exist_ok=True)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+        for fpath in list(self.spools):
+            self.release(fpath)
+
+    def _spool_for(self, fpath: str, stat: os.stat_result) -> typing.Optional[str]:
+        # Can't block waiting for room: what holds the budget only gets released downstream, on this same thread
+        if self.spool_dir is None or not self.spool_budget.try_acquire(stat.st_size):
+            return None
+        spool = os.path.join(self.spool_dir, os.urandom(8).hex())
+        self.spools[os.path.abspath(fpath)] = (spool, stat.st_size)
+        return spool
+
+    def spooled(self, fpath: str) -> typing.Optional[str]:
+        # Local copy of fpath's contents, if it got spooled
+        entry = self.spools.get(os.path.abspath(fpath))
+        return entry[0] if entry is not None else None
+
+    def release(self, fpath: str) -> None:
+        entry = self.spools.pop(os.path.abspath(fpath), None)
+        if entry is None:
+            return
+        spool, reserved = entry
+        if os.path.exists(spool):
+            os.remove(spool)
+        self.spool_budget.release(reserved)
+
+    def known_inode(self, dev: int, ino: int, fhash: bytes) -> None:
+        # Hash of a hardlinked inode found some other way (e.g. carried over from the last snapshot)
+        self.inodes[(dev, ino)] = fhash
+
+    def _submit(self, fpath: str, root: str) -> concurrent.futures.Future:
+        # Resolves to either a finished FMeta, or (fpath, stat, fhash, (wall, CPU) seconds spent hashing) for a regular
+        # file. None for the timing means it wasn't freshly hashed.
+        hashbak.metrics.registry.add('hashbak_queue_depth', 1, queue='hash')
+        if hashbak.fmeta.FileType.from_file(fpath) != hashbak.fmeta.FileType.file:
+            return hashbak.parallel.resolved(hashbak.fmeta.FMeta.from_file(fpath, self.hash_salt, root))
+
+        stat = os.stat(fpath)
+        if stat.st_nlink > 1:
+            key = (stat.st_dev, stat.st_ino)
+            if key in self.inodes:
+                # Another name for an inode that's already been (or is being) hashed -- picked up in metas()
+                return hashbak.parallel.resolved((fpath, stat, None, None))
+            self.inodes[key] = None
+
+        if self.cache is not None:
+            fhash = self.cache.get(os.path.abspath(fpath), stat, self.hash_salt)
+            if fhash is not None:
+                return hashbak.parallel.resolved((fpath, stat, fhash, None))
+
+        spool = self._spool_for(fpath, stat)
+        if self.executor is None:
+            return hashbak.parallel.resolved(_hash_job(fpath, stat, self.hash_salt, spool))
+        return self.executor.submit(_hash_job, fpath, stat, self.hash_salt, spool)
+
+    def metas(self, fpaths: typing.Iterable[str], root: str = '') -> typing.Iterable[hashbak.fmeta.FMeta]:
+        futures = (self._submit(fpath, root) for fpath in fpaths)
+        for res in hashbak.parallel.ordered(futures, self.window):
+            hashbak.metrics.registry.add('hashbak_queue_depth', -1, queue='hash')
+            if isinstance(res, hashbak.fmeta.FMeta):
+                yield res
+                continue
+            fpath, stat, fhash, timing = res
+            fresh = timing is not None
+            if fresh:
+                hashbak.metrics.record('hash', timing[0], stat.st_size, cpu=timing[1])
+            if stat.st_nlink > 1:
+                key = (stat.st_dev, stat.st_ino)
+                # Results come back in input order, so the first name for an inode always lands before the others
+                if fhash is None:
+                    fhash = self.inodes[key]
+                self.inodes[key] = fhash
+            if fresh and self.cache is not None:
+                self.cache.put(os.path.abspath(fpath), stat, self.hash_salt, fhash)
+            yield hashbak.fmeta.FMeta.from_file(fpath, self.hash_salt, root, fhash=fhash)
@@ -0,0 +1,77 @@
+import hashlib
+import math
+import typing
+
+
+class BloomFilter:
+    def __init__(self, capacity: int, error_rate: float = 0.001):
+        self.capacity = capacity
+        self.count = 0
+        self.nbits = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.nhashes = max(1, round(self.nbits / capacity * math.log(2)))
+        self.bits = bytearray((self.nbits + 7) // 8)
+
+    def _positions(self, key: bytes) -> typing.Iterable[int]:
+        # Double hashing: k positions out of two 64 bit hashes
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        for i in range(self.nhashes):
+            yield (h1 + i * h2) % self.nbits
+
+    def add(self, key: bytes) -> None:
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key: bytes) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+    @property
+    def full(self) -> bool:
+        return self.count >= self.capacity
+
+
+class HashIndex:
+    """
+    Set of hashes, exact up to max_exact entries and a (growing) bloom filter after that
+
+    Once it's a bloom filter, "not in" is still definitive, but "in" is only a maybe -- check `exact` before
+    trusting a hit.
+    """
+
+    def __init__(self, max_exact: int = 2_000_000, error_rate: float = 0.001):
+        self.max_exact = max_exact
+        self.error_rate = error_rate
+        self.keys = set()
+        self.blooms = []
+
+    @property
+    def exact(self) -> bool:
+        return not self.blooms
+
+    def __len__(self) -> int:
+        return len(self.keys) + sum(bloom.count for bloom in self.blooms)
+
+    def add(self, key: bytes) -> None:
+        if self.exact:
+            self.keys.add(key)
+            if len(self.keys) > self.max_exact:
+                self._to_bloom()
+            return
+        if self.blooms[-1].full:
+            # Scalable bloom filter: each new layer doubles capacity and halves error rate, so the total stays bounded
+            layer = len(self.blooms)
+            self.blooms.append(BloomFilter(self.max_exact * 2 ** (layer + 1), self.error_rate / 2 ** (layer + 1)))
+        self.blooms[-1].add(key)
+
+    def _to_bloom(self):
+        self.blooms.append(BloomFilter(self.max_exact * 2, self.error_rate / 2))
+        for key in self.keys:
+            self.blooms[-1].add(key)
+        self.keys = set()
+
+    def __contains__(self, key: bytes) -> bool:
+        if self.exact:
+            return key in self.keys
+        return any(key in bloom for bloom in self.blooms)
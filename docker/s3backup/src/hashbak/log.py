@@ -1,9 +1,10 @@
 import logging
 import sys
+import typing
 
 
-def setup_logs():
-    handler = logging.StreamHandler(sys.stdout)
+def setup_logs(stream: typing.TextIO = sys.stdout):
+    handler = logging.StreamHandler(stream)
     fmt = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     handler.setFormatter(fmt)
 
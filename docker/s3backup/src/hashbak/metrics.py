@@ -0,0 +1,268 @@
+import bisect
+import http.server
+import logging
+import os
+import threading
+import time
+import typing
+
+
+logger = logging.getLogger(__name__)
+
+
+# Pipeline stages, in order. Each records time spent + bytes in / out as work goes through it. 'read' is reading file
+# contents to upload them (reads for hashing are part of 'hash').
+STAGES = ['walk', 'hash', 'read', 'compress', 'encrypt', 'upload']
+
+DURATION_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0]
+
+Labels = typing.Tuple[typing.Tuple[str, str], ...]
+
+
+class Histogram:
+    def __init__(self, buckets: [float]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """
+    Counters, gauges and histograms for one process, rendered in the Prometheus text format
+
+    Deliberately tiny: hashbak is a batch job, so everything just accumulates over the run and gets scraped (or
+    written to a textfile-collector file) as is.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters: typing.Dict[str, typing.Dict[Labels, float]] = {}
+        self.gauges: typing.Dict[str, typing.Dict[Labels, float]] = {}
+        self.histograms: typing.Dict[str, typing.Dict[Labels, Histogram]] = {}
+        self.started = time.time()
+
+    @staticmethod
+    def _labels(labels: typing.Dict[str, str]) -> Labels:
+        return tuple(sorted(labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = self._labels(labels)
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels) -> None:
+        with self.lock:
+            self.gauges.setdefault(name, {})[self._labels(labels)] = value
+
+    def add(self, name: str, value: float, **labels) -> None:
+        # Gauge that goes up and down, e.g. items in flight
+        key = self._labels(labels)
+        with self.lock:
+            series = self.gauges.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = self._labels(labels)
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram(DURATION_BUCKETS)
+            series[key].observe(value)
+
+    def get(self, name: str, **labels) -> float:
+        key = self._labels(labels)
+        with self.lock:
+            for kind in (self.counters, self.gauges):
+                if name in kind:
+                    return kind[name].get(key, 0)
+        return 0
+
+    def reset(self) -> None:
+        with self.lock:
+            self.counters = {}
+            self.gauges = {}
+            self.histograms = {}
+            self.started = time.time()
+
+    @staticmethod
+    def _fmt_labels(labels: Labels, extra: typing.Optional[typing.Tuple[str, str]] = None) -> str:
+        items = list(labels) + ([extra] if extra else [])
+        if not items:
+            return ''
+        return '{' + ','.join(f'{k}="{v}"' for k, v in items) + '}'
+
+    def render(self) -> str:
+        lines = []
+        with self.lock:
+            for name, series in sorted(self.counters.items()):
+                lines.append(f'# TYPE {name} counter')
+                for labels, value in sorted(series.items()):
+                    lines.append(f'{name}{self._fmt_labels(labels)} {value}')
+            for name, series in sorted(self.gauges.items()):
+                lines.append(f'# TYPE {name} gauge')
+                for labels, value in sorted(series.items()):
+                    lines.append(f'{name}{self._fmt_labels(labels)} {value}')
+            for name, series in sorted(self.histograms.items()):
+                lines.append(f'# TYPE {name} histogram')
+                for labels, hist in sorted(series.items()):
+                    acc = 0
+                    for bound, count in zip(hist.buckets + [float('inf')], hist.counts):
+                        acc += count
+                        le = '+Inf' if bound == float('inf') else str(bound)
+                        lines.append(f'{name}_bucket{self._fmt_labels(labels, ("le", le))} {acc}')
+                    lines.append(f'{name}_sum{self._fmt_labels(labels)} {hist.sum}')
+                    lines.append(f'{name}_count{self._fmt_labels(labels)} {hist.count}')
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path: str) -> None:
+        # Atomic, so the node exporter never reads half a file
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as out_f:
+            out_f.write(self.render())
+        os.replace(tmp, path)
+
+
+# The one registry for the process: stages deep inside the stream / storage code record straight into it
+registry = Metrics()
+
+
+def record(stage: str, seconds: float, bytes_in: int = 0, bytes_out: int = 0, items: int = 1, cpu: float = 0.0) -> None:
+    # cpu: CPU time of the thread doing the work. Much less than `seconds` means it was mostly waiting (disk, network).
+    registry.inc('hashbak_stage_seconds_total', seconds, stage=stage)
+    registry.inc('hashbak_stage_cpu_seconds_total', cpu, stage=stage)
+    registry.inc('hashbak_stage_items_total', items, stage=stage)
+    if bytes_in:
+        registry.inc('hashbak_stage_bytes_total', bytes_in, stage=stage, direction='in')
+    if bytes_out:
+        registry.inc('hashbak_stage_bytes_total', bytes_out, stage=stage, direction='out')
+    registry.observe('hashbak_stage_duration_seconds', seconds, stage=stage)
+
+
+def metered(stage: str, fn: typing.Callable[[bytes], bytes]) -> typing.Callable[[bytes], bytes]:
+    # Wraps a bytes -> bytes step (compress a frame, encrypt a page...) so each call gets recorded
+    def wrapped(data: bytes) -> bytes:
+        start, cpu = time.perf_counter(), time.thread_time()
+        res = fn(data)
+        record(stage, time.perf_counter() - start, len(data), len(res), cpu=time.thread_time() - cpu)
+        return res
+    return wrapped
+
+
+def stage_summary(metrics: Metrics = registry) -> typing.Dict[str, typing.Dict[str, float]]:
+    res = {}
+    for stage in STAGES:
+        seconds = metrics.get('hashbak_stage_seconds_total', stage=stage)
+        bytes_in = metrics.get('hashbak_stage_bytes_total', stage=stage, direction='in')
+        res[stage] = {
+            'seconds': round(seconds, 3),
+            'cpu_seconds': round(metrics.get('hashbak_stage_cpu_seconds_total', stage=stage), 3),
+            'items': metrics.get('hashbak_stage_items_total', stage=stage),
+            'bytes_in': bytes_in,
+            'bytes_out': metrics.get('hashbak_stage_bytes_total', stage=stage, direction='out'),
+            # Throughput while busy, i.e. what this stage could do if nothing else held it up
+            'mb_per_s': round(bytes_in / (1024**2) / seconds, 2) if seconds else 0.0,
+        }
+    return res
+
+
+def dedup_rate(metrics: Metrics = registry) -> float:
+    hits = metrics.get('hashbak_dedup_checks_total', result='hit')
+    misses = metrics.get('hashbak_dedup_checks_total', result='miss')
+    return hits / (hits + misses) if hits + misses else 0.0
+
+
+def progress_line(metrics: Metrics = registry) -> str:
+    elapsed = max(time.time() - metrics.started, 1e-9)
+    files = sum(metrics.get('hashbak_files_total', result=r) for r in ['new', 'dedup', 'carried', 'hardlink', 'other'])
+    hashed = metrics.get('hashbak_stage_bytes_total', stage='hash', direction='in')
+    uploaded = metrics.get('hashbak_stage_bytes_total', stage='upload', direction='in')
+    line = (
+        f'{files:.0f} files, '
+        f'hashed {hashed / (1024**2):.0f} MiB ({hashed / (1024**2) / elapsed:.1f} MiB/s), '
+        f'uploaded {uploaded / (1024**2):.0f} MiB ({uploaded / (1024**2) / elapsed:.1f} MiB/s), '
+        f'dedup {dedup_rate(metrics) * 100:.0f}%, '
+        f'queues: walk {metrics.get("hashbak_queue_depth", queue="walk"):.0f} '
+        f'hash {metrics.get("hashbak_queue_depth", queue="hash"):.0f} '
+        f'store {metrics.get("hashbak_queue_depth", queue="store"):.0f} '
+        f'upload {metrics.get("hashbak_queue_depth", queue="upload"):.0f}'
+    )
+    expected = metrics.get('hashbak_expected_files')
+    if expected and files:
+        # Only known when there's a previous snapshot to go by
+        remaining = max(expected - files, 0)
+        line += f', ETA {remaining * elapsed / files / 60:.0f} min'
+    return line
+
+
+class Progress:
+    """
+    Logs a progress summary every `interval` seconds while a run goes, and keeps the metrics visible outside the
+    process: rewrites a textfile-collector file on every tick, and / or serves /metrics on a port
+    """
+
+    def __init__(
+            self,
+            interval: float = 60.0,
+            textfile: typing.Optional[str] = None,
+            port: typing.Optional[int] = None,
+            metrics: Metrics = registry,
+    ):
+        self.interval = interval
+        self.textfile = textfile
+        self.port = port
+        self.metrics = metrics
+        self.stopped = threading.Event()
+        self.thread = None
+        self.server = None
+
+    def _tick(self) -> None:
+        logger.info(f'Progress: {progress_line(self.metrics)}')
+        if self.textfile:
+            self.metrics.write_textfile(self.textfile)
+
+    def _run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            self._tick()
+
+    def _serve(self) -> None:
+        metrics = self.metrics
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('', self.port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        logger.info(f'Serving metrics on port {self.server.server_address[1]}')
+
+    def __enter__(self) -> 'Progress':
+        if self.port is not None:
+            self._serve()
+        if self.interval > 0:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        # One last time, so the final numbers are what's left behind
+        self._tick()
+        if self.server is not None:
+            self.server.shutdown()
@@ -0,0 +1,279 @@
+import dataclasses
+import itertools
+import logging
+import os
+import tempfile
+import threading
+import time
+import typing
+
+import hashbak.catalog
+import hashbak.remote
+import hashbak.serial
+import hashbak.stream
+
+
+logger = logging.getLogger(__name__)
+
+
+# Pack index (sealed, one per pack): magic, varint count, then per entry: varint len + hash, varint offset, varint
+# length. Offsets are into the pack object, each entry being exactly what upload_file would have stored for that hash.
+INDEX_MAGIC = b'HBPACKIX'
+
+# Thaw units for packs (see RemoteStorage.restore_unit) are this + the pack id. Never 32 bytes long, so they can't
+# be mistaken for a content hash.
+UNIT_PREFIX = b'pack:'
+
+
+@dataclasses.dataclass
+class PackEntry:
+    pack_id: str
+    offset: int
+    length: int
+
+
+def encode_index(entries: typing.Dict[bytes, PackEntry]) -> bytes:
+    res = [INDEX_MAGIC, hashbak.serial.encode_varint(len(entries))]
+    for fhash, entry in entries.items():
+        res.append(hashbak.serial.encode_varint(len(fhash)))
+        res.append(fhash)
+        res.append(hashbak.serial.encode_varint(entry.offset))
+        res.append(hashbak.serial.encode_varint(entry.length))
+    return b''.join(res)
+
+
+def decode_index(pack_id: str, data: bytes) -> typing.Dict[bytes, PackEntry]:
+    if not data.startswith(INDEX_MAGIC):
+        raise ValueError(f'Not a pack index: {pack_id}')
+    pos = len(INDEX_MAGIC)
+    n, pos = hashbak.serial.decode_varint(data, pos)
+    res = {}
+    for _ in range(n):
+        hlen, pos = hashbak.serial.decode_varint(data, pos)
+        fhash = data[pos:pos + hlen]
+        pos += hlen
+        offset, pos = hashbak.serial.decode_varint(data, pos)
+        length, pos = hashbak.serial.decode_varint(data, pos)
+        res[fhash] = PackEntry(pack_id, offset, length)
+    return res
+
+
+class PackedStorage(hashbak.remote.RemoteStorage):
+    """
+    Wraps a storage so that small files get packed together instead of each being its own archived object
+
+    Glacier charges per object (metadata overhead, minimum billable size, per-request thaw cost), which adds up fast
+    over thousands of .nfo / .srt / config files. Files up to `threshold` bytes get encrypted on their own (so any one
+    of them can be read back with a range read), then appended to a local spool file that goes up as one pack object
+    once it passes `pack_size`. Each pack has a small index object mapping hash -> (offset, length); they all get
+    loaded up front, so dedup checks and restores know what's packed without touching the packs.
+
+    Reads always understand packs, whatever the threshold. Packing new uploads is opt-in: threshold=0 (the default)
+    stores every file as its own object, like an unwrapped storage.
+
+    upload_file can be called from several threads at once: entries get compressed + encrypted in parallel, only
+    appending to the spool (and uploading it when full) is serialized.
+    """
+
+    def __init__(self, inner: hashbak.remote.EncryptedStorage, threshold: int = 0, pack_size: int = 128 * (1024**2)):
+        self.inner = inner
+        self.threshold = threshold
+        self.pack_size = pack_size
+        self.packs: typing.Optional[typing.Dict[bytes, PackEntry]] = None
+
+        # The pack currently being filled
+        self.spool = None
+        self.pending: typing.Dict[bytes, PackEntry] = {}
+        self.pending_infos: typing.List[hashbak.catalog.ObjectInfo] = []
+        self.pack_id = ''
+        self.lock = threading.RLock()
+
+    @property
+    def catalog(self) -> typing.Optional[hashbak.catalog.Catalog]:
+        return self.inner.catalog
+
+    @property
+    def archive_class(self) -> str:
+        return self.inner.archive_class
+
+    def _index(self) -> typing.Dict[bytes, PackEntry]:
+        if self.packs is None:
+            with self.lock:
+                if self.packs is None:
+                    packs = {}
+                    pack_ids = self.inner.list_packs()
+                    for pack_id in pack_ids:
+                        packs.update(decode_index(pack_id, self.inner.get_pack_index(pack_id)))
+                    logger.info(f'Loaded {len(packs)} packed files from {len(pack_ids)} packs')
+                    self.packs = packs
+        return self.packs
+
+    def _lookup(self, fhash: bytes) -> typing.Optional[PackEntry]:
+        return self._index().get(fhash)
+
+    def packed(self, fhash: bytes) -> typing.Optional[PackEntry]:
+        # Where fhash is, if it's in a pack
+        return self._lookup(fhash)
+
+    def _add(self, fhash: bytes, contents: typing.Iterable[bytes], fname: typing.Optional[str]) -> None:
+        info = hashbak.catalog.ObjectInfo(fhash, storage_class=self.inner.archive_class)
+        entry = self.inner.pack_entry(fhash, contents, fname, info)
+        with self.lock:
+            if self.spool is None:
+                self.spool = tempfile.TemporaryFile()
+                self.pack_id = os.urandom(16).hex()
+            info.pack = self.pack_id
+            self.pending[fhash] = PackEntry(self.pack_id, self.spool.tell(), len(entry))
+            self.pending_infos.append(info)
+            self.spool.write(entry)
+            if self.spool.tell() >= self.pack_size:
+                self.flush()
+
+    def _spooled(self) -> typing.Iterable[bytes]:
+        self.spool.seek(0)
+        while page := self.spool.read(hashbak.stream.PAGE_SIZE):
+            yield page
+
+    def flush(self) -> None:
+        with self.lock:
+            if self.spool is None:
+                return
+            logger.info(f'Uploading pack {self.pack_id}: {len(self.pending)} files, {self.spool.tell()} bytes')
+            self.inner.upload_pack(self.pack_id, self._spooled())
+            # Index goes last: a pack without an index is never referenced, so it can just get cleaned up later
+            self.inner.upload_pack_index(self.pack_id, encode_index(self.pending))
+            self._index().update(self.pending)
+            if self.catalog is not None:
+                self.catalog.add_many(self.pending_infos)
+            self.spool.close()
+            self.spool = None
+            self.pending = {}
+            self.pending_infos = []
+            self.inner.flush()
+
+    def load_index(self) -> None:
+        self.inner.load_index()
+        self._index()
+
+    def file_exists(self, fhash: bytes) -> bool:
+        return fhash in self.pending or self._lookup(fhash) is not None or self.inner.file_exists(fhash)
+
+    def list_objects(self) -> typing.Iterable[hashbak.catalog.ObjectInfo]:
+        return self.inner.list_objects()
+
+    def upload_file(self, fhash: bytes, contents: typing.Iterable[bytes], fname: typing.Optional[str] = None) -> None:
+        # Read just far enough to tell whether it's small
+        pages = iter(contents)
+        head = []
+        size = 0
+        for page in pages:
+            head.append(page)
+            size += len(page)
+            if size > self.threshold:
+                break
+        else:
+            if self.threshold > 0:
+                self._add(fhash, head, fname)
+                return
+        self.inner.upload_file(fhash, itertools.chain(head, pages), fname)
+
+    def restore_unit(self, fhash: bytes) -> bytes:
+        entry = self._lookup(fhash)
+        if entry is None:
+            return self.inner.restore_unit(fhash)
+        return UNIT_PREFIX + entry.pack_id.encode('ascii')
+
+    def request_restore(self, fhash: bytes) -> None:
+        if fhash.startswith(UNIT_PREFIX):
+            self.inner.request_pack_restore(fhash.removeprefix(UNIT_PREFIX).decode('ascii'))
+        else:
+            self.inner.request_restore(fhash)
+
+    def restore_status(self, fhash: bytes) -> hashbak.remote.RestoreStatus:
+        if fhash.startswith(UNIT_PREFIX):
+            return self.inner.pack_restore_status(fhash.removeprefix(UNIT_PREFIX).decode('ascii'))
+        return self.inner.restore_status(fhash)
+
+    def await_restore(self, fhash: bytes) -> None:
+        if not fhash.startswith(UNIT_PREFIX):
+            return self.inner.await_restore(fhash)
+        while self.restore_status(fhash) != hashbak.remote.RestoreStatus.complete:
+            time.sleep(60)
+
+    def get_restored_file(self, fhash: bytes) -> typing.Iterable[bytes]:
+        entry = self._lookup(fhash)
+        if entry is None:
+            return self.inner.get_restored_file(fhash)
+        return self.inner.unpack_entry(self.inner.get_pack_range(entry.pack_id, entry.offset, entry.length))
+
+    def read_range(self, fhash: bytes, start: int, length: int) -> typing.Iterable[bytes]:
+        # Packed files are small, reading the whole entry is fine
+        if self._lookup(fhash) is not None:
+            return hashbak.stream.window(self.get_restored_file(fhash), start, length)
+        return self.inner.read_range(fhash, start, length)
+
+    def delete_packs(self, pack_ids: [str]) -> None:
+        self.inner.delete_packs(pack_ids)
+        with self.lock:
+            if self.packs is not None:
+                gone = set(pack_ids)
+                self.packs = {fhash: entry for fhash, entry in self.packs.items() if entry.pack_id not in gone}
+
+    # Everything else goes straight through
+
+    def upload_meta(self, name: str, contents: typing.Iterable[bytes]) -> None:
+        self.inner.upload_meta(name, contents)
+
+    def list_meta(self) -> [str]:
+        return self.inner.list_meta()
+
+    def get_meta(self, name: str) -> typing.Iterable[bytes]:
+        return self.inner.get_meta(name)
+
+    def seal(self, data: bytes) -> bytes:
+        return self.inner.seal(data)
+
+    def unseal(self, data: bytes) -> bytes:
+        return self.inner.unseal(data)
+
+    def upload_report(self, name: str, report: bytes) -> None:
+        self.inner.upload_report(name, report)
+
+    def get_report(self, name: str) -> typing.Optional[bytes]:
+        return self.inner.get_report(name)
+
+    def upload_snapshot(self, name: str, blocks: typing.Iterable[bytes]) -> None:
+        self.inner.upload_snapshot(name, blocks)
+
+    def upload_snapshot_index(self, name: str, index: bytes) -> None:
+        self.inner.upload_snapshot_index(name, index)
+
+    def get_snapshot_index(self, name: str) -> typing.Optional[bytes]:
+        return self.inner.get_snapshot_index(name)
+
+    def get_snapshot_range(self, name: str, offset: int, size: int) -> bytes:
+        return self.inner.get_snapshot_range(name, offset, size)
+
+    def get_snapshot_raw(self, name: str) -> typing.Iterable[bytes]:
+        return self.inner.get_snapshot_raw(name)
+
+    def list_packs(self) -> [str]:
+        return self.inner.list_packs()
+
+    def get_pack_index(self, pack_id: str) -> bytes:
+        return self.inner.get_pack_index(pack_id)
+
+    def list_pack_objects(self) -> typing.Iterable[hashbak.catalog.ObjectInfo]:
+        return self.inner.list_pack_objects()
+
+    def delete_objects(self, fhashes: [bytes]) -> None:
+        self.inner.delete_objects(fhashes)
+
+    def put_lock(self, name: str) -> None:
+        self.inner.put_lock(name)
+
+    def list_locks(self) -> typing.Dict[str, float]:
+        return self.inner.list_locks()
+
+    def delete_lock(self, name: str) -> None:
+        self.inner.delete_lock(name)
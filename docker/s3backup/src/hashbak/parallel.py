@@ -0,0 +1,154 @@
+import collections
+import concurrent.futures
+import multiprocessing
+import queue
+import threading
+import time
+import typing
+
+import hashbak.metrics
+
+
+T = typing.TypeVar('T')
+
+
+def make_executor(workers: int, kind: str = 'thread') -> typing.Optional[concurrent.futures.Executor]:
+    if workers <= 1:
+        return None
+    if kind == 'process':
+        # Not fork: by the time a pool gets made there are other threads around (walker, progress, uploads), and a
+        # forked child can inherit one of their locks mid-hold
+        method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        return concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(method))
+    elif kind == 'thread':
+        return concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    else:
+        raise ValueError(f'Unknown pool kind {kind}')
+
+
+def resolved(x: T) -> concurrent.futures.Future:
+    fut = concurrent.futures.Future()
+    fut.set_result(x)
+    return fut
+
+
+def ordered(futures: typing.Iterable[concurrent.futures.Future], window: int) -> typing.Iterable[typing.Any]:
+    """
+    Yield the results of futures in the order they were produced, keeping at most `window` of them in flight
+
+    `futures` should be lazy (a generator that submits work as it's pulled), otherwise there's nothing to bound
+    """
+    pending = collections.deque()
+    try:
+        for fut in futures:
+            pending.append(fut)
+            while len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for fut in pending:
+            fut.cancel()
+
+
+def background(xs: typing.Iterable[T], depth: int, name: typing.Optional[str] = None) -> typing.Iterable[T]:
+    """
+    Pull xs on a thread of its own, up to `depth` items ahead of whoever's consuming this
+
+    Exceptions come out on the consuming side, in order. Stopping early (closing the generator) stops the thread too.
+    With a name, how far ahead it is shows up as hashbak_queue_depth{queue=name}.
+    """
+    items = queue.Queue(maxsize=max(depth, 1))
+    stopped = threading.Event()
+    done = object()
+
+    def put(item) -> bool:
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def run():
+        try:
+            for x in xs:
+                if name is not None:
+                    hashbak.metrics.registry.add('hashbak_queue_depth', 1, queue=name)
+                if not put((x, None)):
+                    return
+        except BaseException as e:
+            put((done, e))
+            return
+        put((done, None))
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    try:
+        while True:
+            x, exc = items.get()
+            if x is done:
+                if exc is not None:
+                    raise exc
+                return
+            if name is not None:
+                hashbak.metrics.registry.add('hashbak_queue_depth', -1, queue=name)
+            yield x
+    finally:
+        stopped.set()
+        thread.join()
+
+
+class ByteBudget:
+    """
+    Counting semaphore over bytes: acquire blocks until there's room for n more
+
+    A single request bigger than the whole budget gets clamped to it, so it still runs (just alone).
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self.cond = threading.Condition()
+
+    def acquire(self, n: int) -> int:
+        # -> what was actually reserved, pass that back to release
+        n = min(n, self.limit)
+        with self.cond:
+            self.cond.wait_for(lambda: self.used + n <= self.limit)
+            self.used += n
+        return n
+
+    def try_acquire(self, n: int) -> bool:
+        # Non-blocking, and no clamping: False if n doesn't fit right now
+        with self.cond:
+            if self.used + n > self.limit:
+                return False
+            self.used += n
+        return True
+
+    def release(self, n: int) -> None:
+        with self.cond:
+            self.used -= n
+            self.cond.notify_all()
+
+
+class RateLimiter:
+    # At most `rate` calls to wait() per second, shared across threads. rate <= 0 means no limit. With a cost, it's
+    # `rate` units per second instead (e.g. bytes, for a bandwidth cap).
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate > 0 else 0
+        self.next = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self, cost: float = 1) -> None:
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next)
+            self.next = slot + self.interval * cost
+        if slot > now:
+            time.sleep(slot - now)
@@ -0,0 +1,132 @@
+import cProfile
+import collections
+import json
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+import typing
+
+import hashbak.metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+class Profiler:
+    """
+    --profile: where a run's time actually went
+
+    Writes three files next to `prefix`:
+      .stages.json  wall time, CPU time and bytes in / out per pipeline stage (see hashbak.metrics.STAGES)
+      .prof         cProfile stats for every thread (snakeviz, gprof2dot, `python -m pstats`)
+      .folded       sampled stacks, one "frame;frame;frame count" line each (flamegraph.pl, speedscope)
+
+    The stages are chained generators, so a cProfile tree alone smears their time together -- the stage numbers
+    are timed around each step's own work, and wall time well over CPU time means waiting (NFS, S3). Threads get
+    picked up as long as they start inside the `with`. Worker processes (--hash-pool process) don't show in .prof /
+    .folded, use --hash-pool thread to see into hashing.
+
+    A thread's cProfile can only be switched off from that thread, so .prof only gets the threads that have finished
+    by the end of the `with` (waiting up to `join_timeout` for stragglers) -- reading one that's still recording isn't
+    safe. Worker pools shut down inside the `with` are fine.
+    """
+
+    def __init__(self, prefix: str, sample_interval: float = 0.005, join_timeout: float = 5.0):
+        self.prefix = prefix
+        self.sample_interval = sample_interval
+        self.join_timeout = join_timeout
+        self.main: typing.Optional[cProfile.Profile] = None
+        # One per thread started inside the `with`, next to the thread it's recording
+        self.profiles: typing.List[typing.Tuple[threading.Thread, cProfile.Profile]] = []
+        self.lock = threading.Lock()
+        self.stacks: typing.Dict[str, int] = collections.Counter()
+        self.stopped = threading.Event()
+        self.sampler = None
+
+    def _thread_hook(self, frame, event, arg):
+        # First profiling event in a new thread: swap in a cProfile of its own (enable() replaces this hook)
+        prof = cProfile.Profile()
+        with self.lock:
+            self.profiles.append((threading.current_thread(), prof))
+        prof.enable()
+
+    @staticmethod
+    def _fold(frame) -> [str]:
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+            frame = frame.f_back
+        return stack[::-1]
+
+    def _sample(self) -> None:
+        me = threading.get_ident()
+        while not self.stopped.wait(self.sample_interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = [names.get(ident, str(ident))] + self._fold(frame)
+                self.stacks[';'.join(stack)] += 1
+
+    def __enter__(self) -> 'Profiler':
+        threading.setprofile(self._thread_hook)
+        self.main = cProfile.Profile()
+        self.main.enable()
+        self.sampler = threading.Thread(target=self._sample, daemon=True)
+        self.sampler.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.main.disable()
+        threading.setprofile(None)
+        self.stopped.set()
+        self.sampler.join()
+        self.dump()
+
+    def _finished(self) -> typing.List[cProfile.Profile]:
+        # A thread's profiler stops with the thread. Anything still running past the deadline gets left out.
+        deadline = time.monotonic() + self.join_timeout
+        with self.lock:
+            profiles = list(self.profiles)
+        res = []
+        running = []
+        for thread, prof in profiles:
+            thread.join(max(deadline - time.monotonic(), 0))
+            if thread.is_alive():
+                running.append(thread.name)
+            else:
+                res.append(prof)
+        if running:
+            logger.warning(f'Profile leaves out {len(running)} threads still running: {", ".join(running)}')
+        return res
+
+    def dump(self) -> None:
+        stats = pstats.Stats(self.main)
+        for prof in self._finished():
+            try:
+                stats.add(prof)
+            except TypeError:
+                # Thread never got as far as recording anything
+                continue
+        stats.dump_stats(f'{self.prefix}.prof')
+
+        with open(f'{self.prefix}.folded', 'w') as out_f:
+            for stack, count in sorted(self.stacks.items()):
+                out_f.write(f'{stack} {count}\n')
+
+        summary = hashbak.metrics.stage_summary()
+        with open(f'{self.prefix}.stages.json', 'w') as out_f:
+            json.dump(summary, out_f, indent=2)
+
+        logger.info('Stage profile (time inside each stage, summed over threads):')
+        for stage, entry in summary.items():
+            wait = max(entry['seconds'] - entry['cpu_seconds'], 0)
+            logger.info(
+                f'  {stage:<8} wall {entry["seconds"]:9.2f}s  cpu {entry["cpu_seconds"]:9.2f}s  wait {wait:9.2f}s  '
+                f'in {entry["bytes_in"] / (1024**2):9.1f} MiB  out {entry["bytes_out"] / (1024**2):9.1f} MiB'
+            )
+        logger.info(f'Profile written to {self.prefix}.prof / .folded / .stages.json')
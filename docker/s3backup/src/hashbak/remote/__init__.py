@@ -1,3 +1,3 @@
-from .base import RemoteStorage
+from .base import DELETE_BATCH, EncryptedStorage, RemoteStorage, RestoreStatus
 from .local import EncryptedLocalStorage
 from .s3 import EncryptedS3Storage
@@ -1,7 +1,29 @@
+import enum
+import os
 import typing
 
+import hashbak.catalog
+import hashbak.codec
+import hashbak.parallel
+import hashbak.stream
+
+
+class RestoreStatus(enum.Enum):
+    none = 0
+    progress = 1
+    complete = 2
+
+
+# Most keys one S3 DeleteObjects request takes
+DELETE_BATCH = 1000
+
 
 class RemoteStorage:
+    # Optional local record of uploads (see hashbak.catalog). Backends add to it as uploads complete.
+    catalog: typing.Optional[hashbak.catalog.Catalog] = None
+    # Storage class file objects and packs go in as, recorded in the catalog
+    archive_class = ''
+
     def upload_meta(self, name: str, contents: typing.Iterable[bytes]) -> None:
         raise NotImplementedError('stub!')
 
@@ -11,18 +33,219 @@ class RemoteStorage:
     def get_meta(self, name: str) -> typing.Iterable[bytes]:
         raise NotImplementedError('stub!')
 
+    # Block-structured snapshots (see hashbak.snapshot): a data object that's a concatenation of independently
+    # sealed blocks, plus a small sealed index object saying where each block starts
+
+    def seal(self, data: bytes) -> bytes:
+        raise NotImplementedError('stub!')
+
+    def unseal(self, data: bytes) -> bytes:
+        raise NotImplementedError('stub!')
+
+    def upload_snapshot(self, name: str, blocks: typing.Iterable[bytes]) -> None:
+        # blocks come pre-sealed (see seal)
+        raise NotImplementedError('stub!')
+
+    def upload_snapshot_index(self, name: str, index: bytes) -> None:
+        # plaintext, the storage seals it. Written last, so a snapshot without an index never finished uploading.
+        raise NotImplementedError('stub!')
+
+    def get_snapshot_index(self, name: str) -> typing.Optional[bytes]:
+        # None for snapshots written in the old flat format
+        raise NotImplementedError('stub!')
+
+    def get_snapshot_range(self, name: str, offset: int, size: int) -> bytes:
+        raise NotImplementedError('stub!')
+
+    def get_snapshot_raw(self, name: str) -> typing.Iterable[bytes]:
+        raise NotImplementedError('stub!')
+
+    # Run reports (see hashbak.metrics): a small sealed JSON summary of how a backup went, next to its snapshot
+
+    def upload_report(self, name: str, report: bytes) -> None:
+        raise NotImplementedError('stub!')
+
+    def get_report(self, name: str) -> typing.Optional[bytes]:
+        raise NotImplementedError('stub!')
+
+    # Pack objects (see hashbak.pack): many small files' encrypted contents back to back in one archived object, plus
+    # a small sealed index object per pack
+
+    def upload_pack(self, pack_id: str, contents: typing.Iterable[bytes]) -> None:
+        # contents are already encrypted entries (see EncryptedStorage.pack_entry), stored as is
+        raise NotImplementedError('stub!')
+
+    def upload_pack_index(self, pack_id: str, index: bytes) -> None:
+        raise NotImplementedError('stub!')
+
+    def list_packs(self) -> [str]:
+        raise NotImplementedError('stub!')
+
+    def get_pack_index(self, pack_id: str) -> bytes:
+        raise NotImplementedError('stub!')
+
+    def list_pack_objects(self) -> typing.Iterable[hashbak.catalog.ObjectInfo]:
+        # Every stored pack object, indexed or not, as ObjectInfos with pack set (and no fhash)
+        raise NotImplementedError('stub!')
+
+    def delete_packs(self, pack_ids: [str]) -> None:
+        # Packs + their indexes, at most DELETE_BATCH at a time. Index first, so a half-done delete never leaves an
+        # index pointing at nothing.
+        raise NotImplementedError('stub!')
+
+    def get_pack_range(self, pack_id: str, offset: int, size: int) -> bytes:
+        # From the restored copy, like get_restored_file
+        raise NotImplementedError('stub!')
+
+    def request_pack_restore(self, pack_id: str) -> None:
+        raise NotImplementedError('stub!')
+
+    def pack_restore_status(self, pack_id: str) -> RestoreStatus:
+        raise NotImplementedError('stub!')
+
+    # Locks (see hashbak.garbage.lock): empty marker objects saying a backup or gc is running, listed with the time
+    # they were written. Also holds the marker for the last gc --delete (see hashbak.garbage.last_sweep).
+
+    def put_lock(self, name: str) -> None:
+        raise NotImplementedError('stub!')
+
+    def list_locks(self) -> typing.Dict[str, float]:
+        raise NotImplementedError('stub!')
+
+    def delete_lock(self, name: str) -> None:
+        # Gone already is fine
+        raise NotImplementedError('stub!')
+
+    def load_index(self) -> None:
+        # Optional: grab whatever's needed up front to make file_exists cheap
+        pass
+
     def file_exists(self, fhash: bytes) -> bool:
         raise NotImplementedError('stub!')
 
-    def upload_file(self, fhash: bytes, contents: typing.Iterable[bytes]) -> None:
+    def has_object(self, fhash: bytes) -> bool:
+        # file_exists, but asking the catalog first. A trusted catalog gets the last word, so no round trips at all.
+        if self.catalog is not None and not self.catalog.stale:
+            if fhash in self.catalog:
+                return True
+            if self.catalog.trusted:
+                return False
+        return self.file_exists(fhash)
+
+    def list_objects(self) -> typing.Iterable[hashbak.catalog.ObjectInfo]:
+        # Every stored file object (not packs), for rebuilding the catalog. A listing doesn't say which codec was used.
+        raise NotImplementedError('stub!')
+
+    def delete_objects(self, fhashes: [bytes]) -> None:
+        # File objects, at most DELETE_BATCH at a time (one request on S3). Gone already is fine.
+        raise NotImplementedError('stub!')
+
+    def upload_file(self, fhash: bytes, contents: typing.Iterable[bytes], fname: typing.Optional[str] = None) -> None:
+        # fname is only a hint (e.g. for picking a codec), contents are keyed by fhash alone
         raise NotImplementedError('stub!')
 
+    def flush(self) -> None:
+        # Anything upload_file has buffered up has to be stored by the time this returns
+        pass
+
+    def restore_unit(self, fhash: bytes) -> bytes:
+        # What actually needs thawing to read fhash: request_restore / restore_status / await_restore take these
+        return fhash
+
     def request_restore(self, fhash: bytes) -> None:
         raise NotImplementedError('stub!')
 
+    def restore_status(self, fhash: bytes) -> RestoreStatus:
+        raise NotImplementedError('stub!')
+
     def await_restore(self, fhash: bytes) -> None:
         raise NotImplementedError('stub!')
 
     def get_restored_file(self, fhash: bytes) -> typing.Iterable[bytes]:
         raise NotImplementedError('stub!')
 
+    def read_range(self, fhash: bytes, start: int, length: int) -> typing.Iterable[bytes]:
+        # `length` bytes of fhash's contents from `start` (fewer at the end), out of the restored copy like
+        # get_restored_file. This default reads through everything before them.
+        return hashbak.stream.window(self.get_restored_file(fhash), start, length)
+
+
+class EncryptedStorage(RemoteStorage):
+    # The compress + encrypt plumbing shared by the real storage backends
+
+    def __init__(
+            self,
+            aes_key: bytes,
+            codec: typing.Optional[hashbak.codec.Codec] = None,
+            cipher: str = 'cbc',
+            crypt_workers: int = 1,
+            catalog: typing.Optional[hashbak.catalog.Catalog] = None,
+    ):
+        self.aes_key = aes_key
+        self.catalog = catalog
+        self.codec = codec or hashbak.codec.GzipCodec()
+        # 'cbc' (original format) or 'gcm' (framed, see hashbak.stream.encrypt_gcm). Reads handle either.
+        self.cipher = cipher
+        self.crypt_executor = hashbak.parallel.make_executor(crypt_workers, 'thread')
+
+    def _encrypt(
+            self,
+            contents: typing.Iterable[bytes],
+            key: bytes,
+            iv: bytes,
+            fname: typing.Optional[str] = None,
+            info: typing.Optional[hashbak.catalog.ObjectInfo] = None,
+    ) -> typing.Iterable[bytes]:
+        # With info, fills in the codec picked + the stored size as the result gets consumed
+        on_select = None
+        if info is not None:
+            def on_select(codec: hashbak.codec.Codec):
+                info.codec = codec.name
+        gzs = hashbak.stream.compress(contents, self.codec, fname, on_select)
+        if self.cipher == 'gcm':
+            enc = hashbak.stream.encrypt_gcm(gzs, key, executor=self.crypt_executor)
+        else:
+            enc = hashbak.stream.encrypt(gzs, key, iv)
+        return enc if info is None else info.count(enc)
+
+    def _uploaded(self, info: hashbak.catalog.ObjectInfo) -> None:
+        if self.catalog is not None:
+            self.catalog.add(info)
+
+    @staticmethod
+    def _decrypt(contents: typing.Iterable[bytes], key: bytes) -> typing.Iterable[bytes]:
+        dec = hashbak.stream.decrypt(contents, key)
+        ugz = hashbak.stream.decompress(dec)
+        return hashbak.stream.paginate(ugz)
+
+    def seal(self, data: bytes) -> bytes:
+        return b''.join(self._encrypt([data], self.aes_key, os.urandom(16)))
+
+    def unseal(self, data: bytes) -> bytes:
+        return b''.join(self._decrypt([data], self.aes_key))
+
+    def pack_entry(
+            self,
+            fhash: bytes,
+            contents: typing.Iterable[bytes],
+            fname: typing.Optional[str] = None,
+            info: typing.Optional[hashbak.catalog.ObjectInfo] = None,
+    ) -> bytes:
+        # Exactly what upload_file would have stored, so it can be read back on its own out of the middle of a pack
+        return b''.join(self._encrypt(contents, self.aes_key, fhash[:16], fname, info))
+
+    def unpack_entry(self, data: bytes) -> typing.Iterable[bytes]:
+        return self._decrypt([data], self.aes_key)
+
+    def _restored_range(self, fhash: bytes, offset: int, size: int) -> bytes:
+        # Raw (still encrypted) bytes of the restored copy, e.g. an S3 range GET
+        raise NotImplementedError('stub!')
+
+    def read_range(self, fhash: bytes, start: int, length: int) -> typing.Iterable[bytes]:
+        # GCM objects can be read from the middle (see hashbak.stream.read_range), CBC ones only from the start
+        def fetch(offset: int, size: int) -> bytes:
+            return self._restored_range(fhash, offset, size)
+
+        if fetch(0, len(hashbak.stream.GCM_MAGIC)) != hashbak.stream.GCM_MAGIC:
+            return super().read_range(fhash, start, length)
+        return hashbak.stream.read_range(fetch, self.aes_key, start, length)
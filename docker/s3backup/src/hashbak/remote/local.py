@@ -1,9 +1,18 @@
+import concurrent.futures
+import contextlib
 import hashlib
+import itertools
 import os
+import random
 import shutil
+import threading
 import time
 import typing
 
+import hashbak.catalog
+import hashbak.codec
+import hashbak.metrics
+import hashbak.parallel
 import hashbak.stream
 
 from . import base
@@ -15,63 +24,370 @@ def str_hash(contents: str) -> bytes:
     return acc.digest()
 
 
-class EncryptedLocalStorage(base.RemoteStorage):
+# Like botocore: a throttled request gets retried a few times with backoff before the error comes out
+MAX_ATTEMPTS = 5
+LIST_PAGE = 1000
 
-    def __init__(self, aes_key: bytes):
-        self.aes_key = aes_key
 
-    @staticmethod
-    def _encrypt(contents: typing.Iterable[bytes], key: bytes, iv: bytes) -> typing.Iterable[bytes]:
-        gzs = hashbak.stream.gzip(contents)
-        enc = hashbak.stream.encrypt(gzs, key, iv)
-        return enc
+class Throttled(Exception):
+    # Stand-in for S3's SlowDown, once the retries have run out
+    pass
 
-    @staticmethod
-    def _decrypt(contents: typing.Iterable[bytes], key: bytes) -> typing.Iterable[bytes]:
-        dec = hashbak.stream.decrypt(contents, key)
-        ugz = hashbak.stream.ungzip(dec)
-        return hashbak.stream.paginate(ugz)
 
-    @staticmethod
-    def _meta_name(name: str):
-        return f'/home/anton/tmp/mock_s3/meta/{name}'
+class LocalMultipart:
+    """
+    Same shape as S3Multipart: parts go up (concurrently) as separate requests into a scratch directory, and the
+    object only appears once it's completed. An upload that fails or gets interrupted leaves nothing behind at `path`.
+    """
 
-    @staticmethod
-    def _file_name(fhash: bytes):
-        return f'/home/anton/tmp/mock_s3/file/{fhash.hex()}'
+    def __init__(self, storage: 'EncryptedLocalStorage', path: str, concurrency: int = 1):
+        self.storage = storage
+        self.path = path
+        self.concurrency = max(concurrency, 1)
+        self.upload_dir = None
+        self.idx = 1
+        self.slots = threading.BoundedSemaphore(self.concurrency)
+        self.executor = None
+        self.futures = []
+        self.failed = None
 
-    @staticmethod
-    def _restore_name(fhash: bytes):
-        return f'/home/anton/tmp/mock_s3/restore/{fhash.hex()}'
+    def __enter__(self) -> 'LocalMultipart':
+        self.storage._request()
+        self.upload_dir = self.storage._scratch()
+        os.makedirs(self.upload_dir)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency)
+        return self
+
+    def _upload_part(self, idx: int, data: bytes) -> None:
+        try:
+            start, cpu = time.perf_counter(), time.thread_time()
+            self.storage._request(len(data))
+            with open(os.path.join(self.upload_dir, str(idx)), 'wb') as out_f:
+                out_f.write(data)
+            hashbak.metrics.record('upload', time.perf_counter() - start, len(data), cpu=time.thread_time() - cpu)
+        except BaseException as e:
+            self.failed = e
+            raise
+        finally:
+            hashbak.metrics.registry.add('hashbak_queue_depth', -1, queue='upload')
+            self.slots.release()
+
+    def add_chunk(self, data: bytes) -> None:
+        self.slots.acquire()
+        if self.failed is not None:
+            self.slots.release()
+            raise self.failed
+        hashbak.metrics.registry.add('hashbak_queue_depth', 1, queue='upload')
+        self.futures.append(self.executor.submit(self._upload_part, self.idx, data))
+        self.idx += 1
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            if exc_val is None:
+                for fut in self.futures:
+                    fut.result()
+                self.executor.shutdown()
+                self.storage._request()
+                done = self.upload_dir + '.complete'
+                with open(done, 'wb') as out_f:
+                    for idx in range(1, self.idx):
+                        with open(os.path.join(self.upload_dir, str(idx)), 'rb') as in_f:
+                            shutil.copyfileobj(in_f, out_f)
+                os.replace(done, self.path)
+                shutil.rmtree(self.upload_dir)
+                return
+        except BaseException:
+            self._abort()
+            raise
+        self._abort()
+
+    def _abort(self):
+        self.executor.shutdown(cancel_futures=True)
+        shutil.rmtree(self.upload_dir, ignore_errors=True)
+
+
+class EncryptedLocalStorage(base.EncryptedStorage):
+    """
+    S3 stand-in on the local disk, for running backups + restores offline
+
+    Tries to behave like the real thing where it matters: uploads are multipart and only show up once complete,
+    archived objects have to be thawed (taking `thaw_delay` seconds) before they can be read, and every request can be
+    slowed down (`latency` seconds each, `bandwidth` bytes/sec shared across all requests) or throttled (a
+    `throttle_rate` fraction of requests get a SlowDown, retried with backoff like botocore does).
+    """
+
+    archive_class = 'LOCAL'
+
+    def __init__(
+            self,
+            aes_key: bytes,
+            codec: typing.Optional[hashbak.codec.Codec] = None,
+            cipher: str = 'cbc',
+            crypt_workers: int = 1,
+            catalog: typing.Optional[hashbak.catalog.Catalog] = None,
+            root: str = '/home/anton/tmp/mock_s3',
+            upload_concurrency: int = 4,
+            part_size: int = 10 * (1024**2),
+            latency: float = 0.0,
+            bandwidth: float = 0.0,
+            thaw_delay: float = 0.0,
+            throttle_rate: float = 0.0,
+            upload_buffer: int = 256 * (1024**2),
+    ):
+        super().__init__(aes_key, codec, cipher, crypt_workers, catalog)
+        self.root = root
+        for sub in ['meta', 'meta-index', 'file', 'restore', 'pack', 'pack-index', 'report', 'locks', 'uploads']:
+            os.makedirs(os.path.join(root, sub), exist_ok=True)
+        self.upload_concurrency = upload_concurrency
+        # Same memory cap as EncryptedS3Storage: parts in flight + the one being filled
+        self.part_size = min(part_size, max(upload_buffer // (upload_concurrency + 1), 1024**2))
+        self.latency = latency
+        self.bandwidth = hashbak.parallel.RateLimiter(bandwidth)
+        self.thaw_delay = thaw_delay
+        self.throttle_rate = throttle_rate
+
+    def _meta_name(self, name: str):
+        return f'{self.root}/meta/{name}'
+
+    def _meta_index_name(self, name: str):
+        return f'{self.root}/meta-index/{name}'
+
+    def _file_name(self, fhash: bytes):
+        return f'{self.root}/file/{fhash.hex()}'
+
+    def _restore_name(self, fhash: bytes):
+        return f'{self.root}/restore/{fhash.hex()}'
+
+    def _report_name(self, name: str):
+        return f'{self.root}/report/{name}'
+
+    def _pack_name(self, pack_id: str):
+        return f'{self.root}/pack/{pack_id}'
+
+    def _pack_index_name(self, pack_id: str):
+        return f'{self.root}/pack-index/{pack_id}'
+
+    def _pack_restore_name(self, pack_id: str):
+        return f'{self.root}/restore/pack-{pack_id}'
+
+    def _lock_name(self, name: str):
+        return f'{self.root}/locks/{name}'
+
+    def _scratch(self) -> str:
+        # Somewhere to build an object before it appears, outside of anything that gets listed
+        return f'{self.root}/uploads/{os.urandom(8).hex()}'
+
+    # Request emulation
+
+    def _request(self, nbytes: int = 0) -> None:
+        for attempt in range(MAX_ATTEMPTS):
+            if self.latency:
+                time.sleep(self.latency)
+            if not self.throttle_rate or random.random() >= self.throttle_rate:
+                break
+            time.sleep(random.uniform(0, 0.05 * 2 ** attempt))
+        else:
+            raise Throttled(f'SlowDown, {MAX_ATTEMPTS} attempts')
+        self.bandwidth.wait(nbytes)
+
+    def _get(self, path: str) -> typing.Iterable[bytes]:
+        self._request()
+        for page in hashbak.stream.file(path):
+            self.bandwidth.wait(len(page))
+            yield page
+
+    def _get_bytes(self, path: str) -> bytes:
+        return b''.join(self._get(path))
+
+    def _put(self, path: str, data: bytes) -> None:
+        self._request(len(data))
+        tmp = self._scratch()
+        with open(tmp, 'wb') as out_f:
+            out_f.write(data)
+        os.replace(tmp, path)
+
+    def _put_multipart(self, path: str, contents: typing.Iterable[bytes]) -> None:
+        parts = hashbak.stream.repaginate(contents, itertools.repeat(self.part_size))
+        with LocalMultipart(self, path, self.upload_concurrency) as multipart:
+            for part in parts:
+                multipart.add_chunk(part)
+
+    def _read_range(self, path: str, offset: int, size: int) -> bytes:
+        self._request(size)
+        with open(path, 'rb') as in_f:
+            in_f.seek(offset)
+            return in_f.read(size)
+
+    def _list(self, fdir: str) -> [os.DirEntry]:
+        entries = list(os.scandir(fdir))
+        for _ in range(max(1, -(-len(entries) // LIST_PAGE))):
+            self._request()
+        return entries
+
+    # Glacier emulation: a thaw request leaves a marker with the time it was made, and the readable copy shows up
+    # (on the first status check) once thaw_delay has passed
+
+    def _thaw(self, src: str, dst: str) -> None:
+        tmp = self._scratch()
+        shutil.copy(src, tmp)
+        os.replace(tmp, dst)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(dst + '.requested')
+
+    def _request_thaw(self, src: str, dst: str) -> None:
+        self._request()
+        if os.path.isfile(dst) or os.path.isfile(dst + '.requested'):
+            return
+        if self.thaw_delay <= 0:
+            self._thaw(src, dst)
+            return
+        with open(dst + '.requested', 'w') as out_f:
+            out_f.write(str(time.time()))
+
+    def _thaw_status(self, src: str, dst: str) -> base.RestoreStatus:
+        self._request()
+        if os.path.isfile(dst):
+            return base.RestoreStatus.complete
+        try:
+            with open(dst + '.requested') as in_f:
+                requested = float(in_f.read())
+        except FileNotFoundError:
+            return base.RestoreStatus.none
+        if time.time() - requested < self.thaw_delay:
+            return base.RestoreStatus.progress
+        self._thaw(src, dst)
+        return base.RestoreStatus.complete
 
     def upload_meta(self, name: str, contents: typing.Iterable[bytes]) -> None:
         iv = str_hash(name)[:16]
         enc = self._encrypt(contents, self.aes_key, iv)
-        with open(self._meta_name(name), 'wb') as out_f:
-            for page in enc:
-                out_f.write(page)
+        self._put_multipart(self._meta_name(name), enc)
 
     def list_meta(self) -> [str]:
-        return os.listdir('/home/anton/tmp/mock_s3/meta')
+        return [entry.name for entry in self._list(f'{self.root}/meta')]
 
     def get_meta(self, name: str) -> typing.Iterable[bytes]:
-        return self._decrypt(hashbak.stream.file(self._meta_name(name)), self.aes_key)
+        return self._decrypt(self._get(self._meta_name(name)), self.aes_key)
+
+    def upload_snapshot(self, name: str, blocks: typing.Iterable[bytes]) -> None:
+        self._put_multipart(self._meta_name(name), blocks)
+
+    def upload_snapshot_index(self, name: str, index: bytes) -> None:
+        self._put(self._meta_index_name(name), self.seal(index))
+
+    def get_snapshot_index(self, name: str) -> typing.Optional[bytes]:
+        if not os.path.isfile(self._meta_index_name(name)):
+            self._request()
+            return None
+        return self.unseal(self._get_bytes(self._meta_index_name(name)))
+
+    def get_snapshot_range(self, name: str, offset: int, size: int) -> bytes:
+        return self._read_range(self._meta_name(name), offset, size)
+
+    def get_snapshot_raw(self, name: str) -> typing.Iterable[bytes]:
+        return self._get(self._meta_name(name))
+
+    def upload_report(self, name: str, report: bytes) -> None:
+        self._put(self._report_name(name), self.seal(report))
+
+    def get_report(self, name: str) -> typing.Optional[bytes]:
+        if not os.path.isfile(self._report_name(name)):
+            self._request()
+            return None
+        return self.unseal(self._get_bytes(self._report_name(name)))
+
+    def upload_pack(self, pack_id: str, contents: typing.Iterable[bytes]) -> None:
+        self._put_multipart(self._pack_name(pack_id), contents)
+
+    def upload_pack_index(self, pack_id: str, index: bytes) -> None:
+        self._put(self._pack_index_name(pack_id), self.seal(index))
+
+    def list_packs(self) -> [str]:
+        return [entry.name for entry in self._list(f'{self.root}/pack-index')]
+
+    def get_pack_index(self, pack_id: str) -> bytes:
+        return self.unseal(self._get_bytes(self._pack_index_name(pack_id)))
+
+    def get_pack_range(self, pack_id: str, offset: int, size: int) -> bytes:
+        return self._read_range(self._pack_restore_name(pack_id), offset, size)
+
+    def list_pack_objects(self) -> typing.Iterable[hashbak.catalog.ObjectInfo]:
+        for entry in self._list(f'{self.root}/pack'):
+            stat = entry.stat()
+            yield hashbak.catalog.ObjectInfo(
+                b'',
+                size=stat.st_size,
+                storage_class=self.archive_class,
+                uploaded=stat.st_mtime,
+                pack=entry.name,
+            )
+
+    def _delete(self, paths: [str]) -> None:
+        if not paths:
+            return
+        self._request()
+        for path in paths:
+            # Restored copies go with the object, like they would on S3 (where they're the same key)
+            for p in [path, path + '.requested']:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(p)
+
+    def delete_packs(self, pack_ids: [str]) -> None:
+        self._delete([self._pack_index_name(pack_id) for pack_id in pack_ids])
+        self._delete([self._pack_name(pack_id) for pack_id in pack_ids])
+        self._delete([self._pack_restore_name(pack_id) for pack_id in pack_ids])
+
+    def request_pack_restore(self, pack_id: str) -> None:
+        self._request_thaw(self._pack_name(pack_id), self._pack_restore_name(pack_id))
+
+    def put_lock(self, name: str) -> None:
+        self._put(self._lock_name(name), b'')
+
+    def list_locks(self) -> typing.Dict[str, float]:
+        return {entry.name: entry.stat().st_mtime for entry in self._list(f'{self.root}/locks')}
+
+    def delete_lock(self, name: str) -> None:
+        self._delete([self._lock_name(name)])
+
+    def pack_restore_status(self, pack_id: str) -> base.RestoreStatus:
+        return self._thaw_status(self._pack_name(pack_id), self._pack_restore_name(pack_id))
 
     def file_exists(self, fhash: bytes) -> bool:
+        self._request()
         return os.path.exists(self._file_name(fhash))
 
-    def upload_file(self, fhash: bytes, contents: typing.Iterable[bytes]) -> None:
-        enc = self._encrypt(contents, self.aes_key, fhash[:16])
-        with open(self._file_name(fhash), 'wb') as out_f:
-            for page in enc:
-                out_f.write(page)
+    def list_objects(self) -> typing.Iterable[hashbak.catalog.ObjectInfo]:
+        for entry in self._list(f'{self.root}/file'):
+            stat = entry.stat()
+            yield hashbak.catalog.ObjectInfo(
+                bytes.fromhex(entry.name),
+                size=stat.st_size,
+                storage_class=self.archive_class,
+                uploaded=stat.st_mtime,
+            )
+
+    def delete_objects(self, fhashes: [bytes]) -> None:
+        self._delete([self._file_name(fhash) for fhash in fhashes])
+        self._delete([self._restore_name(fhash) for fhash in fhashes])
+
+    def upload_file(self, fhash: bytes, contents: typing.Iterable[bytes], fname: typing.Optional[str] = None) -> None:
+        info = hashbak.catalog.ObjectInfo(fhash, storage_class=self.archive_class)
+        enc = self._encrypt(contents, self.aes_key, fhash[:16], fname, info)
+        self._put_multipart(self._file_name(fhash), enc)
+        self._uploaded(info)
 
     def request_restore(self, fhash: bytes) -> None:
-        shutil.copy(self._file_name(fhash), self._restore_name(fhash))
+        self._request_thaw(self._file_name(fhash), self._restore_name(fhash))
+
+    def restore_status(self, fhash: bytes) -> base.RestoreStatus:
+        return self._thaw_status(self._file_name(fhash), self._restore_name(fhash))
 
     def await_restore(self, fhash: bytes) -> None:
-        while not os.path.isfile(self._restore_name(fhash)):
+        while self.restore_status(fhash) != base.RestoreStatus.complete:
             time.sleep(1)
 
+    def _restored_range(self, fhash: bytes, offset: int, size: int) -> bytes:
+        return self._read_range(self._restore_name(fhash), offset, size)
+
     def get_restored_file(self, fhash: bytes) -> typing.Iterable[bytes]:
-        return self._decrypt(hashbak.stream.file(self._restore_name(fhash)), self.aes_key)
+        return self._decrypt(self._get(self._restore_name(fhash)), self.aes_key)
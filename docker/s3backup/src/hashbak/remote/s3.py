@@ -1,18 +1,28 @@
-import enum
+import concurrent.futures
 import hashlib
+import logging
+import os
 import queue
 import threading
 import time
 import typing
 
 import boto3
+import botocore.config
 import botocore.exceptions
 
+import hashbak.catalog
+import hashbak.codec
+import hashbak.metrics
+import hashbak.index
 import hashbak.stream
 
 from . import base
 
 
+logger = logging.getLogger(__name__)
+
+
 def str_hash(contents: str) -> bytes:
     acc = hashlib.sha256()
     acc.update(contents.encode('utf-8'))
@@ -26,14 +36,20 @@ class ThreadBufferedS3Download:
         self.key = key
         self.q = queue.Queue(maxsize=2)
         self.done = False
+        self.error: typing.Optional[Exception] = None
 
     def worker(self):
-        self.s3.download_fileobj(
-            Bucket=self.bucket,
-            Key=self.key,
-            Fileobj=self,
-        )
-        self.finish()
+        try:
+            self.s3.download_fileobj(
+                Bucket=self.bucket,
+                Key=self.key,
+                Fileobj=self,
+            )
+        except Exception as e:
+            # Goes to the reader, rather than leaving it waiting on a queue nothing is going to fill
+            self.error = e
+        finally:
+            self.finish()
 
     def thread(self):
         t = threading.Thread(target=self.worker, daemon=True)
@@ -46,28 +62,63 @@ class ThreadBufferedS3Download:
 
     def finish(self):
         self.done = True
-        self.write(b'')
+        self.q.put(None)
 
     def deque(self) -> typing.Iterable[bytes]:
-        while not self.done:
-            item = self.q.get()
+        while (item := self.q.get()) is not None:
             yield item
+        if self.error is not None:
+            raise self.error
 
     def stream(self) -> typing.Iterable[bytes]:
         return hashbak.stream.paginate(self.deque())
 
 
+# S3 limits: at most 10k parts per upload, each part (except the last) between 5MiB and 5GiB
+MAX_PARTS = 10_000
+MIN_PART_SIZE = 10 * (1024**2)
+MAX_PART_SIZE = 5 * (1024**3)
+PARTS_PER_STEP = 1000
+
+
+def part_sizes(expected: typing.Optional[int] = None, max_part: int = MAX_PART_SIZE) -> typing.Iterable[int]:
+    """
+    Part sizes for one multipart upload, never above max_part: every in-flight part is held in memory in full, so
+    that's what bounds an upload's memory (see EncryptedS3Storage's upload_buffer)
+
+    With an expected size, parts start just big enough to fit it in 90% of the part limit (room for compression doing
+    worse than nothing, or the file growing) and stay that size. Without one, they start at MIN_PART_SIZE and double
+    every 1000 parts, so small objects stay in small parts.
+    """
+    size = MIN_PART_SIZE
+    step = PARTS_PER_STEP
+    if expected:
+        step = MAX_PARTS * 9 // 10
+        size = max(size, -(-expected // step))
+    idx = 0
+    while True:
+        yield min(size * 2 ** (idx // step), max_part)
+        idx += 1
+
+
 class S3Multipart:
-    def __init__(self, bucket: str, key: str, storage_class: str, client: boto3.client):
+    def __init__(self, bucket: str, key: str, storage_class: str, client: boto3.client, concurrency: int = 1):
         self.s3 = client
         self.bucket = bucket
         self.key = key
         self.storage_class = storage_class
+        self.concurrency = max(concurrency, 1)
 
         self.upload_id = None
         self.idx = 1
         self.parts = []
 
+        # Each slot is one part held in memory, waiting on / in the middle of its upload
+        self.slots = threading.BoundedSemaphore(self.concurrency)
+        self.executor = None
+        self.futures = []
+        self.failed = None
+
     def __enter__(self) -> 'S3Multipart':
         response = self.s3.create_multipart_upload(
             Bucket=self.bucket,
@@ -75,67 +126,108 @@ class S3Multipart:
             StorageClass=self.storage_class,
         )
         self.upload_id = response['UploadId']
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency)
         return self
 
-    def add_chunk(self, data: bytes) -> None:
-        resp = self.s3.upload_part(
-            Body=data,
-            Bucket=self.bucket,
-            Key=self.key,
-            PartNumber=self.idx,
-            UploadId=self.upload_id,
-        )
-        self.parts.append({
-            'ETag': resp['ETag'],
-            'PartNumber': self.idx,
-        })
-        self.idx += 1
-
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        if exc_val is None:
-            self.s3.complete_multipart_upload(
-                Bucket=self.bucket,
-                Key=self.key,
-                MultipartUpload={'Parts': self.parts},
-                UploadId=self.upload_id,
-            )
-        else:
-            self.s3.abort_multipart_upload(
+    def _upload_part(self, idx: int, data: bytes) -> dict:
+        try:
+            start, cpu = time.perf_counter(), time.thread_time()
+            resp = self.s3.upload_part(
+                Body=data,
                 Bucket=self.bucket,
                 Key=self.key,
+                PartNumber=idx,
                 UploadId=self.upload_id,
             )
+            hashbak.metrics.record('upload', time.perf_counter() - start, len(data), cpu=time.thread_time() - cpu)
+            return {
+                'ETag': resp['ETag'],
+                'PartNumber': idx,
+            }
+        except BaseException as e:
+            self.failed = e
+            raise
+        finally:
+            hashbak.metrics.registry.add('hashbak_queue_depth', -1, queue='upload')
+            self.slots.release()
 
+    def add_chunk(self, data: bytes) -> None:
+        if self.idx > MAX_PARTS:
+            raise ValueError(f'{self.key}: more than {MAX_PARTS} parts, needs a bigger upload buffer')
+        self.slots.acquire()
+        if self.failed is not None:
+            self.slots.release()
+            raise self.failed
+        hashbak.metrics.registry.add('hashbak_queue_depth', 1, queue='upload')
+        self.futures.append(self.executor.submit(self._upload_part, self.idx, data))
+        self.idx += 1
 
-class RestoreStatus(enum.Enum):
-    none = 0
-    progress = 1
-    complete = 2
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            if exc_val is None:
+                # Raises if any part failed, which lands us in the abort below
+                self.parts = [fut.result() for fut in self.futures]
+                self.s3.complete_multipart_upload(
+                    Bucket=self.bucket,
+                    Key=self.key,
+                    MultipartUpload={'Parts': self.parts},
+                    UploadId=self.upload_id,
+                )
+                self.executor.shutdown()
+                return
+        except BaseException:
+            self._abort()
+            raise
+        self._abort()
+
+    def _abort(self):
+        # Drop queued parts and let in-flight ones land first, otherwise S3 can hang on to them after the abort
+        self.executor.shutdown(cancel_futures=True)
+        self.s3.abort_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+        )
 
 
-class EncryptedS3Storage(base.RemoteStorage):
+# Storage classes that need a restore_object before they can be read
+ARCHIVE_CLASSES = {'GLACIER', 'DEEP_ARCHIVE'}
 
-    def __init__(self, aes_key: bytes, bucket: str):
-        self.aes_key = aes_key
-        self.bucket = bucket
-        self.s3 = boto3.client('s3')
 
-    @staticmethod
-    def _encrypt(contents: typing.Iterable[bytes], key: bytes, iv: bytes) -> typing.Iterable[bytes]:
-        gzs = hashbak.stream.gzip(contents)
-        enc = hashbak.stream.encrypt(gzs, key, iv)
-        return enc
+class EncryptedS3Storage(base.EncryptedStorage):
+    archive_class = 'GLACIER'
 
-    @staticmethod
-    def _decrypt(contents: typing.Iterable[bytes], key: bytes) -> typing.Iterable[bytes]:
-        dec = hashbak.stream.decrypt(contents, key)
-        ugz = hashbak.stream.ungzip(dec)
-        return hashbak.stream.paginate(ugz)
+    def __init__(
+            self,
+            aes_key: bytes,
+            bucket: str,
+            upload_concurrency: int = 4,
+            codec: typing.Optional[hashbak.codec.Codec] = None,
+            cipher: str = 'cbc',
+            crypt_workers: int = 1,
+            catalog: typing.Optional[hashbak.catalog.Catalog] = None,
+            upload_buffer: int = 256 * (1024**2),
+    ):
+        super().__init__(aes_key, codec, cipher, crypt_workers, catalog)
+        self.bucket = bucket
+        self.upload_concurrency = upload_concurrency
+        # Memory for one upload: the parts in flight plus the one being filled. Caps the part size, and with it the
+        # biggest object that fits in the part limit (256MiB over 5 parts: ~50MiB parts, objects up to ~400GiB).
+        self.max_part = max(MIN_PART_SIZE, upload_buffer // (upload_concurrency + 1))
+        self.s3 = boto3.client(
+            's3',
+            config=botocore.config.Config(max_pool_connections=max(upload_concurrency, 10)),
+        )
+        self.index: typing.Optional[hashbak.index.HashIndex] = None
 
     @staticmethod
     def _meta_name(name: str):
         return f'hashbak/snapshots/{name}'
 
+    @staticmethod
+    def _meta_index_name(name: str):
+        return f'hashbak/snapshot-index/{name}'
+
     @staticmethod
     def _file_name(fhash: bytes):
         return f'hashbak/file/{fhash.hex()}'
@@ -144,12 +236,42 @@ class EncryptedS3Storage(base.RemoteStorage):
     def _restore_name(fhash: bytes):
         return EncryptedS3Storage._file_name(fhash)
 
+    @staticmethod
+    def _report_name(name: str):
+        return f'hashbak/reports/{name}'
+
+    @staticmethod
+    def _pack_name(pack_id: str):
+        return f'hashbak/pack/{pack_id}'
+
+    @staticmethod
+    def _pack_index_name(pack_id: str):
+        return f'hashbak/pack-index/{pack_id}'
+
+    @staticmethod
+    def _lock_name(name: str):
+        return f'hashbak/locks/{name}'
+
+    def _read_range(self, key: str, offset: int, size: int) -> bytes:
+        try:
+            response = self.s3.get_object(
+                Bucket=self.bucket,
+                Key=key,
+                Range=f'bytes={offset}-{offset + size - 1}',
+            )
+        except botocore.exceptions.ClientError as e:
+            # Asking for a range that starts past the end
+            if e.response.get('Error', {}).get('Code') == 'InvalidRange':
+                return b''
+            raise
+        return response['Body'].read()
+
     def upload_meta(self, name: str, contents: typing.Iterable[bytes]) -> None:
         iv = str_hash(name)[:16]
         enc = self._encrypt(contents, self.aes_key, iv)
         key = self._meta_name(name)
-        parts = hashbak.stream.paginate(enc, 10*(1024**2))
-        with S3Multipart(bucket=self.bucket, key=key, storage_class='STANDARD', client=self.s3) as multipart:
+        parts = hashbak.stream.repaginate(enc, part_sizes(max_part=self.max_part))
+        with S3Multipart(bucket=self.bucket, key=key, storage_class='STANDARD', client=self.s3, concurrency=self.upload_concurrency) as multipart:
             for part in parts:
                 multipart.add_chunk(part)
 
@@ -160,10 +282,11 @@ class EncryptedS3Storage(base.RemoteStorage):
             Delimiter='/',
             Prefix=self._meta_name(''),
         )
+        prefix = self._meta_name('')
         res = []
         for entry in response_iterator:
-            for x in entry['Contents']:
-                res.append(x['Key'])
+            for x in entry.get('Contents', []):
+                res.append(x['Key'].removeprefix(prefix))
         return res
 
     def get_meta(self, name: str) -> typing.Iterable[bytes]:
@@ -172,7 +295,164 @@ class EncryptedS3Storage(base.RemoteStorage):
         dl.thread()
         return self._decrypt(dl.stream(), self.aes_key)
 
+    def _list(self, prefix: str) -> typing.Iterable[dict]:
+        paginator = self.s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            yield from page.get('Contents', [])
+
+    def load_index(self) -> None:
+        index = hashbak.index.HashIndex()
+        prefix = self._file_name(b'')
+        for obj in self._list(prefix):
+            try:
+                index.add(bytes.fromhex(obj['Key'].removeprefix(prefix)))
+            except ValueError:
+                continue
+        self.index = index
+        logger.info(f'Indexed {len(index)} remote files (exact: {index.exact})')
+
+    def list_objects(self) -> typing.Iterable[hashbak.catalog.ObjectInfo]:
+        prefix = self._file_name(b'')
+        for obj in self._list(prefix):
+            try:
+                fhash = bytes.fromhex(obj['Key'].removeprefix(prefix))
+            except ValueError:
+                continue
+            yield hashbak.catalog.ObjectInfo(
+                fhash,
+                size=obj['Size'],
+                storage_class=obj.get('StorageClass', 'STANDARD'),
+                uploaded=obj['LastModified'].timestamp(),
+            )
+
+    def upload_snapshot(self, name: str, blocks: typing.Iterable[bytes]) -> None:
+        parts = hashbak.stream.repaginate(blocks, part_sizes(max_part=self.max_part))
+        with S3Multipart(bucket=self.bucket, key=self._meta_name(name), storage_class='STANDARD', client=self.s3, concurrency=self.upload_concurrency) as multipart:
+            for part in parts:
+                multipart.add_chunk(part)
+
+    def upload_snapshot_index(self, name: str, index: bytes) -> None:
+        self.s3.put_object(
+            Bucket=self.bucket,
+            Key=self._meta_index_name(name),
+            Body=self.seal(index),
+        )
+
+    def get_snapshot_index(self, name: str) -> typing.Optional[bytes]:
+        try:
+            response = self.s3.get_object(
+                Bucket=self.bucket,
+                Key=self._meta_index_name(name),
+            )
+        except botocore.exceptions.ClientError as e:
+            if e.response.get('Error', {}).get('Code') in {'NoSuchKey', '404'}:
+                return None
+            raise
+        return self.unseal(response['Body'].read())
+
+    def get_snapshot_range(self, name: str, offset: int, size: int) -> bytes:
+        return self._read_range(self._meta_name(name), offset, size)
+
+    def get_snapshot_raw(self, name: str) -> typing.Iterable[bytes]:
+        dl = ThreadBufferedS3Download(self.s3, self.bucket, self._meta_name(name))
+        dl.thread()
+        return dl.stream()
+
+    def upload_report(self, name: str, report: bytes) -> None:
+        self.s3.put_object(
+            Bucket=self.bucket,
+            Key=self._report_name(name),
+            Body=self.seal(report),
+        )
+
+    def get_report(self, name: str) -> typing.Optional[bytes]:
+        try:
+            response = self.s3.get_object(
+                Bucket=self.bucket,
+                Key=self._report_name(name),
+            )
+        except botocore.exceptions.ClientError as e:
+            if e.response.get('Error', {}).get('Code') in {'NoSuchKey', '404'}:
+                return None
+            raise
+        return self.unseal(response['Body'].read())
+
+    def upload_pack(self, pack_id: str, contents: typing.Iterable[bytes]) -> None:
+        parts = hashbak.stream.repaginate(contents, part_sizes(max_part=self.max_part))
+        with S3Multipart(bucket=self.bucket, key=self._pack_name(pack_id), storage_class=self.archive_class, client=self.s3, concurrency=self.upload_concurrency) as multipart:
+            for part in parts:
+                multipart.add_chunk(part)
+
+    def upload_pack_index(self, pack_id: str, index: bytes) -> None:
+        self.s3.put_object(
+            Bucket=self.bucket,
+            Key=self._pack_index_name(pack_id),
+            Body=self.seal(index),
+        )
+
+    def list_packs(self) -> [str]:
+        prefix = self._pack_index_name('')
+        return [obj['Key'].removeprefix(prefix) for obj in self._list(prefix)]
+
+    def get_pack_index(self, pack_id: str) -> bytes:
+        response = self.s3.get_object(
+            Bucket=self.bucket,
+            Key=self._pack_index_name(pack_id),
+        )
+        return self.unseal(response['Body'].read())
+
+    def get_pack_range(self, pack_id: str, offset: int, size: int) -> bytes:
+        return self._read_range(self._pack_name(pack_id), offset, size)
+
+    def list_pack_objects(self) -> typing.Iterable[hashbak.catalog.ObjectInfo]:
+        prefix = self._pack_name('')
+        for obj in self._list(prefix):
+            yield hashbak.catalog.ObjectInfo(
+                b'',
+                size=obj['Size'],
+                storage_class=obj.get('StorageClass', 'STANDARD'),
+                uploaded=obj['LastModified'].timestamp(),
+                pack=obj['Key'].removeprefix(prefix),
+            )
+
+    def _delete_keys(self, keys: [str]) -> None:
+        if not keys:
+            return
+        response = self.s3.delete_objects(
+            Bucket=self.bucket,
+            Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True},
+        )
+        errors = response.get('Errors', [])
+        if errors:
+            raise RuntimeError(f'Failed to delete {len(errors)} objects, e.g. {errors[0]["Key"]}: {errors[0].get("Message")}')
+
+    def delete_packs(self, pack_ids: [str]) -> None:
+        self._delete_keys([self._pack_index_name(pack_id) for pack_id in pack_ids])
+        self._delete_keys([self._pack_name(pack_id) for pack_id in pack_ids])
+
+    def request_pack_restore(self, pack_id: str) -> None:
+        self._request_key_restore(self._pack_name(pack_id))
+
+    def put_lock(self, name: str) -> None:
+        self.s3.put_object(Bucket=self.bucket, Key=self._lock_name(name), Body=b'')
+
+    def list_locks(self) -> typing.Dict[str, float]:
+        prefix = self._lock_name('')
+        return {obj['Key'].removeprefix(prefix): obj['LastModified'].timestamp() for obj in self._list(prefix)}
+
+    def delete_lock(self, name: str) -> None:
+        self._delete_keys([self._lock_name(name)])
+
+    def pack_restore_status(self, pack_id: str) -> base.RestoreStatus:
+        return self._key_restore_status(self._pack_name(pack_id))
+
     def file_exists(self, fhash: bytes) -> bool:
+        if self.index is not None:
+            if fhash not in self.index:
+                return False
+            if self.index.exact:
+                return True
+            # bloom filter hit, could be a false positive
         try:
             self.s3.head_object(
                 Bucket=self.bucket,
@@ -182,30 +462,47 @@ class EncryptedS3Storage(base.RemoteStorage):
         except botocore.exceptions.ClientError:
             return False
 
-    def upload_file(self, fhash: bytes, contents: typing.Iterable[bytes]) -> None:
-        enc = self._encrypt(contents, self.aes_key, fhash[:16])
-        # This will break if we go above 100Gi (AWS maxes at 10_000 parts)
-        parts = hashbak.stream.paginate(enc, 10*(1024**2))
-        with S3Multipart(bucket=self.bucket, key=self._file_name(fhash), storage_class='GLACIER', client=self.s3) as multipart:
+    def delete_objects(self, fhashes: [bytes]) -> None:
+        self._delete_keys([self._file_name(fhash) for fhash in fhashes])
+        # Can't take things back out of a bloom filter, and a stale "exists" would mean dedup against nothing
+        self.index = None
+
+    @staticmethod
+    def _expected_size(fname: typing.Optional[str]) -> typing.Optional[int]:
+        # fname is only a hint, but usually the file being uploaded (or one the upload is a chunk of: an overestimate)
+        try:
+            return os.path.getsize(fname) if fname else None
+        except OSError:
+            return None
+
+    def upload_file(self, fhash: bytes, contents: typing.Iterable[bytes], fname: typing.Optional[str] = None) -> None:
+        info = hashbak.catalog.ObjectInfo(fhash, storage_class=self.archive_class)
+        enc = self._encrypt(contents, self.aes_key, fhash[:16], fname, info)
+        parts = hashbak.stream.repaginate(enc, part_sizes(self._expected_size(fname), self.max_part))
+        with S3Multipart(bucket=self.bucket, key=self._file_name(fhash), storage_class=self.archive_class, client=self.s3, concurrency=self.upload_concurrency) as multipart:
             for part in parts:
                 multipart.add_chunk(part)
+        if self.index is not None:
+            self.index.add(fhash)
+        self._uploaded(info)
 
-    def _test_restore(self, fhash: bytes) -> RestoreStatus:
-        key = self._restore_name(fhash)
+    def _key_restore_status(self, key: str) -> base.RestoreStatus:
         response = self.s3.head_object(
             Bucket=self.bucket,
             Key=key,
         )
-        if 'Restore' not in response:
-            return RestoreStatus.none
+        if response.get('StorageClass') not in ARCHIVE_CLASSES:
+            # Never archived (or already moved back out), readable as is
+            return base.RestoreStatus.complete
+        elif 'Restore' not in response:
+            return base.RestoreStatus.none
         elif '''ongoing-request="false"''' in response["Restore"]:
-            return RestoreStatus.complete
+            return base.RestoreStatus.complete
         else:
-            return RestoreStatus.progress
+            return base.RestoreStatus.progress
 
-    def request_restore(self, fhash: bytes) -> None:
-        key = self._restore_name(fhash)
-        if self._test_restore(fhash) == RestoreStatus.none:
+    def _request_key_restore(self, key: str) -> None:
+        if self._key_restore_status(key) == base.RestoreStatus.none:
             response = self.s3.restore_object(
                 Bucket=self.bucket,
                 Key=key,
@@ -217,15 +514,24 @@ class EncryptedS3Storage(base.RemoteStorage):
                 },
             )
 
+    def restore_status(self, fhash: bytes) -> base.RestoreStatus:
+        return self._key_restore_status(self._restore_name(fhash))
+
+    def request_restore(self, fhash: bytes) -> None:
+        self._request_key_restore(self._restore_name(fhash))
+
     def await_restore(self, fhash: bytes) -> None:
         while True:
-            status = self._test_restore(fhash)
-            if status == RestoreStatus.complete:
+            status = self.restore_status(fhash)
+            if status == base.RestoreStatus.complete:
                 return
             else:
-                assert status == RestoreStatus.progress
+                assert status == base.RestoreStatus.progress
                 time.sleep(60)
 
+    def _restored_range(self, fhash: bytes, offset: int, size: int) -> bytes:
+        return self._read_range(self._restore_name(fhash), offset, size)
+
     def get_restored_file(self, fhash: bytes) -> typing.Iterable[bytes]:
         key = self._restore_name(fhash)
         dl = ThreadBufferedS3Download(self.s3, self.bucket, key)
@@ -0,0 +1,131 @@
+import concurrent.futures
+import logging
+import os
+import typing
+
+import hashbak.fmeta
+import hashbak.hashcache
+import hashbak.parallel
+import hashbak.remote
+import hashbak.stream
+
+
+logger = logging.getLogger(__name__)
+
+
+# Rough in-flight memory for one object being restored: download queue, decrypt / decompress buffers, a page or two.
+# Only used to divide up the memory budget, so it doesn't have to be exact.
+STREAM_MEMORY = 8 * hashbak.stream.PAGE_SIZE
+
+
+def stored_objects(meta: hashbak.fmeta.FMeta) -> [bytes]:
+    # Hashes of the remote objects that hold this file's contents
+    if meta.ftype == hashbak.fmeta.FileType.chunked:
+        return meta.chunks
+    elif meta.ftype == hashbak.fmeta.FileType.file:
+        return [meta.fhash]
+    else:
+        return []
+
+
+def restored_contents(meta: hashbak.fmeta.FMeta, storage: hashbak.remote.RemoteStorage) -> typing.Iterable[bytes]:
+    # Lazy, so only one object is being downloaded at a time
+    for fhash in stored_objects(meta):
+        yield from storage.get_restored_file(fhash)
+
+
+class Restorer:
+    """
+    Writes a snapshot back to disk: directories and links up front (prepare), file contents up to `workers` at a
+    time (submit), then hardlinks, ownership + permissions in one last pass (finish)
+
+    Attributes go last so a read-only directory doesn't block writing its contents, and so chown/chmod don't sit in
+    between downloads. In-flight files share a memory budget: small ones only reserve about their own size, so lots
+    of them can go at once.
+    """
+
+    def __init__(
+            self,
+            storage: hashbak.remote.RemoteStorage,
+            root: str,
+            hash_salt: bytes,
+            cache: typing.Optional[hashbak.hashcache.HashCache] = None,
+            workers: int = 1,
+            memory_budget: int = 512 * (1024**2),
+    ):
+        self.storage = storage
+        self.root = os.path.abspath(root)
+        self.hash_salt = hash_salt
+        self.cache = cache
+        self.executor = hashbak.parallel.make_executor(workers, 'thread')
+        self.budget = hashbak.parallel.ByteBudget(memory_budget)
+        self.futures: typing.List[concurrent.futures.Future] = []
+        # (hardlink, FMeta of the name it links to)
+        self.hardlinks: typing.List[typing.Tuple[hashbak.fmeta.FMeta, hashbak.fmeta.FMeta]] = []
+
+    def __enter__(self) -> 'Restorer':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+
+    def prepare(self, metas: [hashbak.fmeta.FMeta]) -> [hashbak.fmeta.FMeta]:
+        # -> the regular files whose contents still need writing
+        # Snapshots are sorted by path, so files at the top level can come before any directory creates the root
+        os.makedirs(self.root, exist_ok=True)
+        todo = []
+        firsts = {}
+        for meta in metas:
+            if meta.ftype == hashbak.fmeta.FileType.directory:
+                meta.to_file(self.hash_salt, root=self.root, attrs=False)
+        for meta in metas:
+            if meta.ftype != hashbak.fmeta.FileType.directory:
+                # For a filtered restore the parent directory might not have been picked
+                os.makedirs(os.path.dirname(self.root + meta.fname), exist_ok=True)
+            if meta.ftype == hashbak.fmeta.FileType.link:
+                meta.to_file(self.hash_salt, root=self.root, attrs=False)
+            elif meta.link_key in firsts:
+                # Hardlinked: only the first name gets contents, the rest get linked to it in finish()
+                self.hardlinks.append((meta, firsts[meta.link_key]))
+                continue
+            if meta.link_key is not None:
+                firsts[meta.link_key] = meta
+            # Checked here rather than in the workers: the hash cache has to stay on this thread
+            if meta.ftype.regular and not meta.test(self.root, self.hash_salt, self.cache):
+                todo.append(meta)
+        return todo
+
+    def _write(self, meta: hashbak.fmeta.FMeta, reserved: int):
+        try:
+            logger.info(f'Restoring file {meta.fname}')
+            meta.write_contents(restored_contents(meta, self.storage), self.root)
+        finally:
+            self.budget.release(reserved)
+
+    def submit(self, meta: hashbak.fmeta.FMeta) -> None:
+        # Size 0 is either an empty file or an old snapshot that didn't record it, assume the worst
+        want = min(max(meta.size, hashbak.stream.PAGE_SIZE), STREAM_MEMORY) if meta.size else STREAM_MEMORY
+        reserved = self.budget.acquire(want)
+        if self.executor is None:
+            self._write(meta, reserved)
+            return
+        self.futures.append(self.executor.submit(self._write, meta, reserved))
+        # Fail fast, rather than finding out once everything else has downloaded
+        while self.futures and self.futures[0].done():
+            self.futures.pop(0).result()
+
+    def finish(self, metas: [hashbak.fmeta.FMeta]) -> None:
+        for fut in self.futures:
+            fut.result()
+        self.futures = []
+        for meta, first in self.hardlinks:
+            fpath, target = self.root + meta.fname, self.root + first.fname
+            if os.path.lexists(fpath):
+                if os.path.samefile(fpath, target):
+                    continue
+                os.remove(fpath)
+            os.link(target, fpath)
+        # Deepest paths first, so a directory only goes read-only once everything inside it is done
+        for meta in reversed(metas):
+            meta.apply_attrs(self.root)
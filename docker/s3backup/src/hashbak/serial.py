@@ -100,3 +100,35 @@ class Serial:
     @staticmethod
     def read_str(buf: io.BytesIO) -> str:
         return Serial.read_dyn_bytes(buf).decode('utf-8')
+
+
+# Varints (LEB128) for the compact snapshot format. Signed values go through zigzag first so small negatives stay small.
+
+def encode_varint(x: int) -> bytes:
+    res = bytearray()
+    while x > 0x7f:
+        res.append((x & 0x7f) | 0x80)
+        x >>= 7
+    res.append(x)
+    return bytes(res)
+
+
+def decode_varint(buf: bytes, pos: int) -> (int, int):
+    # -> (value, position after it)
+    res = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        res |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return res, pos
+        shift += 7
+
+
+def zigzag(x: int) -> int:
+    return x * 2 if x >= 0 else -x * 2 - 1
+
+
+def unzigzag(x: int) -> int:
+    return x >> 1 if not x & 1 else -((x + 1) >> 1)
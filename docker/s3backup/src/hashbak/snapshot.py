@@ -0,0 +1,454 @@
+import bisect
+import dataclasses
+import fnmatch
+import logging
+import os
+import typing
+
+import hashbak.fmeta
+import hashbak.remote
+import hashbak.serial
+import hashbak.stream
+
+
+logger = logging.getLogger(__name__)
+
+
+# Snapshot format v2
+#
+# Data object: DATA_MAGIC (plaintext), then independently sealed blocks, back to back. Each block (before sealing) is a run of records, sorted by
+# path across the whole snapshot:
+#     varint shared | varint suffix length | suffix | varint body length | body
+# where `shared` is how many leading bytes of the path are the same as the previous record's (0 for the first record
+# of a block, so every block decodes on its own). The body is a list of protobuf-style fields:
+#     varint (tag << 1 | wire type) | value
+# wire type 0 is a zigzag varint, 1 is varint length + bytes. Unknown tags get skipped, so fields can be added later.
+#
+# Index object: magic, then per block: first path, offset and length in the data object, and record count. Enough to
+# find the blocks covering a path (or subtree) and range-read just those.
+#
+# The index goes up last. The original flat stream of FMeta.write records is still readable: a snapshot without an
+# index object is one of those, unless its data starts with DATA_MAGIC -- then it's a v2 upload that never finished,
+# and there's no reading it (blocks don't say where they end). v2 data written before the magic was added starts
+# straight with the first block; the index offsets say where that is either way.
+
+INDEX_MAGIC = b'HBSNAPIX'
+DATA_MAGIC = b'HBSNAPV2'
+VERSION = 2
+
+# Plaintext bytes per block. Smaller means more precise lookups, bigger means better compression and fewer requests.
+BLOCK_SIZE = 256 * 1024
+
+WIRE_INT = 0
+WIRE_BYTES = 1
+
+TAG_FTYPE = 1
+TAG_FHASH = 2
+TAG_INO = 3
+TAG_UID = 4
+TAG_GID = 5
+TAG_MODE = 6
+TAG_CHUNK = 7  # repeated, in order
+TAG_SIZE = 8
+TAG_MTIME = 9
+TAG_DEV = 10
+TAG_NLINK = 11
+
+
+def _encode_path(fname: str) -> bytes:
+    # surrogateescape: paths that aren't valid utf-8 still round trip
+    return fname.encode('utf-8', 'surrogateescape')
+
+
+def _decode_path(path: bytes) -> str:
+    return path.decode('utf-8', 'surrogateescape')
+
+
+def _int_field(tag: int, x: int) -> bytes:
+    return hashbak.serial.encode_varint(tag << 1 | WIRE_INT) + hashbak.serial.encode_varint(hashbak.serial.zigzag(x))
+
+
+def _bytes_field(tag: int, x: bytes) -> bytes:
+    return hashbak.serial.encode_varint(tag << 1 | WIRE_BYTES) + hashbak.serial.encode_varint(len(x)) + x
+
+
+def encode_meta(meta: hashbak.fmeta.FMeta) -> (bytes, bytes):
+    # -> (path, body)
+    fields = [
+        _int_field(TAG_FTYPE, hashbak.fmeta.FileType._byte_code()[meta.ftype][0]),
+        _bytes_field(TAG_FHASH, meta.fhash),
+        _int_field(TAG_INO, meta.ino),
+        _int_field(TAG_UID, meta.uid),
+        _int_field(TAG_GID, meta.gid),
+        _int_field(TAG_MODE, meta.mode),
+        _int_field(TAG_SIZE, meta.size),
+        _int_field(TAG_MTIME, meta.mtime_ns),
+        _int_field(TAG_DEV, meta.dev),
+        _int_field(TAG_NLINK, meta.nlink),
+    ]
+    for chunk in meta.chunks or []:
+        fields.append(_bytes_field(TAG_CHUNK, chunk))
+    return _encode_path(meta.fname), b''.join(fields)
+
+
+def decode_meta(path: bytes, body: bytes) -> hashbak.fmeta.FMeta:
+    rev_code = {v[0]: k for k, v in hashbak.fmeta.FileType._byte_code().items()}
+    ints = {}
+    fhash = b''
+    chunks = []
+    pos = 0
+    while pos < len(body):
+        key, pos = hashbak.serial.decode_varint(body, pos)
+        tag, wire = key >> 1, key & 1
+        if wire == WIRE_INT:
+            x, pos = hashbak.serial.decode_varint(body, pos)
+            ints[tag] = hashbak.serial.unzigzag(x)
+        else:
+            n, pos = hashbak.serial.decode_varint(body, pos)
+            x = body[pos:pos + n]
+            pos += n
+            if tag == TAG_FHASH:
+                fhash = x
+            elif tag == TAG_CHUNK:
+                chunks.append(x)
+    ftype = rev_code[ints[TAG_FTYPE]]
+    return hashbak.fmeta.FMeta(
+        fname=_decode_path(path),
+        ftype=ftype,
+        fhash=fhash,
+        ino=ints.get(TAG_INO, 0),
+        uid=ints.get(TAG_UID, 0),
+        gid=ints.get(TAG_GID, 0),
+        mode=ints.get(TAG_MODE, 0),
+        chunks=chunks if ftype == hashbak.fmeta.FileType.chunked else None,
+        size=ints.get(TAG_SIZE, 0),
+        mtime_ns=ints.get(TAG_MTIME, 0),
+        dev=ints.get(TAG_DEV, 0),
+        nlink=ints.get(TAG_NLINK, 0),
+    )
+
+
+def decode_block(block: bytes) -> typing.Iterable[typing.Tuple[bytes, bytes]]:
+    # -> (path, body) for each record
+    prev = b''
+    pos = 0
+    while pos < len(block):
+        shared, pos = hashbak.serial.decode_varint(block, pos)
+        n, pos = hashbak.serial.decode_varint(block, pos)
+        path = prev[:shared] + block[pos:pos + n]
+        pos += n
+        n, pos = hashbak.serial.decode_varint(block, pos)
+        yield path, block[pos:pos + n]
+        pos += n
+        prev = path
+
+
+@dataclasses.dataclass
+class BlockRef:
+    first: bytes
+    offset: int
+    length: int
+    count: int
+
+
+def encode_index(blocks: [BlockRef]) -> bytes:
+    res = [INDEX_MAGIC, hashbak.serial.encode_varint(VERSION), hashbak.serial.encode_varint(len(blocks))]
+    for block in blocks:
+        res.append(hashbak.serial.encode_varint(len(block.first)))
+        res.append(block.first)
+        res.append(hashbak.serial.encode_varint(block.offset))
+        res.append(hashbak.serial.encode_varint(block.length))
+        res.append(hashbak.serial.encode_varint(block.count))
+    return b''.join(res)
+
+
+def decode_index(data: bytes) -> [BlockRef]:
+    if not data.startswith(INDEX_MAGIC):
+        raise ValueError('Not a snapshot index')
+    pos = len(INDEX_MAGIC)
+    version, pos = hashbak.serial.decode_varint(data, pos)
+    if version != VERSION:
+        raise ValueError(f'Unsupported snapshot version {version}')
+    n, pos = hashbak.serial.decode_varint(data, pos)
+    res = []
+    for _ in range(n):
+        flen, pos = hashbak.serial.decode_varint(data, pos)
+        first = data[pos:pos + flen]
+        pos += flen
+        offset, pos = hashbak.serial.decode_varint(data, pos)
+        length, pos = hashbak.serial.decode_varint(data, pos)
+        count, pos = hashbak.serial.decode_varint(data, pos)
+        res.append(BlockRef(first, offset, length, count))
+    return res
+
+
+def in_subtree(fname: str, prefix: typing.Optional[str]) -> bool:
+    if prefix is None:
+        return True
+    prefix = prefix.rstrip('/')
+    return fname == prefix or fname.startswith(prefix + '/')
+
+
+def rooted(pattern: str) -> str:
+    # Snapshot paths all start with /, so "photos/*.jpg" would never match anything: it means /photos/*.jpg.
+    # A leading * already matches the /.
+    return pattern if pattern.startswith(('/', '*')) else '/' + pattern
+
+
+def _glob_match(fname: str, pattern: str) -> bool:
+    # A pattern that matches a directory matches everything under it too
+    return fnmatch.fnmatchcase(fname, pattern) or fnmatch.fnmatchcase(fname, pattern.rstrip('/') + '/*')
+
+
+class PathFilter:
+    """
+    Which paths (relative to the backup root, e.g. /photos/2020/a.jpg) to pick out of a snapshot
+
+    path: only this file / subtree. include: globs, keep paths matching any of them (all paths if none). exclude:
+    globs, drop paths matching any of them. `*` matches across `/`. A path or glob without the leading `/` gets one.
+    """
+
+    def __init__(self, path: typing.Optional[str] = None, include: typing.Sequence[str] = (), exclude: typing.Sequence[str] = ()):
+        self.path = None if path is None else rooted(path)
+        self.include = [rooted(pat) for pat in include]
+        self.exclude = [rooted(pat) for pat in exclude]
+
+    def __call__(self, fname: str) -> bool:
+        if not in_subtree(fname, self.path):
+            return False
+        if self.include and not any(_glob_match(fname, pat) for pat in self.include):
+            return False
+        return not any(_glob_match(fname, pat) for pat in self.exclude)
+
+    @property
+    def prefix(self) -> typing.Optional[str]:
+        # A subtree every match has to be in, so the reader can skip straight to the blocks covering it
+        if self.path is not None:
+            return self.path
+        if not self.include:
+            return None
+        dirs = []
+        for pat in self.include:
+            literal = pat
+            for i, c in enumerate(pat):
+                if c in '*?[':
+                    literal = os.path.dirname(pat[:i])
+                    break
+            dirs.append(literal)
+        common = os.path.commonpath(dirs) if all(d.startswith('/') for d in dirs) else '/'
+        return None if common in {'', '/'} else common
+
+
+class SnapshotWriter:
+    """
+    Collects FMeta for a snapshot, then sorts them and uploads in the block format
+
+    Sorting means holding every (encoded) record in memory until the end -- on the order of 100 bytes per file.
+    """
+
+    def __init__(self, block_size: int = BLOCK_SIZE):
+        self.block_size = block_size
+        self.records = []
+
+    def add(self, meta: hashbak.fmeta.FMeta) -> None:
+        self.records.append(encode_meta(meta))
+
+    def _blocks(self) -> typing.Iterable[typing.Tuple[bytes, int, bytes]]:
+        # -> (first path, record count, plaintext block)
+        self.records.sort(key=lambda rec: rec[0])
+        buf = []
+        size = 0
+        first = b''
+        prev = b''
+        count = 0
+        for path, body in self.records:
+            if count == 0:
+                first = path
+                prev = b''
+            shared = 0
+            limit = min(len(prev), len(path))
+            while shared < limit and prev[shared] == path[shared]:
+                shared += 1
+            rec = b''.join([
+                hashbak.serial.encode_varint(shared),
+                hashbak.serial.encode_varint(len(path) - shared),
+                path[shared:],
+                hashbak.serial.encode_varint(len(body)),
+                body,
+            ])
+            buf.append(rec)
+            size += len(rec)
+            count += 1
+            prev = path
+            if size >= self.block_size:
+                yield first, count, b''.join(buf)
+                buf = []
+                size = 0
+                count = 0
+        if count or not self.records:
+            # Always at least one block, even for an empty snapshot
+            yield first, count, b''.join(buf)
+
+    def upload(self, storage: hashbak.remote.RemoteStorage, name: str) -> None:
+        refs = []
+
+        def sealed():
+            yield DATA_MAGIC
+            offset = len(DATA_MAGIC)
+            for first, count, block in self._blocks():
+                data = storage.seal(block)
+                refs.append(BlockRef(first, offset, len(data), count))
+                offset += len(data)
+                yield data
+
+        storage.upload_snapshot(name, sealed())
+        storage.upload_snapshot_index(name, encode_index(refs))
+
+
+class IncompleteSnapshot(ValueError):
+    pass
+
+
+def _half_written(storage: hashbak.remote.RemoteStorage, name: str) -> bool:
+    # Only meaningful when there's no index: v2 data, so not a legacy snapshot
+    return storage.get_snapshot_range(name, 0, len(DATA_MAGIC)) == DATA_MAGIC
+
+
+def complete(storage: hashbak.remote.RemoteStorage, name: str) -> bool:
+    return storage.get_snapshot_index(name) is not None or not _half_written(storage, name)
+
+
+class Snapshot:
+    def __init__(self, storage: hashbak.remote.RemoteStorage, name: str):
+        self.storage = storage
+        self.name = name
+        index = storage.get_snapshot_index(name)
+        if index is None and _half_written(storage, name):
+            raise IncompleteSnapshot(f'Snapshot {name} never finished uploading (no index)')
+        self.blocks: typing.Optional[typing.List[BlockRef]] = None if index is None else decode_index(index)
+
+    @property
+    def legacy(self) -> bool:
+        return self.blocks is None
+
+    def _select(self, prefix: str) -> [BlockRef]:
+        # Blocks that could hold paths starting with prefix: from the last block starting at or before it, through
+        # every following block that still starts inside it
+        key = _encode_path(prefix.rstrip('/'))
+        firsts = [block.first for block in self.blocks]
+        lo = max(bisect.bisect_right(firsts, key) - 1, 0)
+        hi = lo + 1
+        while hi < len(self.blocks) and self.blocks[hi].first.startswith(key):
+            hi += 1
+        return self.blocks[lo:hi]
+
+    def _read_blocks(self, blocks: [BlockRef]) -> typing.Iterable[bytes]:
+        # Consecutive blocks get fetched with a single range read
+        run = []
+        for block in blocks + [None]:
+            if run and (block is None or block.offset != run[-1].offset + run[-1].length):
+                start = run[0].offset
+                data = self.storage.get_snapshot_range(self.name, start, run[-1].offset + run[-1].length - start)
+                for ref in run:
+                    yield self.storage.unseal(data[ref.offset - start:ref.offset - start + ref.length])
+                run = []
+            if block is not None:
+                run.append(block)
+
+    def _scan_blocks(self) -> typing.Iterable[bytes]:
+        # Whole snapshot: one streaming download rather than a request per block
+        raw = hashbak.stream.IterIO(self.storage.get_snapshot_raw(self.name))
+        if self.blocks:
+            raw.read(self.blocks[0].offset)
+        for ref in self.blocks:
+            yield self.storage.unseal(raw.read(ref.length))
+
+    def metas(self, prefix: typing.Optional[str] = None, match: typing.Optional[typing.Callable[[str], bool]] = None) -> typing.Iterable[hashbak.fmeta.FMeta]:
+        # prefix: subtree, picks which blocks get read at all. match: checked against each path before the rest of
+        # the record gets decoded.
+        if self.legacy:
+            for meta in hashbak.fmeta.iter_meta(self.storage.get_meta(self.name)):
+                if in_subtree(meta.fname, prefix) and (match is None or match(meta.fname)):
+                    yield meta
+            return
+
+        blocks = self._scan_blocks() if prefix is None else self._read_blocks(self._select(prefix))
+        for block in blocks:
+            for path, body in decode_block(block):
+                if prefix is None and match is None:
+                    yield decode_meta(path, body)
+                    continue
+                fname = _decode_path(path)
+                if in_subtree(fname, prefix) and (match is None or match(fname)):
+                    yield decode_meta(path, body)
+
+
+def complete_snapshots(storage: hashbak.remote.RemoteStorage) -> ([str], [str]):
+    # -> (readable snapshots, half-written ones), both sorted
+    done, incomplete = [], []
+    for name in sorted(storage.list_meta()):
+        (done if complete(storage, name) else incomplete).append(name)
+    for name in incomplete:
+        logger.warning(f'Skipping snapshot {name}: never finished uploading')
+    return done, incomplete
+
+
+def latest(storage: hashbak.remote.RemoteStorage) -> typing.Optional[str]:
+    # Snapshot names are timestamps (see hashbak.entrypoints.backup), so they sort in time order. Newest one that
+    # finished uploading.
+    for name in sorted(storage.list_meta(), reverse=True):
+        if complete(storage, name):
+            return name
+        logger.warning(f'Skipping snapshot {name}: never finished uploading')
+    return None
+
+
+@dataclasses.dataclass
+class SnapshotDiff:
+    added: int = 0
+    added_bytes: int = 0
+    changed: int = 0
+    changed_bytes: int = 0
+    removed: int = 0
+    removed_bytes: int = 0
+    carried: int = 0
+
+    @staticmethod
+    def _bytes(meta: hashbak.fmeta.FMeta) -> int:
+        return meta.size if meta.ftype.regular else 0
+
+    @staticmethod
+    def _same(a: hashbak.fmeta.FMeta, b: hashbak.fmeta.FMeta) -> bool:
+        # file vs chunked is just a storage detail
+        same_type = a.ftype == b.ftype or (a.ftype.regular and b.ftype.regular)
+        return same_type and (a.fhash, a.mode, a.uid, a.gid) == (b.fhash, b.mode, b.uid, b.gid)
+
+    def record(self, prev: typing.Optional[hashbak.fmeta.FMeta], cur: typing.Optional[hashbak.fmeta.FMeta]) -> None:
+        # A path that got looked at again (prev -> cur), or dropped out (cur=None)
+        if prev is None:
+            self.added += 1
+            self.added_bytes += self._bytes(cur)
+        elif cur is None:
+            self.removed += 1
+            self.removed_bytes += self._bytes(prev)
+        elif not self._same(prev, cur):
+            self.changed += 1
+            self.changed_bytes += self._bytes(cur)
+
+    def __str__(self):
+        return (
+            f'{self.added} added ({self.added_bytes} bytes), '
+            f'{self.changed} changed ({self.changed_bytes} bytes), '
+            f'{self.removed} removed ({self.removed_bytes} bytes), '
+            f'{self.carried} carried over unchanged'
+        )
+
+
+def iter_snapshot(storage: hashbak.remote.RemoteStorage, name: str, prefix: typing.Optional[str] = None, match: typing.Optional[typing.Callable[[str], bool]] = None) -> typing.Iterable[hashbak.fmeta.FMeta]:
+    return Snapshot(storage, name).metas(None if prefix is None else rooted(prefix), match)
+
+
+def iter_filtered(storage: hashbak.remote.RemoteStorage, name: str, path_filter: typing.Optional[PathFilter] = None) -> typing.Iterable[hashbak.fmeta.FMeta]:
+    if path_filter is None:
+        return iter_snapshot(storage, name)
+    return iter_snapshot(storage, name, path_filter.prefix, path_filter)
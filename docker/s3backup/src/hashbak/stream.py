@@ -1,10 +1,18 @@
+import concurrent.futures
 import cryptography.hazmat.primitives.ciphers
+import cryptography.hazmat.primitives.ciphers.aead
 import cryptography.hazmat.primitives.ciphers.algorithms
 import cryptography.hazmat.primitives.ciphers.modes
-import io
-import gzip as _gzip
+import cryptography.hazmat.primitives.hashes
+import cryptography.hazmat.primitives.kdf.hkdf
+import itertools
+import os
+import time
 import typing
 
+import hashbak.codec
+import hashbak.metrics
+import hashbak.parallel
 import hashbak.serial
 
 
@@ -14,51 +22,86 @@ PAGE_SIZE = 4 * (1024**2)
 
 def file(fname: str) -> typing.Iterable[bytes]:
     with open(fname, 'rb') as in_f:
-        while nxt := in_f.read(PAGE_SIZE):
+        while True:
+            start, cpu = time.perf_counter(), time.thread_time()
+            nxt = in_f.read(PAGE_SIZE)
+            if not nxt:
+                return
+            hashbak.metrics.record('read', time.perf_counter() - start, len(nxt), cpu=time.thread_time() - cpu)
             yield nxt
 
 
 class IterIO:
+    """
+    File-like reads over an iterable of pages
+
+    Keeps a view into the current page rather than copying it; a read that lines up with a whole page hands the page
+    back untouched, anything else costs exactly one copy.
+    """
+
     def __init__(self, itr: typing.Iterable[bytes]):
         self.itr = iter(itr)
-        self.buf = io.BytesIO()
-        self.bufl = 0
+        self.cur = memoryview(b'')
+        self.pos = 0
         self.more = True
 
-    def read(self, n: typing.Optional[int]) -> bytes:
-        res = io.BytesIO()
+    def _fill(self) -> bool:
+        # Make sure there's something unread in self.cur (so `more` is accurate as soon as the last byte is read)
+        while self.pos >= len(self.cur):
+            try:
+                self.cur = memoryview(next(self.itr))
+                self.pos = 0
+            except StopIteration:
+                self.more = False
+                return False
+        return True
+
+    def read(self, n: typing.Optional[int] = None) -> bytes:
+        pieces = []
         remain = n
-        while remain > 0 and self.more:
-            nxt = self.buf.read(remain)
-            remain -= res.write(nxt)
-            self.bufl -= len(nxt)
-            if self.bufl == 0:
-                try:
-                    buf_nxt = next(self.itr)
-                    self.buf = io.BytesIO(buf_nxt)
-                    self.bufl = len(buf_nxt)
-                except StopIteration:
-                    self.more = False
-        res.seek(0)
-        return res.read()
+        while (remain is None or remain > 0) and self._fill():
+            take = len(self.cur) - self.pos if remain is None else min(remain, len(self.cur) - self.pos)
+            pieces.append(self.cur[self.pos:self.pos + take])
+            self.pos += take
+            if remain is not None:
+                remain -= take
+        self._fill()
+        if len(pieces) == 1 and isinstance(pieces[0].obj, bytes) and len(pieces[0]) == len(pieces[0].obj):
+            return pieces[0].obj
+        return b''.join(pieces)
 
 
 def paginate(base: typing.Iterable[bytes], page_size: int = PAGE_SIZE) -> typing.Iterable[bytes]:
-    buf = io.BytesIO()
+    return repaginate(base, itertools.repeat(page_size))
+
+
+def repaginate(base: typing.Iterable[bytes], page_sizes: typing.Iterable[int]) -> typing.Iterable[bytes]:
+    # Like paginate, but each page can ask for a different size
+    # Input that's already the right size passes straight through; otherwise pages are assembled from views into the
+    # input with a single join, so every byte gets copied at most once.
+    page_sizes = iter(page_sizes)
+    page_size = next(page_sizes)
+    pieces = []
+    have = 0
     for nxt in base:
-        while nxt:
-            pivot = page_size - buf.tell()
-            buf.write(nxt[:pivot])
-            nxt = nxt[pivot:]
-            if buf.tell() == page_size:
-                buf.seek(0)
-                yield buf.read()
-                buf.seek(0)
-                buf.truncate()
-    buf.seek(0)
-    nxt = buf.read()
-    if nxt:
-        yield nxt
+        if have == 0 and len(nxt) == page_size and isinstance(nxt, bytes):
+            yield nxt
+            page_size = next(page_sizes)
+            continue
+        view = memoryview(nxt)
+        pos = 0
+        while pos < len(view):
+            take = min(page_size - have, len(view) - pos)
+            pieces.append(view[pos:pos + take])
+            have += take
+            pos += take
+            if have == page_size:
+                yield b''.join(pieces)
+                pieces = []
+                have = 0
+                page_size = next(page_sizes)
+    if have:
+        yield b''.join(pieces)
 
 
 def pad(base: typing.Iterable[bytes], n: int) -> typing.Iterable[bytes]:
@@ -100,30 +143,69 @@ def call(fn) -> typing.Iterable[bytes]:
     yield fn()
 
 
-def gzip(xs: typing.Iterable[bytes]) -> typing.Iterable[bytes]:
-    for x in paginate(xs):
-        res = _gzip.compress(x)
+# Compressed streams start with a zero-length frame (which the original gzip-only format never wrote, not even for
+# empty input) followed by a codec id byte. Anything without that header is the original gzip format.
+CODEC_MARKER = (0).to_bytes(hashbak.serial.INTSIZE, hashbak.serial.ENDIAN)
+
+
+def compress(
+        xs: typing.Iterable[bytes],
+        codec: hashbak.codec.Codec,
+        fname: typing.Optional[str] = None,
+        on_select: typing.Optional[typing.Callable[[hashbak.codec.Codec], None]] = None,
+) -> typing.Iterable[bytes]:
+    pages = iter(paginate(xs, PAGE_SIZE * codec.pages_per_frame))
+    first = next(pages, b'')
+    codec = codec.select(first, fname)
+    if on_select is not None:
+        on_select(codec)
+    if first:
+        pages = cat([first], pages)
+    yield CODEC_MARKER + codec.id
+    frame = hashbak.metrics.metered('compress', codec.compress)
+    for x in pages:
+        res = frame(x)
         size = len(res)
         yield size.to_bytes(hashbak.serial.INTSIZE, hashbak.serial.ENDIAN)
         yield res
 
 
-def ungzip(xs: typing.Iterable[bytes]) -> typing.Iterable[bytes]:
+def decompress(xs: typing.Iterable[bytes]) -> typing.Iterable[bytes]:
     buf = IterIO(xs)
+    codec = hashbak.codec.GzipCodec()
+    first = True
     while buf.more:
-        size = int.from_bytes(buf.read(hashbak.serial.INTSIZE), hashbak.serial.ENDIAN)
-        res = buf.read(size)
-        yield _gzip.decompress(res)
+        head = buf.read(hashbak.serial.INTSIZE)
+        if not head:
+            break
+        size = int.from_bytes(head, hashbak.serial.ENDIAN)
+        if first and size == 0:
+            codec = hashbak.codec.by_id(buf.read(1))
+        else:
+            yield codec.decompress(buf.read(size))
+        first = False
+
+
+def gzip(xs: typing.Iterable[bytes]) -> typing.Iterable[bytes]:
+    return compress(xs, hashbak.codec.GzipCodec())
+
+
+def ungzip(xs: typing.Iterable[bytes]) -> typing.Iterable[bytes]:
+    # Reads anything compress() wrote (whatever the codec), as well as the old header-less gzip format
+    return decompress(xs)
 
 
 def split(xs: typing.Iterable[bytes], size: int) -> (bytes, typing.Iterable[bytes]):
     _iter = iter(xs)
-    _buf = b''
-    while len(_buf) < size:
+    pieces = []
+    have = 0
+    while have < size:
         nxt = next(_iter)
-        _buf += nxt
+        pieces.append(nxt)
+        have += len(nxt)
 
-    return _buf[:size], paginate(cat([_buf[size:]], _iter))
+    view = memoryview(pieces[0] if len(pieces) == 1 else b''.join(pieces))
+    return bytes(view[:size]), paginate(cat([view[size:]], _iter))
 
 
 def log(xs: typing.Iterable[bytes], prefix: str = '') -> typing.Iterable[bytes]:
@@ -141,13 +223,17 @@ def encrypt(base: typing.Iterable[bytes], key: bytes, iv: bytes) -> typing.Itera
     enc = cipher.encryptor()
 
     pd = pad(base, 16)
-    enc = cat(apply(pd, enc.update), call(enc.finalize))
+    enc = cat(apply(pd, hashbak.metrics.metered('encrypt', enc.update)), call(enc.finalize))
     res = cat([iv], enc)
     return paginate(res)
 
 
 def decrypt(base: typing.Iterable[bytes], key: bytes) -> typing.Iterable[bytes]:
-    iv, remain = split(base, 16)
+    head, remain = split(base, len(GCM_MAGIC))
+    if head == GCM_MAGIC:
+        return decrypt_gcm(remain, key)
+
+    iv, remain = split(cat([head], remain), 16)
 
     cipher = cryptography.hazmat.primitives.ciphers.Cipher(
         algorithm=cryptography.hazmat.primitives.ciphers.algorithms.AES(key),
@@ -158,3 +244,206 @@ def decrypt(base: typing.Iterable[bytes], key: bytes) -> typing.Iterable[bytes]:
     dec = cat(apply(remain, dec.update), call(dec.finalize))
     upd = unpad(paginate(dec))
     return upd
+
+
+# AES-GCM stream format:
+#   magic (8) | frame size (8) | salt (16) | frame 0 | frame 1 | ...
+# Each frame is frame_size bytes of plaintext (the last one shorter, possibly empty) sealed independently with
+# AES-GCM, under a key derived from the salt, with the frame index as nonce. The header and a "this is the last frame"
+# flag go in as associated data, so frames can't be reordered, swapped between objects or truncated off the end.
+# Frames sit at fixed offsets, so any byte range can be decrypted without reading the frames before it.
+#
+# CBC streams start with a random-looking IV, so there's a 2^-64 chance one starts with the magic -- close enough.
+GCM_MAGIC = b'HBAESGCM'
+GCM_FRAME_SIZE = 1024**2
+GCM_TAG_SIZE = 16
+GCM_SALT_SIZE = 16
+GCM_HEADER_SIZE = len(GCM_MAGIC) + hashbak.serial.INTSIZE + GCM_SALT_SIZE
+
+
+def _gcm_cipher(key: bytes, salt: bytes) -> cryptography.hazmat.primitives.ciphers.aead.AESGCM:
+    # Fresh key per object, so frame-index nonces never repeat under the same key
+    hkdf = cryptography.hazmat.primitives.kdf.hkdf.HKDF(
+        algorithm=cryptography.hazmat.primitives.hashes.SHA256(),
+        length=32,
+        salt=salt,
+        info=b'hashbak-aes-gcm',
+    )
+    return cryptography.hazmat.primitives.ciphers.aead.AESGCM(hkdf.derive(key))
+
+
+def _gcm_nonce(idx: int) -> bytes:
+    return idx.to_bytes(12, 'big')
+
+
+def _gcm_aad(header: bytes, final: bool) -> bytes:
+    return header + (b'\x01' if final else b'\x00')
+
+
+def _gcm_parse_header(header: bytes) -> (int, bytes):
+    if len(header) != GCM_HEADER_SIZE or not header.startswith(GCM_MAGIC):
+        raise ValueError('Not an AES-GCM stream')
+    frame_size = int.from_bytes(header[len(GCM_MAGIC):-GCM_SALT_SIZE], hashbak.serial.ENDIAN)
+    return frame_size, header[-GCM_SALT_SIZE:]
+
+
+def encrypt_gcm(
+        base: typing.Iterable[bytes],
+        key: bytes,
+        frame_size: int = GCM_FRAME_SIZE,
+        executor: typing.Optional[concurrent.futures.Executor] = None,
+) -> typing.Iterable[bytes]:
+    salt = os.urandom(GCM_SALT_SIZE)
+    header = GCM_MAGIC + frame_size.to_bytes(hashbak.serial.INTSIZE, hashbak.serial.ENDIAN) + salt
+    aead = _gcm_cipher(key, salt)
+
+    def frames() -> typing.Iterable[typing.Tuple[int, bytes, bool]]:
+        idx = 0
+        final = False
+        for page in paginate(base, frame_size):
+            final = len(page) < frame_size
+            yield idx, page, final
+            idx += 1
+        if not final:
+            # A full-size last frame would look just like a truncated stream
+            yield idx, b'', True
+
+    def seal(frame: typing.Tuple[int, bytes, bool]) -> bytes:
+        idx, page, final = frame
+        start, cpu = time.perf_counter(), time.thread_time()
+        res = aead.encrypt(_gcm_nonce(idx), page, _gcm_aad(header, final))
+        hashbak.metrics.record('encrypt', time.perf_counter() - start, len(page), len(res), cpu=time.thread_time() - cpu)
+        return res
+
+    if executor is None:
+        sealed = map(seal, frames())
+    else:
+        # Frames are independent, so they can be sealed in any order -- just hand them back in the right one
+        sealed = hashbak.parallel.ordered((executor.submit(seal, frame) for frame in frames()), 16)
+    return paginate(cat([header], sealed))
+
+
+def decrypt_gcm(remain: typing.Iterable[bytes], key: bytes) -> typing.Iterable[bytes]:
+    # `remain` is everything after the magic
+    rest, remain = split(remain, GCM_HEADER_SIZE - len(GCM_MAGIC))
+    header = GCM_MAGIC + rest
+    frame_size, salt = _gcm_parse_header(header)
+    aead = _gcm_cipher(key, salt)
+
+    def frames() -> typing.Iterable[bytes]:
+        final = False
+        for idx, frame in enumerate(paginate(remain, frame_size + GCM_TAG_SIZE)):
+            if final:
+                raise ValueError('Data after the final frame')
+            final = len(frame) < frame_size + GCM_TAG_SIZE
+            yield aead.decrypt(_gcm_nonce(idx), frame, _gcm_aad(header, final))
+        if not final:
+            raise ValueError('Stream truncated')
+
+    return paginate(frames())
+
+
+
+class RangeReader:
+    """
+    Random access to the plaintext of an encrypt_gcm object: each read fetches (and authenticates) only the frames
+    covering it
+
+    fetch(offset, size) -> the ciphertext at that offset (shorter at the end of the object), e.g. an S3 range GET
+    """
+
+    def __init__(self, fetch: typing.Callable[[int, int], bytes], key: bytes):
+        self.fetch = fetch
+        self.header = fetch(0, GCM_HEADER_SIZE)
+        self.frame_size, salt = _gcm_parse_header(self.header)
+        self.aead = _gcm_cipher(key, salt)
+        # Last frame decrypted: lots of small reads in a row (length prefixes) tend to land in the same one
+        self.last = (-1, b'')
+
+    def read(self, start: int, length: int) -> bytes:
+        if length <= 0:
+            return b''
+        sealed_size = self.frame_size + GCM_TAG_SIZE
+        first = start // self.frame_size
+        last = (start + length - 1) // self.frame_size
+
+        res = []
+        idx = first
+        if self.last[0] == first:
+            res.append(self.last[1])
+            idx += 1
+        if idx <= last:
+            data = self.fetch(GCM_HEADER_SIZE + idx * sealed_size, (last - idx + 1) * sealed_size)
+            for i in range((len(data) + sealed_size - 1) // sealed_size):
+                frame = data[i * sealed_size:(i + 1) * sealed_size]
+                final = len(frame) < sealed_size
+                res.append(self.aead.decrypt(_gcm_nonce(idx + i), frame, _gcm_aad(self.header, final)))
+                if final:
+                    break
+        if res:
+            self.last = (first + len(res) - 1, res[-1])
+        offset = start - first * self.frame_size
+        return b''.join(res)[offset:offset + length]
+
+
+def read_range(fetch: typing.Callable[[int, int], bytes], key: bytes, start: int, length: int) -> typing.Iterable[bytes]:
+    """
+    `length` bytes of the original contents from `start` (fewer at the end), out of an object compress() +
+    encrypt_gcm() wrote, fetching only the frames needed
+
+    Compressed frames all hold the same amount of input (except the last), learned from the first one. Each is
+    prefixed with its compressed size, so getting to the one holding `start` means hopping along those prefixes: a
+    few bytes each, mostly out of GCM frames already fetched. Stored (uncompressed) frames are all the same size on
+    both sides, so for those it's straight arithmetic.
+    """
+    plain = RangeReader(fetch, key)
+    head = plain.read(0, hashbak.serial.INTSIZE + 1)
+    if head[:hashbak.serial.INTSIZE] == CODEC_MARKER:
+        codec = hashbak.codec.by_id(head[hashbak.serial.INTSIZE:])
+        pos = len(head)
+    else:
+        codec = hashbak.codec.GzipCodec()
+        pos = 0
+    stored = isinstance(codec, hashbak.codec.StoredCodec)
+
+    frame_input = 0
+    done = 0
+    while length > 0:
+        if stored and frame_input and start >= done + frame_input:
+            skip = (start - done) // frame_input
+            pos += skip * (hashbak.serial.INTSIZE + frame_input)
+            done += skip * frame_input
+        prefix = plain.read(pos, hashbak.serial.INTSIZE)
+        if len(prefix) < hashbak.serial.INTSIZE:
+            return
+        size = int.from_bytes(prefix, hashbak.serial.ENDIAN)
+        pos += hashbak.serial.INTSIZE
+        if stored:
+            # Same size in as out, no need to look inside to find out
+            frame_input = frame_input or size
+        if frame_input and start >= done + frame_input:
+            # Wholly before the range (a short last frame would be too)
+            done += frame_input
+        else:
+            data = codec.decompress(plain.read(pos, size))
+            frame_input = frame_input or len(data)
+            if start < done + len(data):
+                piece = data[start - done:start - done + length]
+                yield piece
+                start += len(piece)
+                length -= len(piece)
+            done += len(data)
+        pos += size
+
+
+def window(xs: typing.Iterable[bytes], start: int, length: int) -> typing.Iterable[bytes]:
+    # `length` bytes from `start` of a stream, the slow way: everything before it still gets read
+    pos = 0
+    for x in xs:
+        if length <= 0:
+            return
+        if pos + len(x) > start:
+            piece = x[max(start - pos, 0):max(start - pos, 0) + length]
+            yield piece
+            length -= len(piece)
+        pos += len(x)
@@ -0,0 +1,118 @@
+import logging
+import sqlite3
+import time
+import typing
+
+import hashbak.parallel
+import hashbak.remote
+
+
+logger = logging.getLogger(__name__)
+
+
+class ThawPlanner:
+    """
+    Gets a set of archived objects thawed, and hands them back one at a time as they become readable
+
+    Thaw requests go out concurrently (rate limited, so S3 doesn't start throwing SlowDown). Then a single loop
+    polls everything still pending, backing off while nothing is finishing and speeding back up once things do --
+    bulk retrievals take hours, there's no point checking 100k objects every minute.
+
+    Which objects have been requested is kept in a sqlite file, so a restore that gets interrupted picks up where it
+    left off instead of re-requesting everything. Keyed by thaw unit alone (an object hash, or a pack -- see
+    RemoteStorage.restore_unit), so the file doesn't care which snapshot it was for.
+    """
+
+    def __init__(
+            self,
+            storage: hashbak.remote.RemoteStorage,
+            state_path: str = ':memory:',
+            workers: int = 8,
+            rate: float = 50.0,
+            min_poll: float = 60.0,
+            max_poll: float = 1800.0,
+    ):
+        self.storage = storage
+        self.db = sqlite3.connect(state_path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS thaw (fhash BLOB PRIMARY KEY, requested REAL NOT NULL)')
+        self.db.commit()
+        self.workers = max(workers, 1)
+        self.executor = hashbak.parallel.make_executor(self.workers, 'thread')
+        self.limiter = hashbak.parallel.RateLimiter(rate)
+        self.min_poll = min_poll
+        self.max_poll = max_poll
+        self.pending = []
+        self.wanted = set()
+
+    def __enter__(self) -> 'ThawPlanner':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+        self.db.commit()
+        self.db.close()
+
+    def _run(self, fn: typing.Callable[[bytes], typing.Any], fhashes: typing.Iterable[bytes]) -> typing.Iterable[typing.Tuple[bytes, typing.Any]]:
+        def job(fhash: bytes):
+            return fhash, fn(fhash)
+
+        if self.executor is None:
+            return map(job, fhashes)
+        futures = (self.executor.submit(job, fhash) for fhash in fhashes)
+        return hashbak.parallel.ordered(futures, self.workers * 4)
+
+    def _request(self, fhash: bytes) -> None:
+        self.limiter.wait()
+        self.storage.request_restore(fhash)
+
+    def _poll(self, fhash: bytes) -> hashbak.remote.RestoreStatus:
+        self.limiter.wait()
+        status = self.storage.restore_status(fhash)
+        if status == hashbak.remote.RestoreStatus.none:
+            # The restored copy expired, or the request never made it (e.g. interrupted before the state got saved)
+            self._request(fhash)
+        return status
+
+    def request(self, fhashes: typing.Iterable[bytes]) -> None:
+        fresh = []
+        for fhash in fhashes:
+            if fhash in self.wanted:
+                continue
+            self.wanted.add(fhash)
+            self.pending.append(fhash)
+            if self.db.execute('SELECT 1 FROM thaw WHERE fhash = ?', (fhash,)).fetchone() is None:
+                fresh.append(fhash)
+
+        logger.info(f'Requesting thaw of {len(fresh)} objects ({len(self.pending) - len(fresh)} requested earlier)')
+        for i, (fhash, _) in enumerate(self._run(self._request, fresh)):
+            self.db.execute('INSERT OR REPLACE INTO thaw (fhash, requested) VALUES (?, ?)', (fhash, time.time()))
+            if i % 1000 == 999:
+                self.db.commit()
+        self.db.commit()
+
+    def ready(self) -> typing.Iterable[bytes]:
+        # Yields each requested hash once, as soon as a poll finds it readable. The first round goes out right away,
+        # so on a resumed restore whatever already finished comes straight back.
+        interval = self.min_poll
+        first = True
+        while self.pending:
+            if not first:
+                logger.info(f'Waiting on {len(self.pending)} objects to thaw, next check in {interval:.0f}s')
+                time.sleep(interval)
+            first = False
+
+            still = []
+            done = 0
+            for fhash, status in self._run(self._poll, self.pending):
+                if status == hashbak.remote.RestoreStatus.complete:
+                    done += 1
+                    yield fhash
+                else:
+                    still.append(fhash)
+            self.pending = still
+            interval = self.min_poll if done else min(interval * 2, self.max_poll)
+            logger.info(f'Thaw: {done} objects ready, {len(still)} still pending')
@@ -0,0 +1,132 @@
+import concurrent.futures
+import logging
+import os
+import threading
+import typing
+
+import hashbak.chunker
+import hashbak.fmeta
+import hashbak.hasher
+import hashbak.metrics
+import hashbak.parallel
+import hashbak.remote
+import hashbak.stream
+
+
+logger = logging.getLogger(__name__)
+
+
+class Uploader:
+    """
+    Stores the contents of new files, up to `workers` at a time, while the caller gets on with walking + hashing
+
+    Whole-file dedup checks stay on the calling thread (cheap, with the index or catalog loaded), so only actual
+    uploads go to the pool. A hash being uploaded is claimed until it's stored: a second file (or chunk) with the same
+    contents turning up meanwhile counts as a dedup hit instead of being uploaded again. Results come back in the
+    order files were submitted, at most `workers` * 4 in flight.
+    """
+
+    def __init__(
+            self,
+            storage: hashbak.remote.RemoteStorage,
+            hash_salt: bytes,
+            chunker: typing.Optional[hashbak.chunker.Chunker] = None,
+            hasher: typing.Optional[hashbak.hasher.Hasher] = None,
+            workers: int = 1,
+    ):
+        self.storage = storage
+        self.hash_salt = hash_salt
+        self.chunker = chunker
+        # For spooled copies, see Hasher
+        self.hasher = hasher
+        self.executor = hashbak.parallel.make_executor(workers, 'thread')
+        self.window = max(workers, 1) * 4
+        self.lock = threading.Lock()
+        self.claimed: typing.Set[bytes] = set()
+
+    def __enter__(self) -> 'Uploader':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+
+    def claim(self, fhash: bytes) -> bool:
+        # True if the caller should upload fhash: not stored yet, and nobody else is on it
+        with self.lock:
+            if fhash in self.claimed:
+                return False
+        if self.storage.has_object(fhash):
+            return False
+        with self.lock:
+            if fhash in self.claimed:
+                return False
+            self.claimed.add(fhash)
+        return True
+
+    def _unclaim(self, fhash: bytes) -> None:
+        # Stored now, has_object takes it from here
+        with self.lock:
+            self.claimed.discard(fhash)
+
+    def _upload_chunks(self, fpath: str, source: str) -> [bytes]:
+        chunks = []
+        new = 0
+        for chunk in self.chunker.chunks(hashbak.stream.file(source)):
+            chash = hashbak.chunker.chunk_hash(chunk, self.hash_salt)
+            if self.claim(chash):
+                hashbak.metrics.registry.inc('hashbak_dedup_checks_total', result='miss')
+                try:
+                    self.storage.upload_file(chash, [chunk], fpath)
+                finally:
+                    self._unclaim(chash)
+                new += len(chunk)
+            else:
+                hashbak.metrics.registry.inc('hashbak_dedup_checks_total', result='hit')
+            chunks.append(chash)
+        logger.info(f'File {fpath}: {len(chunks)} chunks, {new} new bytes')
+        return chunks
+
+    def _store(self, meta: hashbak.fmeta.FMeta, fpath: str, source: str, chunked: bool) -> hashbak.fmeta.FMeta:
+        # Runs on a worker. Unless chunked, meta.fhash is claimed.
+        try:
+            if chunked:
+                logger.info(f'File {meta.fname}: backing up in chunks')
+                meta.ftype = hashbak.fmeta.FileType.chunked
+                meta.chunks = self._upload_chunks(fpath, source)
+            else:
+                logger.info(f'File {meta.fname}: backing up to {meta.fhash.hex()}')
+                self.storage.upload_file(meta.fhash, hashbak.stream.file(source), fpath)
+        finally:
+            if self.hasher is not None:
+                self.hasher.release(fpath)
+            if not chunked:
+                self._unclaim(meta.fhash)
+            hashbak.metrics.registry.add('hashbak_queue_depth', -1, queue='store')
+        hashbak.metrics.registry.inc('hashbak_files_total', result='new')
+        return meta
+
+    def submit(self, meta: hashbak.fmeta.FMeta, fpath: str) -> concurrent.futures.Future:
+        # -> resolves to meta once its contents are stored (as chunks, possibly: ftype + chunks get filled in)
+        source = (self.hasher.spooled(fpath) if self.hasher is not None else None) or fpath
+        chunked = self.chunker is not None and os.path.getsize(source) >= self.chunker.min_file_size
+        # A chunked file never gets stored under its own hash, so there's nothing to claim: identical copies in flight
+        # just dedup chunk by chunk
+        stored = self.storage.has_object(meta.fhash) if chunked else not self.claim(meta.fhash)
+        if stored:
+            logger.info(f'File {meta.fname} exists at {meta.fhash.hex()}')
+            if self.hasher is not None:
+                self.hasher.release(fpath)
+            hashbak.metrics.registry.inc('hashbak_dedup_checks_total', result='hit')
+            hashbak.metrics.registry.inc('hashbak_files_total', result='dedup')
+            return hashbak.parallel.resolved(meta)
+        if not chunked:
+            hashbak.metrics.registry.inc('hashbak_dedup_checks_total', result='miss')
+        hashbak.metrics.registry.add('hashbak_queue_depth', 1, queue='store')
+        if self.executor is None:
+            return hashbak.parallel.resolved(self._store(meta, fpath, source, chunked))
+        return self.executor.submit(self._store, meta, fpath, source, chunked)
+
+    def results(self, futures: typing.Iterable[concurrent.futures.Future]) -> typing.Iterable[typing.Any]:
+        # `futures` lazy, as for hashbak.parallel.ordered: pulling it is what submits more work
+        return hashbak.parallel.ordered(futures, self.window)
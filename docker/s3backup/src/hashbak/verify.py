@@ -0,0 +1,199 @@
+import dataclasses
+import hashlib
+import logging
+import random
+import typing
+
+import hashbak.fmeta
+import hashbak.pack
+import hashbak.parallel
+import hashbak.remote
+import hashbak.snapshot
+
+
+logger = logging.getLogger(__name__)
+
+
+# Problems of each kind listed in full in the report, past that they're only counted
+MAX_LISTED = 1000
+
+
+def plausible(stored: int, size: int) -> bool:
+    # Stored (compressed + encrypted) size vs. the file's own. Compression means there's no useful lower bound past
+    # "not empty", but it never grows things by more than a bit of framing. size 0 is either an empty file or an old
+    # snapshot that didn't record it, so only the lower bound holds then.
+    if stored <= 0:
+        return False
+    return size == 0 or stored <= size + size // 64 + 4096
+
+
+@dataclasses.dataclass
+class Ref:
+    # A stored object some snapshot needs: the first file found using it, and its plain size (0 if unknown, e.g. a
+    # chunk -- only the whole file's size is recorded)
+    fname: str
+    size: int = 0
+
+
+class Verifier:
+    """
+    Checks a snapshot is restorable, without restoring it
+
+    Cheap level: every object the snapshot points at shows up in the bucket listing (or in a pack that does) with
+    a plausible stored size. Deep level: objects that can be read right now (STANDARD, or thawed) get downloaded,
+    decrypted and hashed in a worker pool, and the hash compared with the one in the snapshot -- all of them, or a
+    random `sample` fraction. Every request goes through one rate limiter, so a scrub can run alongside backups.
+    """
+
+    def __init__(
+            self,
+            storage: hashbak.pack.PackedStorage,
+            hash_salt: typing.Optional[bytes] = None,
+            deep: bool = False,
+            sample: float = 1.0,
+            workers: int = 8,
+            rate: float = 50.0,
+    ):
+        if deep and hash_salt is None:
+            raise ValueError('Deep verification needs the hash salt')
+        self.storage = storage
+        self.hash_salt = hash_salt
+        self.deep = deep
+        self.sample = sample
+        self.workers = max(workers, 1)
+        self.executor = hashbak.parallel.make_executor(self.workers, 'thread')
+        self.limiter = hashbak.parallel.RateLimiter(rate)
+        self.problems: typing.Dict[str, typing.List[dict]] = {}
+        self.counts: typing.Dict[str, int] = {}
+
+    def __enter__(self) -> 'Verifier':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+
+    def _problem(self, kind: str, fhash: bytes, ref: Ref, **details) -> None:
+        self.counts[kind] = self.counts.get(kind, 0) + 1
+        listed = self.problems.setdefault(kind, [])
+        if len(listed) < MAX_LISTED:
+            listed.append({'fhash': fhash.hex(), 'fname': ref.fname, **details})
+        logger.warning(f'{kind}: {fhash.hex()} ({ref.fname}) {details or ""}')
+
+    def _run(self, fn: typing.Callable[[bytes], typing.Any], keys: typing.Iterable[bytes]) -> typing.Iterable[typing.Tuple[bytes, typing.Any]]:
+        def job(key: bytes):
+            return key, fn(key)
+
+        if self.executor is None:
+            return map(job, keys)
+        futures = (self.executor.submit(job, key) for key in keys)
+        return hashbak.parallel.ordered(futures, self.workers * 4)
+
+    def wanted(self, names: [str]) -> typing.Dict[bytes, Ref]:
+        refs = {}
+        for name in names:
+            logger.info(f'Reading snapshot {name}')
+            try:
+                metas = hashbak.snapshot.iter_snapshot(self.storage, name)
+            except hashbak.snapshot.IncompleteSnapshot as e:
+                logger.warning(str(e))
+                self.counts['incomplete_snapshot'] = self.counts.get('incomplete_snapshot', 0) + 1
+                self.problems.setdefault('incomplete_snapshot', []).append({'snapshot': name})
+                continue
+            for meta in metas:
+                if meta.ftype == hashbak.fmeta.FileType.file:
+                    refs.setdefault(meta.fhash, Ref(meta.fname, meta.size))
+                elif meta.ftype == hashbak.fmeta.FileType.chunked:
+                    for chash in meta.chunks:
+                        refs.setdefault(chash, Ref(meta.fname))
+        return refs
+
+    def check_listing(self, refs: typing.Dict[bytes, Ref]) -> typing.Dict[bytes, str]:
+        # -> storage class of everything found, for picking what the deep check can read
+        found = {}
+        for info in self.storage.list_objects():
+            ref = refs.get(info.fhash)
+            if ref is None:
+                continue
+            found[info.fhash] = info.storage_class
+            if not plausible(info.size, ref.size):
+                self._problem('implausible_size', info.fhash, ref, stored=info.size, size=ref.size)
+
+        packs = {info.pack: info for info in self.storage.list_pack_objects()}
+        for fhash, ref in refs.items():
+            if fhash in found:
+                continue
+            entry = self.storage.packed(fhash)
+            if entry is None:
+                self._problem('missing', fhash, ref)
+                continue
+            pack = packs.get(entry.pack_id)
+            if pack is None:
+                self._problem('missing_pack', fhash, ref, pack=entry.pack_id)
+                continue
+            found[fhash] = pack.storage_class
+            if entry.offset + entry.length > pack.size:
+                self._problem('truncated_pack', fhash, ref, pack=entry.pack_id, stored=pack.size, needed=entry.offset + entry.length)
+            elif not plausible(entry.length, ref.size):
+                self._problem('implausible_size', fhash, ref, stored=entry.length, size=ref.size)
+        return found
+
+    def _status(self, unit: bytes) -> hashbak.remote.RestoreStatus:
+        self.limiter.wait()
+        return self.storage.restore_status(unit)
+
+    def _digest(self, fhash: bytes) -> typing.Union[bytes, Exception]:
+        self.limiter.wait()
+        acc = hashlib.sha256()
+        acc.update(self.hash_salt)
+        try:
+            for page in self.storage.get_restored_file(fhash):
+                acc.update(page)
+        except Exception as e:
+            # Bad padding / tag, truncated download... all mean the same thing here
+            return e
+        return acc.digest()
+
+    def check_contents(self, refs: typing.Dict[bytes, Ref], found: typing.Dict[bytes, str]) -> typing.Dict[str, int]:
+        todo = [fhash for fhash in found if self.sample >= 1 or random.random() < self.sample]
+        # STANDARD is readable as is, anything else needs a status check to see if it's thawed. One per thaw unit,
+        # not per object: a pack holds lots of files.
+        readable = []
+        units = {}
+        for fhash in todo:
+            if found[fhash] == 'STANDARD':
+                readable.append(fhash)
+            else:
+                units.setdefault(self.storage.restore_unit(fhash), []).append(fhash)
+        for unit, status in self._run(self._status, list(units)):
+            if status == hashbak.remote.RestoreStatus.complete:
+                readable.extend(units[unit])
+        logger.info(f'Deep check: {len(readable)} of {len(todo)} sampled objects readable without a thaw')
+
+        checked = 0
+        for fhash, digest in self._run(self._digest, readable):
+            checked += 1
+            if isinstance(digest, Exception):
+                self._problem('unreadable', fhash, refs[fhash], error=str(digest) or type(digest).__name__)
+            elif digest != fhash:
+                self._problem('corrupt', fhash, refs[fhash], got=digest.hex())
+            if checked % 1000 == 0:
+                logger.info(f'Deep check: {checked} / {len(readable)}')
+        return {'sampled': len(todo), 'checked': checked, 'archived': len(todo) - len(readable)}
+
+    def run(self, names: [str]) -> dict:
+        refs = self.wanted(names)
+        logger.info(f'Checking {len(refs)} objects against the bucket listing')
+        found = self.check_listing(refs)
+        report = {
+            'snapshots': names,
+            'level': 'deep' if self.deep else 'cheap',
+            'objects': len(refs),
+            'found': len(found),
+        }
+        if self.deep:
+            report['deep'] = self.check_contents(refs, found)
+        report['problems'] = self.counts
+        report['ok'] = not self.counts
+        report['details'] = self.problems
+        return report
@@ -7,6 +7,9 @@ setup(
         'boto3',
         'cryptography',
     ],
+    extras_require={
+        'zstd': ['zstandard'],
+    },
     entry_points={
         'console_scripts': [
             'hashbak = hashbak.cli:main',